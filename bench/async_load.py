@@ -0,0 +1,105 @@
+#!/bin/python3
+
+# Load test of running servers, to compare the sync app (sh src/run.sh)
+# with the async one (sh src/run.sh async) in front of the same Redis. Each
+# client is a session of its own that makes its character, then loops over
+# a mix of reads and writes until time is up; clients run concurrently, on
+# threads. Reports throughput, latency percentiles, errors and Redis round
+# trips per request (from X-Redis-Round-Trips) for each server and number
+# of clients.
+#
+# usage: python bench/async_load.py URL [URL ...] [--clients 10,100,400]
+#            [--seconds 10]
+#   e.g. python bench/async_load.py http://localhost:5000 http://localhost:8000
+
+import argparse
+import json
+import random
+import threading
+from http.client import HTTPConnection
+from time import perf_counter
+from urllib.parse import urlsplit
+
+# (weight, method, path, body)
+MIX = [
+    (6, "GET", "/api/v0/character/name", None),
+    (2, "PUT", "/api/v0/character/name", {"name": "Samuel"}),
+    (2, "GET", "/api/v0/character/equipment", None),
+    (1, "PUT", "/api/v0/character/notes", {"notes": "load test"}),
+    (1, "GET", "/api/v0/character", None)
+]
+
+class Client:
+    def __init__(self, url):
+        url = urlsplit(url)
+        self.conn = HTTPConnection(url.hostname, url.port or 80, timeout = 60)
+        self.cookie = None
+
+    def request(self, method, path, body = None):
+        headers = {"Content-Type": "application/json"}
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        start = perf_counter()
+        self.conn.request(method, path, None if body is None else json.dumps(body), headers)
+        response = self.conn.getresponse()
+        response.read()
+        elapsed = perf_counter() - start
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return elapsed, response.status, int(response.getheader("X-Redis-Round-Trips") or 0)
+
+def run_client(url, seconds, start, results):
+    client = Client(url)
+    # the session and its character, outside the measurements
+    client.request("GET", "/api/v0/character")
+    client.request("POST", "/api/v0/character/equipment", {"name": "rope", "weight": 10})
+    weights = [op[0] for op in MIX]
+    start.wait()
+    end = perf_counter() + seconds
+    out = []
+    while perf_counter() < end:
+        _, method, path, body = random.choices(MIX, weights)[0]
+        try:
+            out.append(client.request(method, path, body))
+        except OSError:
+            out.append((0, 0, 0))
+            client = Client(url)
+    results.extend(out)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def bench(url, clients, seconds):
+    results = []
+    start = threading.Barrier(clients + 1)
+    threads = [threading.Thread(target = run_client, args = (url, seconds, start, results)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - began
+    ok = sorted(r[0] for r in results if 0 < r[1] < 400)
+    errors = len(results) - len(ok)
+    round_trips = sum(r[2] for r in results) / len(results) if results else 0
+    if not ok:
+        print("{:<28} {:>7} {:>10} no successful requests ({} errors)".format(url, clients, 0, errors))
+        return
+    print("{:<28} {:>7} {:>10.0f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7} {:>7.2f}".format(
+        url, clients, len(ok) / elapsed,
+        percentile(ok, 50) * 1000, percentile(ok, 95) * 1000, percentile(ok, 99) * 1000,
+        errors, round_trips
+    ))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("urls", nargs = "+", help = "base URLs of the servers to compare")
+    parser.add_argument("--clients", default = "10,100,400", help = "comma-separated numbers of concurrent sessions")
+    parser.add_argument("--seconds", type = float, default = 10)
+    args = parser.parse_args()
+    print("{:<28} {:>7} {:>10} {:>9} {:>9} {:>9} {:>7} {:>7}".format("server", "clients", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors", "rt/req"))
+    for clients in (int(n) for n in args.clients.split(",")):
+        for url in args.urls:
+            bench(url, clients, args.seconds)
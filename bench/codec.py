@@ -0,0 +1,41 @@
+#!/bin/python3
+
+# Times the response encoding of each endpoint with the old json.dumps call
+# and with the codec, and checks the codec's output matches the stdlib
+# encoding byte for byte.
+#
+# usage: python bench/codec.py [character.json]
+
+import json
+import os
+import sys
+from timeit import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import codec
+
+def envelope(data):
+    return {"status": 200, "message": "", "data": data}
+
+def bench(endpoint, out, number = 2000):
+    assert codec.dumps(out) == codec.std_dumps(out), endpoint
+    raw = codec.dumps(out)
+    old_dumps = timeit(lambda: json.dumps(out), number = number) / number
+    new_dumps = timeit(lambda: codec.dumps(out), number = number) / number
+    old_loads = timeit(lambda: json.loads(raw), number = number) / number
+    new_loads = timeit(lambda: codec.loads(raw), number = number) / number
+    print("{:<34} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+        endpoint, old_dumps * 1e6, new_dumps * 1e6, old_loads * 1e6, new_loads * 1e6))
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "samuel.json")
+    with open(path) as f:
+        doc = json.load(f)
+    print("codec backend: {}, times in microseconds".format(codec.BACKEND))
+    print("{:<34} {:>9} {:>9} {:>9} {:>9}".format("endpoint", "old dump", "new dump", "old load", "new load"))
+    bench("/character", envelope(doc))
+    for name, value in doc.items():
+        data = value if isinstance(value, list) else {name: value}
+        bench("/character/{}".format(name), envelope(data))
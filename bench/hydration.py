@@ -0,0 +1,52 @@
+#!/bin/python3
+
+# Compares full Character hydration with lazy per-section hydration, for
+# samuel.json and a character with 10x as many collection entries.
+#
+# usage: python bench/hydration.py [character.json] [section]
+
+import json
+import os
+import sys
+from timeit import timeit
+from uuid import uuid4 as uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import pythfinder as pf
+from store import encode
+from formats import ValueFormat
+from lazy import LazyCharacter
+
+def scale(doc, factor):
+    out = dict(doc)
+    for name, value in doc.items():
+        if isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+            out[name] = [
+                {**item, "name": "{} {}".format(item.get("name", ""), n), "uuid": str(uuid())}
+                for n in range(factor) for item in value
+            ]
+    return out
+
+def bench(label, doc, section, number = 50):
+    # go through a real Character once so the document is in the current format
+    doc = json.loads(pf.Character(data = doc).get_json())
+    snapshot = encode(doc, ValueFormat().dumps)
+    full = timeit(lambda: pf.Character(data = doc).get_json(), number = number) / number
+    def lazy():
+        character = LazyCharacter(snapshot)
+        character.hydrate({section})
+        character.document({section})
+    part = timeit(lazy, number = number) / number
+    print("{:<12} {:>10.2f} ms {:>10.2f} ms {:>8.1f}x".format(label, full * 1000, part * 1000, full / part))
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "samuel.json")
+    section = sys.argv[2] if len(sys.argv) > 2 else "equipment"
+    with open(path) as f:
+        doc = json.load(f)
+    print("hydrate + serialize, lazy section '{}'".format(section))
+    print("{:<12} {:>13} {:>13} {:>9}".format("character", "full", "lazy", "speedup"))
+    bench("1x", doc, section)
+    bench("10x", scale(doc, 10), section)
@@ -0,0 +1,286 @@
+#!/bin/python3
+
+# Replays traffic mixes against the app, run in-process through Flask's
+# test client, with Redis at --redis or a fakeredis stand-in (--fake, needs
+# fakeredis). Each mix runs against characters of each size: 0 is a blank
+# character, N is samuel.json with N times as many collection entries.
+# Each client is a session of its own, on a thread, that makes its
+# character and then sends the mix's requests.
+#
+# Reports throughput, latency percentiles, errors, Redis round trips per
+# request (from X-Redis-Round-Trips) and Redis commands per request (from
+# INFO commandstats, counting those run by scripts; not with --fake).
+#
+# --save writes the results to a baseline file; --baseline compares with
+# one, and exits with status 1 if a mix got slower at p95 by more than
+# --tolerance, or makes more round trips. Round trips don't depend on the
+# machine; latencies only compare with a baseline from the same one, made
+# with the same settings. bench/baseline-fake.json is a --fake baseline,
+# for its round trips.
+#
+# usage: python bench/load.py [--redis URL | --fake] [--mixes view,inventory,spells,replace]
+#            [--sizes 0,1,10] [--requests 500] [--clients 1]
+#            [--save FILE] [--baseline FILE] [--tolerance 0.25]
+#   e.g. python bench/load.py --fake --baseline bench/baseline-fake.json
+#        python bench/load.py --fake --save bench/baseline-fake.json
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import sys
+import threading
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+import metrics
+from hydration import scale
+
+WARMUP = 20 # requests each client sends before it's measured
+CHARACTER_TTL = 10*60 # seconds the characters made here are kept in a real Redis
+ROUND_TRIP_TOLERANCE = 0.05 # more round trips per request allowed against the baseline, for retries and random picks
+
+# A client's session: its character's items of each collection by uuid,
+# and the ones it added itself, which are the only ones it deletes
+class Session:
+    def __init__(self, client, rng):
+        self.client = client
+        self.rng = rng
+        self.items = {}
+        self.added = {}
+
+    def pick(self, collection):
+        items = self.items.get(collection)
+        return self.rng.choice(items) if items else None
+
+def level_filter(session):
+    return "/api/v0/character/spells?level={}".format(json.dumps({"lt": session.rng.randint(1, 9)}))
+
+def new_equipment(session):
+    return {"name": "crate {}".format(session.rng.randint(0, 10**6)), "weight": session.rng.randint(1, 50), "count": 1}
+
+def new_spell(session):
+    return {"name": "spell {}".format(session.rng.randint(0, 10**6)), "level": session.rng.randint(0, 9), "prepared": 0, "cast": 0}
+
+# Each op returns (method, path, body), or None when it can't run (nothing
+# to edit or delete yet)
+def get(path):
+    return lambda session: ("GET", path, None)
+
+def post(collection, body):
+    return lambda session: ("POST", "/api/v0/character/" + collection, body(session))
+
+def patch_item(collection, body):
+    def op(session):
+        uuid = session.pick(collection)
+        return uuid and ("PATCH", "/api/v0/character/{}/{}".format(collection, uuid), body(session))
+    return op
+
+def get_item(collection):
+    def op(session):
+        uuid = session.pick(collection)
+        return uuid and ("GET", "/api/v0/character/{}/{}".format(collection, uuid), None)
+    return op
+
+def delete_added(collection):
+    def op(session):
+        added = session.added.get(collection)
+        if not added:
+            return None
+        uuid = added.pop(session.rng.randrange(len(added)))
+        session.items[collection].remove(uuid)
+        return ("DELETE", "/api/v0/character/{}/{}".format(collection, uuid), None)
+    return op
+
+def replace_character(session):
+    return ("PUT", "/api/v0/character", session.doc)
+
+# name -> [(weight, op)]
+MIXES = {
+    # looking over a character sheet
+    "view": [
+        (4, get("/api/v0/character")),
+        (2, get("/api/v0/character/derived")),
+        (2, get("/api/v0/character/name")),
+        (1, get("/api/v0/character/equipment")),
+        (1, get("/api/v0/character/skills")),
+        (1, lambda session: ("GET", level_filter(session), None))
+    ],
+    # managing inventory
+    "inventory": [
+        (3, get("/api/v0/character/equipment")),
+        (1, get_item("equipment")),
+        (2, post("equipment", new_equipment)),
+        (3, patch_item("equipment", lambda session: {"count": session.rng.randint(1, 20)})),
+        (1, delete_added("equipment"))
+    ],
+    # preparing and casting spells
+    "spells": [
+        (3, lambda session: ("GET", level_filter(session), None)),
+        (2, post("spells", new_spell)),
+        (3, patch_item("spells", lambda session: {"prepared": session.rng.randint(0, 4), "cast": session.rng.randint(0, 4)})),
+        (1, delete_added("spells"))
+    ],
+    # clients that save the whole character
+    "replace": [
+        (1, get("/api/v0/character")),
+        (1, replace_character)
+    ]
+}
+
+def request(session, method, path, body = None):
+    start = perf_counter()
+    response = session.client.open(path, method = method, json = body)
+    elapsed = perf_counter() - start
+    data = response.get_data()
+    if method == "POST" and response.status_code < 300:
+        collection = path.rsplit("/", 1)[1]
+        uuid = json.loads(data)["data"]["uuid"]
+        session.items.setdefault(collection, []).append(uuid)
+        session.added.setdefault(collection, []).append(uuid)
+    return elapsed, response.status_code, int(response.headers.get("X-Redis-Round-Trips") or 0)
+
+# The session's character, stored, and what it holds
+def setup(session, doc):
+    session.doc = doc
+    if doc:
+        request(session, "PUT", "/api/v0/character", doc)
+    else:
+        request(session, "PUT", "/api/v0/character/name", {"name": "Blank"})
+    stored = json.loads(session.client.get("/api/v0/character").get_data())["data"]
+    session.doc = stored
+    for name, value in stored.items():
+        if isinstance(value, list):
+            session.items[name] = [item["uuid"] for item in value if isinstance(item, dict) and "uuid" in item]
+
+def run_client(app, doc, mix, count, seed, start, results):
+    session = Session(app.test_client(), random.Random(seed))
+    setup(session, doc)
+    weights = [weight for weight, _ in mix]
+    out = []
+    for n in range(WARMUP + count):
+        if n == WARMUP:
+            start.wait()
+        op = None
+        while op is None:
+            op = session.rng.choices(mix, weights)[0][1](session)
+        result = request(session, *op)
+        if n >= WARMUP:
+            out.append(result)
+    results.extend(out)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Commands Redis has run, or None if it can't say
+def commands(state):
+    from redis.exceptions import ResponseError
+    try:
+        stats = state.r.info("commandstats")
+    except ResponseError:
+        return None
+    return sum(value["calls"] for name, value in stats.items() if name != "cmdstat_info")
+
+def bench(app, doc, mix, requests, clients, seed):
+    state = app.extensions["pythfinder"]
+    results = []
+    start = threading.Barrier(clients + 1)
+    threads = [
+        threading.Thread(target = run_client, args = (app, doc, mix, requests // clients, seed + n, start, results))
+        for n in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    before = commands(state)
+    began = perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - began
+    after = commands(state)
+    ok = sorted(r[0] for r in results if r[1] < 400)
+    return {
+        "requests": len(results),
+        "rps": len(ok) / elapsed,
+        "p50": percentile(ok, 50) * 1000 if ok else None,
+        "p95": percentile(ok, 95) * 1000 if ok else None,
+        "p99": percentile(ok, 99) * 1000 if ok else None,
+        "errors": len(results) - len(ok),
+        "round_trips": sum(r[2] for r in results) / len(results),
+        "commands": None if before is None else (after - before) / len(results)
+    }
+
+def make_app(args):
+    pf_flask = importlib.import_module("pf-flask")
+    app = pf_flask.create_app({"REDIS_URL": args.redis, "CORS_ORIGIN": "", "CHARACTER_TTL": CHARACTER_TTL})
+    if args.fake:
+        import fakeredis
+        from redis import BlockingConnectionPool
+        app.extensions["pythfinder"].pool = BlockingConnectionPool(
+            connection_class = metrics.counting(fakeredis.FakeRedisConnection),
+            server = fakeredis.FakeServer(),
+            max_connections = app.config["REDIS_MAX_CONNECTIONS"]
+        )
+    return app
+
+def compare(results, baseline, tolerance, latencies = True):
+    failures = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        if result["round_trips"] > old["round_trips"] * (1 + ROUND_TRIP_TOLERANCE):
+            failures.append("{}: {:.2f} round trips per request, was {:.2f}".format(key, result["round_trips"], old["round_trips"]))
+        if latencies and result["p95"] is not None and old["p95"] is not None and result["p95"] > old["p95"] * (1 + tolerance):
+            failures.append("{}: p95 {:.1f} ms, was {:.1f} ms".format(key, result["p95"], old["p95"]))
+    return failures
+
+def number(value, format):
+    return "-" if value is None else format.format(value)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis", default = "redis://localhost:6379/15", help = "Redis to run against")
+    parser.add_argument("--fake", action = "store_true", help = "use fakeredis instead of a Redis server")
+    parser.add_argument("--mixes", default = ",".join(MIXES), help = "comma-separated traffic mixes: " + ", ".join(MIXES))
+    parser.add_argument("--sizes", default = "0,1,10", help = "comma-separated character sizes, in samuel.json's")
+    parser.add_argument("--requests", type = int, default = 500, help = "measured requests per mix and size")
+    parser.add_argument("--clients", type = int, default = 1, help = "concurrent sessions")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--save", help = "write the results to this baseline file")
+    parser.add_argument("--baseline", help = "compare with this baseline file")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "p95 slowdown allowed against the baseline")
+    args = parser.parse_args()
+    app = make_app(args)
+    with open(os.path.join(ROOT, "samuel.json")) as f:
+        samuel = json.load(f)
+    print("{:<10} {:>5} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7} {:>7}".format("mix", "size", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors", "rt/req", "cmd/req"))
+    settings = {"machine": platform.node(), "fake": args.fake, "clients": args.clients, "requests": args.requests, "seed": args.seed}
+    results = {}
+    for name in args.mixes.split(","):
+        for size in (int(n) for n in args.sizes.split(",")):
+            doc = scale(samuel, size) if size else None
+            result = results["{}/{}".format(name, size)] = bench(app, doc, MIXES[name], args.requests, args.clients, args.seed)
+            print("{:<10} {:>5} {:>9.0f} {:>9} {:>9} {:>9} {:>7} {:>7.2f} {:>7}".format(
+                name, size, result["rps"],
+                number(result["p50"], "{:.2f}"), number(result["p95"], "{:.2f}"), number(result["p99"], "{:.2f}"),
+                result["errors"], result["round_trips"], number(result["commands"], "{:.1f}")
+            ))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, indent = 4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        same = baseline["settings"] == settings
+        if not same:
+            print("baseline was made with {}; comparing round trips only".format(baseline["settings"]))
+        failures = compare(results, baseline["results"], args.tolerance, latencies = same)
+        for failure in failures:
+            print(failure)
+        if failures:
+            sys.exit(1)
@@ -0,0 +1,67 @@
+#!/bin/python3
+
+# Import and app creation time for pf-flask.py, each measured in a fresh
+# interpreter, plus the slowest top-level imports from one -X importtime
+# run. With --max-ms, exits with status 1 if the median import +
+# create_app() time is over that, to catch startup regressions.
+#
+# usage: python bench/startup.py [--runs 20] [--max-ms N]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+SNIPPET = """
+import sys
+from time import perf_counter
+start = perf_counter()
+import importlib
+module = importlib.import_module("pf-flask")
+imported = perf_counter()
+module.create_app()
+created = perf_counter()
+print(imported - start, created - imported, "redis" in sys.modules)
+"""
+
+def run(*args):
+    return subprocess.run([sys.executable, *args], cwd = SRC, capture_output = True, text = True, check = True)
+
+def slowest_imports(count):
+    stderr = run("-X", "importtime", "-c", SNIPPET).stderr
+    top = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # top-level imports are the ones indented by a single space
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            top.append((int(cumulative), name.strip()))
+    return sorted(top, reverse = True)[:count]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type = int, default = 20)
+    parser.add_argument("--max-ms", type = float, help = "fail if import + create_app() takes longer (median)")
+    args = parser.parse_args()
+    imports, creates, redis = [], [], False
+    for _ in range(args.runs):
+        imported, created, redis_imported = run("-c", SNIPPET).stdout.split()
+        imports.append(float(imported) * 1000)
+        creates.append(float(created) * 1000)
+        redis = redis or redis_imported == "True"
+    totals = [i + c for i, c in zip(imports, creates)]
+    print("{:<16} {:>10} {:>10} {:>10}".format("", "median", "min", "max"))
+    for label, times in (("import", imports), ("create_app()", creates), ("total", totals)):
+        print("{:<16} {:>7.1f} ms {:>7.1f} ms {:>7.1f} ms".format(label, statistics.median(times), min(times), max(times)))
+    print("redis imported: {}".format("yes" if redis else "no"))
+    print("slowest top-level imports:")
+    for cumulative, name in slowest_imports(10):
+        print("  {:<28} {:>7.1f} ms".format(name, cumulative / 1000))
+    if args.max_ms is not None and statistics.median(totals) > args.max_ms:
+        print("median {:.1f} ms is over --max-ms {:.1f}".format(statistics.median(totals), args.max_ms))
+        sys.exit(1)
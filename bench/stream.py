@@ -0,0 +1,67 @@
+#!/bin/python3
+
+# Compares building GET /character's body from a hydrated Character with
+# streaming it from the stored values: time to first chunk, total time and
+# peak memory, for samuel.json and a character with 10x as many
+# collection entries.
+#
+# usage: python bench/stream.py [character.json]
+
+import json
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import codec
+import pythfinder as pf
+from store import encode, iter_json
+from formats import ValueFormat
+from lazy import LazyCharacter, BLANK_DOC
+from hydration import scale
+
+def built(snapshot):
+    data = codec.loads(LazyCharacter(snapshot).hydrate().get_json())
+    yield codec.dumps({"status": 200, "message": "", "data": data}).encode()
+
+def streamed(snapshot):
+    yield b'{"status":200,"message":"","data":'
+    yield from iter_json(snapshot, BLANK_DOC)
+    yield b"}"
+
+# times are taken without tracemalloc running, since it slows allocation
+def measure(body, snapshot):
+    start = perf_counter()
+    chunks = body(snapshot)
+    next(chunks)
+    first = perf_counter() - start
+    for chunk in chunks:
+        pass
+    total = perf_counter() - start
+    tracemalloc.start()
+    for chunk in body(snapshot):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first, total, peak
+
+def bench(label, doc, binary):
+    doc = json.loads(pf.Character(data = doc).get_json())
+    snapshot = encode(doc, ValueFormat(binary = binary).dumps)
+    for name, body in (("built", built), ("streamed", streamed)):
+        first, total, peak = measure(body, snapshot)
+        print("{:<12} {:<9} {:>10.2f} ms {:>10.2f} ms {:>10.0f} KB".format(label, name, first * 1000, total * 1000, peak / 1024))
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "samuel.json")
+    with open(path) as f:
+        doc = json.load(f)
+    for binary in (True, False):
+        print("values stored as {}".format("msgpack" if binary else "JSON"))
+        print("{:<12} {:<9} {:>13} {:>13} {:>13}".format("character", "body", "first chunk", "total", "peak memory"))
+        bench("1x", doc, binary)
+        bench("10x", scale(doc, 10), binary)
@@ -0,0 +1,108 @@
+#!/bin/python3
+
+# Reports how much Redis memory each stored character takes now, and how
+# much it would take in a given storage format. Characters are read from
+# --redis without changing anything there; each one is rewritten into
+# --scratch (a database that should otherwise be empty) to measure it, then
+# deleted again.
+#
+# With --train-dict, a zstd dictionary is first trained on the characters
+# found and used for the "after" numbers; point STORAGE_ZSTD_DICTIONARY at
+# the file to use it in the app.
+#
+# usage: python scripts/session_memory.py [--redis URL] [--scratch URL]
+#            [--text | --level N] [--dictionary PATH | --train-dict PATH]
+#            [--verbose]
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from redis import Redis
+from formats import ValueFormat
+from store import CharacterStore, decode_section, encode
+
+def character_ids(r):
+    for key in r.scan_iter(match = "*:version", count = 1000):
+        yield key.decode().rsplit(":", 1)[0]
+    # old-format characters that were never saved with a version
+    for key in r.scan_iter(count = 1000):
+        if b":" not in key and r.type(key) == b"string" and not r.exists(key + b":version"):
+            yield key.decode()
+
+def memory(r, keys):
+    return sum(r.memory_usage(key) or 0 for key in keys)
+
+# a character's keys, with the change log every write adds to
+def character_keys(store, id):
+    return store.keys(id) + [store.changes_key(id)]
+
+def documents(source, ids):
+    for id in ids:
+        snapshot = source.load(id, migrate = False)[1]
+        if snapshot is not None:
+            fields, collections = snapshot
+            yield id, {name: decode_section(snapshot, name) for name in set(fields) | set(collections)}
+
+# zstandard is only needed here, as in the app, where values are compressed
+def train(source, ids, path, size):
+    import zstandard
+    plain = ValueFormat(binary = True, level = 0)
+    samples = []
+    for _, doc in documents(source, ids):
+        fields, collections = encode(doc, plain.dumps)
+        samples += [raw[1:] for raw in fields.values()]
+        samples += [raw[1:] for items in collections.values() for raw in items.values()]
+    dictionary = zstandard.train_dictionary(size, samples)
+    with open(path, "wb") as f:
+        f.write(dictionary.as_bytes())
+    print("trained {} byte dictionary on {} values -> {}".format(size, len(samples), path))
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis", default = "redis://localhost:6379/0")
+    parser.add_argument("--scratch", default = "redis://localhost:6379/15")
+    parser.add_argument("--text", action = "store_true", help = "measure JSON text values instead of binary")
+    parser.add_argument("--level", type = int, default = 3, help = "zstd level, 0 for no compression")
+    parser.add_argument("--dictionary", help = "zstd dictionary to compress with")
+    parser.add_argument("--train-dict", help = "train a dictionary on the keyspace, write it here and use it")
+    parser.add_argument("--dict-size", type = int, default = 16*1024)
+    parser.add_argument("--verbose", action = "store_true", help = "print every session")
+    args = parser.parse_args()
+    if args.train_dict and (args.text or not args.level):
+        sys.exit("--train-dict is for compressed values; it can't be used with --text or --level 0")
+
+    r = Redis.from_url(args.redis)
+    scratch = Redis.from_url(args.scratch)
+    if scratch.dbsize():
+        sys.exit("scratch database {} isn't empty".format(args.scratch))
+    source = CharacterStore(r, ttl = 0)
+    ids = sorted(set(character_ids(r)))
+    dictionary = args.dictionary
+    if args.train_dict:
+        dictionary = train(source, ids, args.train_dict, args.dict_size)
+    target = CharacterStore(scratch, ttl = 3600, format = ValueFormat(
+        binary = not args.text,
+        level = args.level,
+        dictionary = dictionary
+    ))
+
+    total_before = total_after = 0
+    for id, doc in documents(source, ids):
+        before = memory(r, character_keys(source, id))
+        target.write(id, None, target.encode(doc), None)
+        after = memory(scratch, character_keys(target, id))
+        scratch.delete(*target.write_keys(id, None))
+        total_before += before
+        total_after += after
+        if args.verbose:
+            print("{:<40} {:>10} {:>10}".format(id, before, after))
+    count = len(ids)
+    print("{} sessions".format(count))
+    if count:
+        print("before: {:>12} bytes total, {:>10.0f} per session".format(total_before, total_before / count))
+        print("after:  {:>12} bytes total, {:>10.0f} per session ({:.0%})".format(total_after, total_after / count, total_after / max(total_before, 1)))
@@ -0,0 +1,387 @@
+#!/bin/python3
+
+# ASGI entry point: serves pf-flask.py's app with Redis reached through
+# redis.asyncio, so one process can have hundreds of requests waiting on
+# Redis at once instead of a thread per request.
+#
+# Requests to the active character's endpoints (bp) run in three steps: the
+# character is read asynchronously, the Flask app handles the request
+# against it in memory, and whatever the request changed is written
+# asynchronously (see defer_writes in pf-flask.py). A save that loses a race
+# runs the request again, as the sync path does. Everything else (new
+# sessions, the account endpoints, /metrics) does its own Redis I/O part
+# way through, and runs on a thread with the blocking client.
+#
+# Change feeds (/character/changes, /characters/<id>/changes) are held
+# open here: every stream in the process is fed from one pub/sub
+# connection (ChangeFeed), so an idle one costs a task and a queue.
+#
+# usage: uvicorn asgi:app (from src/; see run.sh)
+
+import asyncio
+import importlib
+import sys
+from io import BytesIO
+from redis.asyncio import Redis, BlockingConnectionPool, Connection
+from redis.exceptions import RedisError
+from werkzeug.exceptions import HTTPException, Conflict, PreconditionFailed, NotFound
+import codec
+import metrics
+from store import AsyncCharacterStore, merge, snapshot_size, UNCHANGED
+from lazy import LazyCharacter
+
+pf_flask = importlib.import_module("pf-flask")
+
+REDIS_MAX_CONNECTIONS = 256 # one per request waiting on Redis, per process
+FEED_KEEPALIVE = 15 # seconds between comments sent on an idle change feed, so proxies keep it open
+FEED_QUEUE_SIZE = 64 # writes waiting for a slow change feed client; past that it catches up from the log
+FEED_RECONNECT = 1 # seconds between attempts to get the change feed's pub/sub connection back
+GAP = (None, None) # queued for change feeds that may have missed writes
+
+flask_app = pf_flask.create_app()
+state = flask_app.extensions["pythfinder"]
+pool = BlockingConnectionPool.from_url(
+    flask_app.config["REDIS_URL"],
+    max_connections = REDIS_MAX_CONNECTIONS,
+    timeout = flask_app.config["REDIS_POOL_TIMEOUT"],
+    connection_class = metrics.counting(Connection)
+)
+store = AsyncCharacterStore(state.connect(), Redis(connection_pool = pool))
+FEED_ENDPOINTS = (pf_flask.bp.name + ".character_changes", pf_flask.accounts.name + ".account_character_changes")
+# endpoints of bp that read Redis for more than the character, so run on a thread
+THREADED_ENDPOINTS = (pf_flask.bp.name + ".character_patches",)
+
+# Hands the messages published on each character's channel to the queues
+# of the streams following it, over one pub/sub connection, read by one
+# task from the first subscription on. If the connection fails, the reader
+# makes a new one, subscribes it to every channel still followed and
+# queues GAP for each stream, since writes published in between are lost.
+class ChangeFeed:
+    def __init__(self, r):
+        self.r = r
+        self.pubsub = None
+        self.queues = {}
+        self.reader = None
+        self.lock = asyncio.Lock()
+
+    async def subscribe(self, channel):
+        queue = asyncio.Queue(FEED_QUEUE_SIZE)
+        async with self.lock:
+            if self.pubsub is None:
+                self.pubsub = self.r.pubsub()
+            subscribers = self.queues.setdefault(channel, set())
+            subscribers.add(queue)
+            if len(subscribers) == 1:
+                try:
+                    await self.pubsub.subscribe(channel)
+                except (RedisError, OSError):
+                    # the reader's reconnect subscribes it
+                    pass
+            if self.reader is None or self.reader.done():
+                self.reader = asyncio.create_task(self.read())
+        return queue
+
+    async def unsubscribe(self, channel, queue):
+        async with self.lock:
+            subscribers = self.queues.get(channel, set())
+            subscribers.discard(queue)
+            if not subscribers:
+                self.queues.pop(channel, None)
+                try:
+                    await self.pubsub.unsubscribe(channel)
+                except (RedisError, OSError):
+                    pass
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages = True, timeout = 1.0)
+            except (RedisError, OSError, RuntimeError):
+                # RuntimeError: the first subscribe failed, so the pub/sub
+                # never got a connection
+                await self.reconnect()
+                continue
+            if message is None:
+                continue
+            version, _, patch = message["data"].partition(b" ")
+            if not version.isdigit():
+                continue
+            for queue in self.queues.get(message["channel"].decode(), ()):
+                offer(queue, (int(version), patch.decode() or None))
+
+    async def reconnect(self):
+        while True:
+            await asyncio.sleep(FEED_RECONNECT)
+            async with self.lock:
+                old, self.pubsub = self.pubsub, self.r.pubsub()
+                try:
+                    await old.aclose()
+                except (RedisError, OSError):
+                    pass
+                try:
+                    if self.queues:
+                        await self.pubsub.subscribe(*self.queues)
+                except (RedisError, OSError):
+                    continue
+                for subscribers in self.queues.values():
+                    for queue in subscribers:
+                        offer(queue, GAP)
+                return
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+
+# Queues item for a stream. A stream too far behind loses its oldest
+# change instead, and sees the gap in versions and reads the log.
+def offer(queue, item):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+feed = ChangeFeed(store.r)
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return bytes(body)
+
+# WSGI environ for an ASGI http scope
+def make_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[key] = environ[key] + "," + value if key in environ else value
+    # the body has been read whole, however it was sent (chunked requests
+    # have no Content-Length)
+    environ["CONTENT_LENGTH"] = str(len(body))
+    environ["wsgi.input_terminated"] = True
+    return environ
+
+# Runs the Flask app; returns the status, headers and body iterable
+def run_wsgi(environ):
+    started = []
+    def start_response(status, headers, exc_info = None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+    body = flask_app(environ, start_response)
+    return started[0], started[1], body
+
+def error_response(e, headers):
+    with flask_app.app_context():
+        response = pf_flask.handle_exception(e)
+    # keep the session cookie the request would have set
+    cookies = [(name, value) for name, value in headers if name.lower() == "set-cookie"]
+    return response.status_code, response.headers.to_wsgi_list() + cookies, [response.get_data()]
+
+# The active character's id, if the request can run with its Redis I/O
+# taken out of it: an endpoint of bp, from a session that has a character.
+# A body the app would turn away isn't worth reading the character for; it
+# goes to the app on a thread, which rejects it without touching Redis.
+def deferrable(environ, body):
+    try:
+        rule, _ = flask_app.url_map.bind_to_environ(environ).match(return_rule = True)
+    except HTTPException:
+        return None
+    if not rule.endpoint.startswith(pf_flask.bp.name + ".") or rule.endpoint in THREADED_ENDPOINTS:
+        return None
+    if environ["REQUEST_METHOD"] in ("POST", "PUT", "PATCH") and pf_flask.PAYLOADS.get(rule.endpoint.rpartition(".")[2]):
+        try:
+            data = codec.loads(body)
+        except ValueError:
+            return None
+        if pf_flask.payload_error(rule.endpoint, environ["REQUEST_METHOD"], data) is not None:
+            return None
+    session = flask_app.session_interface.open_session(flask_app, flask_app.request_class(environ))
+    if not session or "id" not in session or "user" not in session:
+        return None
+    return session["id"]
+
+# The character a change feed request follows, the session's account, and
+# whether the account has to be checked for it (it's not the session's
+# own), if the stream can be held open here: it needs a session that's made
+# a character. Anything else is left to the app.
+def feed_target(environ):
+    try:
+        rule, args = flask_app.url_map.bind_to_environ(environ).match(return_rule = True)
+    except HTTPException:
+        return None
+    if rule.endpoint not in FEED_ENDPOINTS:
+        return None
+    session = flask_app.session_interface.open_session(flask_app, flask_app.request_class(environ))
+    if not session or "id" not in session or "user" not in session:
+        return None
+    return args.get("id", session["id"]), session["user"], "id" in args
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+# The change feed as pf-flask.py's change_feed() gives it, then each write
+# as it's published, until the client goes away
+async def stream_changes(environ, receive, send, id, user, owned):
+    try:
+        since = pf_flask.last_event_id(flask_app.request_class(environ))
+        if owned and await store.r.zscore(store.store.index_key(user), id) is None:
+            raise NotFound(description = "character not found with id '{}'".format(id))
+    except HTTPException as e:
+        status, headers, body = error_response(e, [])
+        await send({"type": "http.response.start", "status": status, "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+        await send({"type": "http.response.body", "body": b"".join(body)})
+        return
+    channel = store.store.changes_key(id)
+    queue = await feed.subscribe(channel)
+    disconnected = asyncio.create_task(wait_for_disconnect(receive))
+    try:
+        # subscribed first, so nothing written after the log is read is missed
+        if since is None:
+            version, changes = int(await store.r.get(store.store.keys(id)[0]) or 0), []
+        else:
+            version, changes = await store.changes(id, since)
+        headers = {**state.header, "Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        await send({"type": "http.response.start", "status": 200, "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]})
+        events = "retry: {}\n{}".format(pf_flask.CHANGES_RETRY, pf_flask.change_events(version, changes))
+        last = changes[-1][0] if changes else version
+        while True:
+            await send({"type": "http.response.body", "body": events.encode(), "more_body": True})
+            change = asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait((change, disconnected), timeout = FEED_KEEPALIVE, return_when = asyncio.FIRST_COMPLETED)
+            if change not in done:
+                change.cancel()
+                if disconnected in done:
+                    return
+                events = ": keepalive\n\n"
+                continue
+            change_version, patch = change.result()
+            if change_version is not None and change_version <= last:
+                events = ""
+            elif change_version == last + 1:
+                events = pf_flask.change_events(change_version, [(change_version, patch)])
+                last = change_version
+            else:
+                # missed some; the log has them
+                version, changes = await store.changes(id, last)
+                events = pf_flask.change_events(version, changes)
+                last = changes[-1][0] if changes else version
+    finally:
+        disconnected.cancel()
+        await feed.unsubscribe(channel, queue)
+
+# As load_character, in one round trip when the cached character is current
+async def prefetch(id):
+    version, snapshot = await store.load(id, unless_version = state.characters.version(id))
+    cached = state.characters.checkout(id, version)
+    if not cached:
+        if snapshot is UNCHANGED:
+            version, snapshot = await store.load(id)
+        cached = LazyCharacter(snapshot)
+    return version, cached
+
+# Makes the writes a request left in its environ; returns the character's
+# version after them (None if it never read the character), or -1 if the
+# save lost a race
+async def write(deferred):
+    lazy = deferred["character"]
+    version = deferred["version"]
+    if deferred["save"] is not None:
+        snapshot, sections = deferred["save"]
+        version = await store.write(deferred["id"], version, snapshot, lazy.snapshot, sections, owner = deferred["owner"])
+        if version < 0:
+            return -1
+        lazy.snapshot = merge(lazy.snapshot, snapshot, sections)
+    elif deferred["touch"]:
+        await store.touch(deferred["id"], owner = deferred["owner"])
+    if lazy is not None and lazy.snapshot is not None:
+        state.characters.checkin(deferred["id"], version, lazy, snapshot_size(lazy.snapshot))
+    return version
+
+async def run_deferred(environ, body, id):
+    attempts = 1
+    while True:
+        attempt = dict(environ, **{"wsgi.input": BytesIO(body)})
+        attempt["pythfinder.prefetched"] = await prefetch(id)
+        status, headers, app_iter = run_wsgi(attempt)
+        deferred = attempt.get("pythfinder.deferred")
+        if deferred is None:
+            return status, headers, app_iter
+        version = await write(deferred)
+        if version != -1:
+            if deferred["save"] is not None and status < 300:
+                headers = [(name, value) for name, value in headers if name.lower() != "etag"]
+                headers.append(("ETag", '"{}"'.format(pf_flask.etag(version))))
+            return status, headers, app_iter
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+        if deferred["if_match"] is not None:
+            return error_response(PreconditionFailed(description = "character has changed since it was last fetched"), headers)
+        if attempts == pf_flask.SAVE_ATTEMPTS:
+            return error_response(Conflict(description = "character was changed by another request; try again"), headers)
+        await asyncio.sleep(pf_flask.save_backoff(attempts))
+        attempts += 1
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await feed.close()
+            await pool.disconnect()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    body = await read_body(receive)
+    environ = make_environ(scope, body)
+    target = feed_target(environ)
+    if target is not None:
+        return await stream_changes(environ, receive, send, *target)
+    id = deferrable(environ, body)
+    if id is None:
+        status, headers, app_iter = await asyncio.to_thread(run_wsgi, environ)
+    else:
+        metrics.start()
+        status, headers, app_iter = await run_deferred(environ, body, id)
+        headers = headers + [("X-Redis-Round-Trips", str(metrics.finish()))]
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+    })
+    try:
+        for chunk in app_iter:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    await send({"type": "http.response.body", "body": b""})
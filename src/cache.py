@@ -0,0 +1,68 @@
+# Per-process LRU cache of hydrated pf.Character objects
+#
+# Entries are keyed by session id and tagged with the version counter that
+# was current in Redis when they were built or saved. The cached value is
+# whatever the caller stores alongside the character (e.g. a snapshot of
+# what's in Redis); the cache only looks at its version and size. A request checks an
+# entry out (removing it) and checks it back in when it's done, so two
+# concurrent requests in one worker never share a Character; the second one
+# simply misses and builds its own.
+
+from collections import OrderedDict
+from threading import Lock
+
+class CharacterCache:
+    def __init__(self, max_entries = 256, max_bytes = 64*1024*1024):
+        self.max_entries = max_entries
+        # sizes are the length of the character's stored JSON, which is a
+        # cheap stand-in for the real memory footprint
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "stale": 0,
+            "evictions": 0
+        }
+
+    # version of the entry for key, if any, without checking it out
+    def version(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else entry[0]
+
+    def checkout(self, key, version):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.size -= entry[2]
+            if entry[0] != version:
+                self.stats["stale"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def checkin(self, key, version, value, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (version, value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last = False)
+                self.size -= evicted[2]
+                self.stats["evictions"] += 1
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
@@ -0,0 +1,45 @@
+# JSON codec for responses, request bodies, query filters and Redis payloads
+#
+# Output is compact UTF-8 ('{"a":1}') and byte-for-byte the same whichever
+# backend is in use: orjson when it's installed, the standard library
+# otherwise. (NaN and infinity are the one exception, but orjson won't
+# parse them either, so they can't come in through a request.)
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def std_dumps(value):
+    return json.dumps(value, separators = (",", ":"), ensure_ascii = False)
+
+if orjson is not None:
+    BACKEND = "orjson"
+    # orjson spells some floats differently (1e16 vs 1e+16, 0.00001 vs
+    # 1e-05); output that might contain one is redone with json. Matches
+    # inside strings only cost the fallback.
+    EXPONENT = re.compile(rb"e(?<=\de)-?\d+(?:[,\]}]|$)")
+
+    def dumps(value):
+        try:
+            out = orjson.dumps(value)
+        except TypeError:
+            # non-str keys (slower option, so only when needed) or values
+            # orjson can't encode at all
+            try:
+                out = orjson.dumps(value, option = orjson.OPT_NON_STR_KEYS)
+            except TypeError:
+                return std_dumps(value)
+        if b"0.0000" in out or EXPONENT.search(out):
+            return std_dumps(value)
+        return out.decode()
+
+    def loads(s):
+        return orjson.loads(s)
+else:
+    BACKEND = "json"
+    dumps = std_dumps
+    loads = json.loads
@@ -0,0 +1,159 @@
+# Derived stats: the totals clients used to work out for themselves from
+# the abilities, saving throws, skills and attacks. They're kept in Redis
+# next to the character (see store.py), so reading them is one round trip
+# with nothing to build.
+#
+# Each stat depends on these inputs:
+#
+#   ability score and modifier  <- the ability's base and misc
+#   saving throw total          <- the save's base and misc, and the
+#                                  modifier of its ability (SAVE_ABILITIES)
+#   skill total                 <- the skill's rank, misc and is_class, and
+#                                  the modifier of its mod ability
+#   attack and damage bonuses   <- base_attack_bonus, and the modifiers of
+#                                  the attack's attack_mod and damage_mod
+#
+# so when a character is saved, changes() works out again only the stats
+# whose own item changed, or whose ability's modifier did. An ability
+# whose modifier comes out the same stops there.
+#
+# Stats are named "<section>:<item key>", the key being the item's uuid or,
+# for sections without them, its name.
+
+import formats
+from store import ORDER
+
+SECTIONS = ("abilities", "saving_throws", "skills", "attacks")
+INPUTS = SECTIONS + ("base_attack_bonus",)
+SAVE_ABILITIES = {"fortitude": "con", "reflex": "dex", "will": "wis"}
+CLASS_SKILL_BONUS = 3 # for class skills with at least one rank
+
+def number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+def total(misc):
+    return sum(number(value) for value in misc) if isinstance(misc, list) else 0
+
+def modifier(score):
+    return int((score - 10) // 2)
+
+def item_key(item):
+    return item.get("uuid") or item.get("name")
+
+# One section's items by key. Items of collections are compared as the
+# values stored in Redis and only decoded when needed; sections kept whole
+# are decoded at once.
+class Section:
+    def __init__(self, snapshot, name, default):
+        fields, collections = snapshot
+        self.decoded = {}
+        if collections.get(name):
+            self.raw = {key: raw for key, raw in collections[name].items() if key != ORDER}
+            return
+        items = formats.loads(fields[name]) if name in fields else default
+        self.decoded = {item_key(item): item for item in (items or []) if isinstance(item, dict)}
+        self.raw = self.decoded
+
+    def item(self, key):
+        if key not in self.decoded:
+            self.decoded[key] = formats.loads(self.raw[key])
+        return self.decoded[key]
+
+    # keys whose items differ from the ones in other
+    def changed(self, other):
+        return [key for key, raw in self.raw.items() if other.raw.get(key) != raw]
+
+class Inputs:
+    def __init__(self, snapshot, defaults):
+        snapshot = snapshot or ({}, {})
+        self.sections = {name: Section(snapshot, name, defaults.get(name)) for name in SECTIONS}
+        fields = snapshot[0]
+        bab = formats.loads(fields["base_attack_bonus"]) if "base_attack_bonus" in fields else defaults.get("base_attack_bonus")
+        self.base_attack_bonus = number(bab)
+        abilities = self.sections["abilities"]
+        self.modifiers = {}
+        for key in abilities.raw:
+            ability = abilities.item(key)
+            self.modifiers[ability.get("name")] = modifier(number(ability.get("base")) + total(ability.get("misc")))
+
+    def stat(self, section, key):
+        item = self.sections[section].item(key)
+        out = {"name": item.get("name")}
+        if item.get("uuid"):
+            out["uuid"] = item["uuid"]
+        if section == "abilities":
+            out["score"] = number(item.get("base")) + total(item.get("misc"))
+            out["modifier"] = modifier(out["score"])
+        elif section == "saving_throws":
+            ability = SAVE_ABILITIES.get(item.get("name"))
+            out["total"] = number(item.get("base")) + total(item.get("misc")) + self.modifiers.get(ability, 0)
+        elif section == "skills":
+            rank = number(item.get("rank"))
+            out["total"] = rank + total(item.get("misc")) + self.modifiers.get(item.get("mod"), 0)
+            if item.get("is_class") and rank > 0:
+                out["total"] += CLASS_SKILL_BONUS
+        elif section == "attacks":
+            out["attack_bonus"] = self.base_attack_bonus + self.modifiers.get(item.get("attack_mod"), 0)
+            out["damage_bonus"] = self.modifiers.get(item.get("damage_mod"), 0)
+        return out
+
+    # the abilities an item's stat reads the modifier of
+    def abilities(self, section, key):
+        item = self.sections[section].item(key)
+        if section == "saving_throws":
+            return {SAVE_ABILITIES.get(item.get("name"))}
+        if section == "skills":
+            return {item.get("mod")}
+        if section == "attacks":
+            return {item.get("attack_mod"), item.get("damage_mod")}
+        return set()
+
+class DerivedStats:
+    # defaults are the sections of a blank character, for the ones a
+    # snapshot doesn't have
+    def __init__(self, defaults):
+        self.defaults = defaults
+
+    def inputs(self, snapshot):
+        return Inputs(snapshot, self.defaults)
+
+    # Every stat of a character, by name
+    def compute(self, snapshot):
+        inputs = self.inputs(snapshot)
+        return {"{}:{}".format(name, key): inputs.stat(name, key) for name, section in inputs.sections.items() for key in section.raw}
+
+    # The stats that change between two snapshots of a character, and the
+    # names of those that no longer exist
+    def changes(self, old, new):
+        old, new = self.inputs(old), self.inputs(new)
+        moved = {name for name in set(old.modifiers) | set(new.modifiers) if old.modifiers.get(name) != new.modifiers.get(name)}
+        bab_changed = old.base_attack_bonus != new.base_attack_bonus
+        values = {}
+        removed = []
+        for name in SECTIONS:
+            section, old_section = new.sections[name], old.sections[name]
+            affected = set(section.changed(old_section))
+            if moved and name != "abilities":
+                affected.update(key for key in section.raw if new.abilities(name, key) & moved)
+            if bab_changed and name == "attacks":
+                affected.update(section.raw)
+            for key in affected:
+                values["{}:{}".format(name, key)] = new.stat(name, key)
+            removed.extend("{}:{}".format(name, key) for key in old_section.raw if key not in section.raw)
+        return values, removed
+
+    # Whether setting these top-level fields can change any stat
+    def depends_on(self, names):
+        return any(name in INPUTS for name in names)
+
+# Stats by name as the API returns them: each section's as a list, by item
+# name (and uuid, for items that have one, since names can repeat)
+def present(stats):
+    out = {name: [] for name in SECTIONS}
+    for name, stat in stats.items():
+        section, _, _ = name.partition(":")
+        if section in out:
+            out[section].append(stat)
+    for items in out.values():
+        items.sort(key = lambda stat: (str(stat.get("name")), stat.get("uuid", "")))
+    return out
@@ -0,0 +1,104 @@
+# Query filters for the collection GET endpoints
+#
+# Each collection's query parameters are listed in PARAMS with how they're
+# written: LIST is comma-separated (?name=a,b), RANGE is a JSON object
+# (?level={"lt": 4}) and BOOL is "true" or anything else. A query's filter
+# parameters are parsed and compiled once into a Filter, which is cached by
+# them; the rest of the query (sorting, paging) doesn't make a new one.
+#
+# The shapes clients send most, lists of uuids, exact name lists and
+# numeric lt/gt ranges, are tested here in a single pass over the section.
+# Anything else is left to pythfinder's own get_* filtering, as before.
+
+import codec
+from functools import lru_cache
+
+LIST = "list"
+RANGE = "range"
+BOOL = "bool"
+
+PARAMS = {
+    "equipment": {"name": LIST, "uuid": LIST, "weight": RANGE, "count": RANGE, "camp": LIST, "on_person": LIST, "location": LIST, "notes": LIST},
+    "abilities": {"name": LIST, "base": RANGE, "modifier": RANGE, "misc": RANGE},
+    "saving_throws": {"name": LIST, "base": RANGE, "misc": RANGE},
+    "classes": {"name": LIST, "archetypes": LIST, "level": RANGE},
+    "feats": {"name": LIST, "uuid": LIST, "description": LIST, "notes": LIST},
+    "traits": {"name": LIST, "uuid": LIST, "description": LIST, "notes": LIST},
+    "special": {"name": LIST, "uuid": LIST, "description": LIST, "notes": LIST},
+    "skills": {"name": LIST, "uuid": LIST, "rank": RANGE, "is_class": BOOL, "mod": LIST, "notes": LIST, "use_untrained": BOOL, "misc": RANGE},
+    "spells": {"name": LIST, "uuid": LIST, "level": RANGE, "description": LIST, "prepared": RANGE, "cast": RANGE},
+    "armor": {"name": LIST, "uuid": LIST, "acBonus": RANGE, "acPenalty": RANGE, "maxDexBonus": RANGE, "arcaneFailureChance": RANGE, "type": LIST},
+    "attacks": {"name": LIST, "uuid": LIST, "attack_type": LIST, "damage_type": LIST, "attack_mod": LIST, "damage_mod": LIST, "damage": LIST, "crit_roll": RANGE, "crit_multi": RANGE, "range": RANGE, "notes": LIST}
+}
+CACHE_SIZE = 1024
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def range_test(bounds):
+    lt = bounds.get("lt")
+    gt = bounds.get("gt")
+    if lt is not None and gt is not None:
+        return lambda value: gt < value < lt
+    if lt is not None:
+        return lambda value: value < lt
+    return lambda value: value > gt
+
+class Filter:
+    # data is the get_* filter dict the endpoints used to build by hand
+    def __init__(self, data):
+        self.data = data
+        self.tests = []
+        self.rest = dict(data)
+        for key, value in data.items():
+            if key == "uuid" and value:
+                self.tests.append((key, set(value).__contains__))
+            elif key == "name" and value and data.get("name_search_type") == "absolute":
+                self.tests.append((key, set(value).__contains__))
+            elif isinstance(value, dict) and value and set(value) <= {"lt", "gt"} and all(map(is_number, value.values())):
+                self.tests.append((key, range_test(value)))
+            else:
+                continue
+            self.rest[key] = type(value)()
+        # pythfinder is only asked if something is left for it to test
+        if not any(value not in ([], {}, "") for key, value in self.rest.items() if key != "name_search_type"):
+            self.rest = None
+
+    # Items of the section that pass; get is the section's get_* method
+    def apply(self, items, get):
+        candidates = items if self.rest is None else get(data = self.rest)
+        if isinstance(candidates, dict):
+            candidates = candidates.values()
+        if not self.tests:
+            return list(candidates)
+        try:
+            if len(self.tests) == 1:
+                (key, test), = self.tests
+                return [item for item in candidates if test(getattr(item, key))]
+            return [item for item in candidates if all(test(getattr(item, key)) for key, test in self.tests)]
+        except (AttributeError, TypeError):
+            # not a shape this can compare; let pythfinder decide
+            return get(data = self.data)
+
+def parse(section, args):
+    data = {}
+    for param, kind in PARAMS[section].items():
+        value = args.get(param)
+        if kind == LIST:
+            data[param] = value.split(",") if value else []
+        elif kind == RANGE:
+            data[param] = codec.loads(value.replace("'", '"')) if value else {}
+        else:
+            data[param] = [] if value is None else value == "true"
+        if param == "name":
+            data["name_search_type"] = args.get("name_search_type") or ""
+    return data
+
+@lru_cache(maxsize = CACHE_SIZE)
+def compile_params(section, params):
+    return Filter(parse(section, dict(params)))
+
+# The Filter for a request's query args; raises ValueError for a range that
+# isn't valid JSON
+def compile(section, args):
+    return compile_params(section, tuple((param, args[param]) for param in (*PARAMS[section], "name_search_type") if param in args))
@@ -0,0 +1,88 @@
+# Encodings for values stored in Redis
+#
+# Binary values start with a format byte:
+#
+#   0x01  MessagePack
+#   0x02  zstd frame holding MessagePack; the frame names the dictionary it
+#         was compressed with, if any
+#
+# Anything else is JSON text, which is also what's written when msgpack
+# isn't installed. Every format can always be read back, so the format can
+# be changed without touching what's already stored.
+
+import codec
+from threading import local
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK = b"\x01"
+ZSTD = b"\x02"
+
+# zstd dictionaries by id, for reading values compressed with them; after
+# switching dictionaries, keep loading the old one until the values it
+# compressed have expired
+dictionaries = {}
+# zstandard (de)compressors aren't safe to share between threads
+threads = local()
+
+def load_dictionary(path):
+    with open(path, "rb") as f:
+        dictionary = zstandard.ZstdCompressionDict(f.read())
+    dictionaries[dictionary.dict_id()] = dictionary
+    return dictionary
+
+def decompressor(dict_id):
+    decompressors = threads.__dict__.setdefault("decompressors", {})
+    if dict_id not in decompressors:
+        if dict_id and dict_id not in dictionaries:
+            raise ValueError("value was compressed with unknown zstd dictionary {}".format(dict_id))
+        decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data = dictionaries.get(dict_id))
+    return decompressors[dict_id]
+
+def loads(raw):
+    if raw[:1] == MSGPACK:
+        return msgpack.unpackb(raw[1:], strict_map_key = False)
+    if raw[:1] == ZSTD:
+        dict_id = zstandard.get_frame_parameters(raw[1:]).dict_id
+        return msgpack.unpackb(decompressor(dict_id).decompress(raw[1:]), strict_map_key = False)
+    return codec.loads(raw)
+
+# A stored value as JSON bytes; values stored as JSON are passed through
+def json_bytes(raw):
+    if raw[:1] in (MSGPACK, ZSTD):
+        return codec.dumps(loads(raw)).encode()
+    return raw
+
+class ValueFormat:
+    # binary and level fall back to JSON / no compression when msgpack or
+    # zstandard aren't installed; values shorter than min_size aren't worth
+    # compressing
+    def __init__(self, binary = True, level = 3, dictionary = None, min_size = 64):
+        self.binary = binary and msgpack is not None
+        self.level = level if self.binary and zstandard is not None else 0
+        self.dictionary = load_dictionary(dictionary) if dictionary and self.level else None
+        self.min_size = min_size
+
+    def compressor(self):
+        if getattr(threads, "compressor", None) is None or threads.compressor_format is not self:
+            threads.compressor = zstandard.ZstdCompressor(level = self.level, dict_data = self.dictionary)
+            threads.compressor_format = self
+        return threads.compressor
+
+    def dumps(self, value):
+        if not self.binary:
+            return codec.dumps(value).encode()
+        packed = msgpack.packb(value)
+        if self.level and len(packed) >= self.min_size:
+            compressed = self.compressor().compress(packed)
+            if len(compressed) < len(packed):
+                return ZSTD + compressed
+        return MSGPACK + packed
@@ -0,0 +1,58 @@
+# gunicorn settings for production: sh run.sh prod, or from src/
+#
+#   gunicorn -c gunicorn.conf.py "wsgi:create_app()"
+#
+# Configured from the environment:
+#
+#   PORT                port to listen on (default 5000)
+#   WEB_CONCURRENCY     worker processes (default 2 per CPU, plus 1)
+#   PYTHFINDER_THREADS  threads per worker (default 4; each can hold one
+#                       of the worker's REDIS_MAX_CONNECTIONS connections)
+#
+# The app is preloaded in the master and forked, so its memory is shared
+# copy-on-write. kill -HUP the master to restart the workers gracefully:
+# new ones are started while the old ones finish their requests, for up to
+# graceful_timeout seconds.
+
+import gc
+import multiprocessing
+import os
+from time import time
+
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", "5000"))
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("PYTHFINDER_THREADS", 4))
+worker_class = "gthread"
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+# workers are replaced after this many requests, staggered by the jitter
+max_requests = 10000
+max_requests_jitter = 1000
+
+started = time()
+
+# RSS and PSS (RSS with shared pages split between the processes sharing
+# them) of this process, in KB
+def memory():
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            sizes = dict(line.split()[:2] for line in f if line.split()[0] in ("Rss:", "Pss:"))
+        return "rss {} KB, pss {} KB".format(sizes["Rss:"], sizes["Pss:"])
+    except OSError:
+        import resource
+        return "max rss {} KB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def when_ready(server):
+    # what's been allocated by now is never collected, so the collector
+    # doesn't touch (and so copy) those pages in the workers
+    gc.freeze()
+    server.log.info("app preloaded in %.0f ms; %s", (time() - started) * 1000, memory())
+
+def post_fork(server, worker):
+    worker.forked = time()
+
+def post_worker_init(worker):
+    import wsgi
+    wsgi.warm(worker.wsgi, worker.cfg.threads)
+    worker.log.info("worker %s ready in %.0f ms; %s", worker.pid, (time() - worker.forked) * 1000, memory())
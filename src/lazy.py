@@ -0,0 +1,160 @@
+# Lazily hydrated characters
+#
+# A LazyCharacter keeps the stored snapshot of a character and only turns a
+# section of it into pythfinder objects the first time something asks for
+# that section. Everything else stays as the strings read from Redis.
+#
+# This relies on each top-level key of Character.get_json() being the
+# Character attribute of the same name, so a section built in one Character
+# can be moved into another.
+
+import codec
+import pythfinder as pf
+from copy import copy
+from store import decode_section, MISSING
+
+BLANK_CHARACTER = pf.Character()
+BLANK_DOC = codec.loads(BLANK_CHARACTER.get_json())
+
+# section used by each get_*/add_*/delete_*/update_* method, by the name
+# that follows the prefix
+METHOD_SECTIONS = {
+    "equipment": "equipment",
+    "class": "classes",
+    "classes": "classes",
+    "feat": "feats",
+    "feats": "feats",
+    "trait": "traits",
+    "traits": "traits",
+    "special": "special",
+    "specials": "special",
+    "skill": "skills",
+    "skills": "skills",
+    "spell": "spells",
+    "spells": "spells",
+    "armor": "armor",
+    "attack": "attacks",
+    "attacks": "attacks",
+    "ability": "abilities",
+    "abilities": "abilities",
+    "saving_throw": "saving_throws",
+    "saving_throws": "saving_throws"
+}
+METHOD_PREFIXES = ("get_", "add_", "delete_", "update_")
+
+# sections whose objects may read other sections, so they're built together
+DEPENDS = {
+    "skills": ("abilities",),
+    "saving_throws": ("abilities",),
+    "attacks": ("abilities", "base_attack_bonus")
+}
+
+# The section a Character attribute belongs to, or None if it isn't one
+def section_for(name):
+    section = name if name in BLANK_DOC else None
+    if section is None and name.startswith(METHOD_PREFIXES):
+        section = METHOD_SECTIONS.get(name.split("_", 1)[1])
+    return section if section in BLANK_DOC else None
+
+# Sections the given ones are built from, other than themselves
+def dependencies(sections):
+    return {d for name in sections for d in DEPENDS.get(name, ()) if d in BLANK_DOC} - set(sections)
+
+# Sections needed for a Character attribute; None means all of them
+def sections_for(name):
+    section = section_for(name)
+    if section is None:
+        return None
+    return {section} | dependencies({section})
+
+class LazyCharacter:
+    # snapshot is what's stored in Redis (see store.encode), or None for a
+    # character that hasn't been saved; a character passed in is taken as
+    # already fully hydrated
+    def __init__(self, snapshot, character = None):
+        self.snapshot = snapshot
+        self.character = character
+        self.hydrated = None if character is not None else set()
+        # (section, key) -> (list indexed, {key value: item}); see find()
+        self.indexes = {}
+
+    def sections(self):
+        fields, collections = self.snapshot or ({}, {})
+        return set(BLANK_DOC) | set(fields) | set(collections)
+
+    def hydrate(self, sections = None):
+        if self.hydrated is None:
+            return self.character
+        known = self.sections()
+        missing = (known if sections is None else sections & known) - self.hydrated
+        if missing or self.character is None:
+            data = {}
+            for name in missing:
+                value = decode_section(self.snapshot or ({}, {}), name)
+                if value is not MISSING:
+                    data[name] = value
+            # sections hydrated earlier may have changed since they were
+            # stored, so the ones built from them see their current values
+            current = dependencies(missing) & self.hydrated
+            if current and self.character is not None:
+                data.update(self.document(current))
+            built = pf.Character(data = {**BLANK_DOC, **data})
+            if self.character is None:
+                self.character = built
+            else:
+                for name in missing:
+                    setattr(self.character, name, getattr(built, name))
+            self.hydrated |= missing
+        if sections is None or self.hydrated >= known:
+            self.hydrated = None
+        return self.character
+
+    # Items of a hydrated section whose key (uuid, name) has the given
+    # value, as a list like the get_* methods return. The index is built on
+    # first use and rebuilt if the section's list is replaced, or on any
+    # miss, since items can be renamed in place by their own update();
+    # changed() keeps it current otherwise.
+    def find(self, section, key, value):
+        items = getattr(self.character, section)
+        entry = self.indexes.get((section, key))
+        if entry is None or entry[0] is not items or value not in entry[1]:
+            entry = self.indexes[(section, key)] = (items, self.build_index(items, key))
+        item = entry[1].get(value)
+        if item is not None and getattr(item, key, None) != value:
+            # renamed since it was indexed
+            entry = self.indexes[(section, key)] = (items, self.build_index(items, key))
+            item = entry[1].get(value)
+        return [] if item is None else [item]
+
+    def build_index(self, items, key):
+        index = {}
+        for item in (items.values() if isinstance(items, dict) else items):
+            index.setdefault(getattr(item, key, None), item)
+        return index
+
+    # Updates the indexes after an add_*/delete_*/update_* call; anything
+    # that can't be followed just drops the index
+    def changed(self, method, args, result):
+        section = METHOD_SECTIONS.get(method.split("_", 1)[1])
+        for (name, key), (items, index) in list(self.indexes.items()):
+            if name != section:
+                continue
+            if method.startswith("add_") and hasattr(result, key):
+                index.setdefault(getattr(result, key), result)
+            elif method.startswith("delete_") and args and index.get(getattr(args[0], key, None)) is args[0]:
+                del index[getattr(args[0], key)]
+            else:
+                del self.indexes[(name, key)]
+
+    # Serializes the given sections (all of them if None). Sections are
+    # moved onto a copy of the blank character first so pythfinder only
+    # serializes what was asked for.
+    def document(self, sections = None):
+        if sections is None:
+            return codec.loads(self.hydrate().get_json())
+        character = self.hydrate(sections)
+        scratch = copy(BLANK_CHARACTER)
+        for name in sections:
+            setattr(scratch, name, getattr(character, name))
+        doc = codec.loads(scratch.get_json())
+        return {name: doc[name] for name in sections if name in doc}
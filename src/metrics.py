@@ -0,0 +1,52 @@
+# Redis round trips per request
+#
+# Connections of a class from counting() count every command or pipeline
+# they send, for the thread or asyncio task sending it. The app resets the count when a request starts and adds it to
+# the totals when it ends.
+
+from contextvars import ContextVar
+from functools import lru_cache
+from threading import Lock
+
+# a context variable rather than a thread local, so requests sharing the
+# async server's thread keep their own counts
+counts = ContextVar("round_trips", default = 0)
+lock = Lock()
+totals = {"requests": 0, "round_trips": 0, "max": 0}
+# round trips -> number of requests that made that many
+histogram = {}
+
+class RoundTripCounter:
+    # for async connections this returns the coroutine the caller awaits
+    def send_packed_command(self, command, check_health = True):
+        counts.set(counts.get() + 1)
+        return super().send_packed_command(command, check_health)
+
+# The given redis connection class (sync or asyncio), counting round trips;
+# taking the class means redis is only imported by whoever makes a pool
+@lru_cache(maxsize = None)
+def counting(connection_class):
+    return type("Counting" + connection_class.__name__, (RoundTripCounter, connection_class), {})
+
+def start():
+    counts.set(0)
+
+# Records the current request's round trips and returns them
+def finish():
+    n = counts.get()
+    counts.set(0)
+    with lock:
+        totals["requests"] += 1
+        totals["round_trips"] += n
+        totals["max"] = max(totals["max"], n)
+        histogram[n] = histogram.get(n, 0) + 1
+    return n
+
+def report():
+    with lock:
+        requests = totals["requests"]
+        return {
+            **totals,
+            "mean": totals["round_trips"] / requests if requests else 0,
+            "histogram": {str(n): histogram[n] for n in sorted(histogram)}
+        }
@@ -0,0 +1,89 @@
+# Sorting, paging and field projection for the collection GET endpoints
+#
+#   ?sort=level,-name   sort by level, then by name descending
+#   ?limit=20           at most 20 items, and a cursor for the next page
+#   ?cursor=...         the page after the one that returned this cursor
+#   ?fields=name,level  only these attributes of each item
+#
+# A cursor records the last item of its page and that item's position.
+# The next page starts after the item wherever it has moved to, or in its
+# old place if it has been deleted since.
+
+import base64
+import codec
+
+MAX_LIMIT = 1000
+MISSING = object()
+
+def identity(item):
+    return getattr(item, "uuid", None) or getattr(item, "name", None)
+
+def encode_cursor(position, item):
+    return base64.urlsafe_b64encode(codec.dumps([position, identity(item)]).encode()).decode()
+
+# The named attributes of item, read straight off it so the rest of it
+# isn't serialized; ones it only has in to_dict's output (worked out by
+# get_dict) come from there
+def project(item, fields, to_dict):
+    out = {}
+    full = None
+    for name in fields:
+        value = getattr(item, name, MISSING)
+        if value is MISSING or callable(value):
+            if full is None:
+                full = to_dict(item)
+            if name not in full:
+                continue
+            value = full[name]
+        out[name] = value
+    return out
+
+def decode_cursor(cursor):
+    position, key = codec.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(position, int) or position < 0:
+        raise ValueError("invalid cursor")
+    return position, key
+
+class Listing:
+    # Raises ValueError for malformed parameters
+    def __init__(self, args):
+        sort = args.get("sort", "").split(",")
+        self.sort = [(name.lstrip("-"), name.startswith("-")) for name in sort if name.lstrip("-")]
+        self.fields = [name for name in args["fields"].split(",") if name] if args.get("fields") else None
+        self.limit = int(args["limit"]) if args.get("limit") else None
+        if self.limit is not None and not 0 < self.limit <= MAX_LIMIT:
+            raise ValueError("limit must be between 1 and {}".format(MAX_LIMIT))
+        try:
+            self.cursor = decode_cursor(args["cursor"]) if args.get("cursor") else None
+        except (TypeError, ValueError):
+            raise ValueError("invalid cursor")
+
+    # Returns the page of items as dicts, and the page metadata (None
+    # unless limit or cursor were given)
+    def apply(self, items, to_dict):
+        items = list(items)
+        for name, descending in reversed(self.sort):
+            try:
+                items.sort(key = lambda item: getattr(item, name), reverse = descending)
+            except (AttributeError, TypeError):
+                raise ValueError("can't sort by '{}'".format(name))
+        page = None
+        if self.limit is not None or self.cursor is not None:
+            start = 0
+            if self.cursor is not None:
+                start, key = self.cursor
+                for i, item in enumerate(items):
+                    if identity(item) == key:
+                        start = i + 1
+                        break
+            total = len(items)
+            end = total if self.limit is None else start + self.limit
+            items = items[start:end]
+            page = {
+                "limit": self.limit,
+                "total": total,
+                "next": encode_cursor(end - 1, items[-1]) if items and end < total else None
+            }
+        if self.fields is not None:
+            return [project(item, self.fields, to_dict) for item in items], page
+        return [to_dict(item) for item in items], page
@@ -0,0 +1,158 @@
+# JSON Patch (RFC 6902) for PATCH /character: checking a patch's shape,
+# the top-level sections it reaches, and applying it to a character's
+# document (or the part of it holding those sections).
+#
+# Paths are JSON pointers (RFC 6901). A failed "test" raises PatchConflict;
+# anything else wrong with a patch, or a path it can't follow, raises
+# ValueError. Either way the document may be half patched, so callers
+# apply patches to a copy.
+
+from copy import deepcopy
+
+OPS = {
+    "add": ("path", "value"),
+    "remove": ("path",),
+    "replace": ("path", "value"),
+    "move": ("from", "path"),
+    "copy": ("from", "path"),
+    "test": ("path", "value")
+}
+
+class PatchConflict(ValueError):
+    pass
+
+def parse_pointer(pointer):
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith("/")):
+        raise ValueError("invalid path '{}'".format(pointer))
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer.split("/")[1:]]
+
+# Raises ValueError listing every malformed operation
+def check(ops):
+    if not isinstance(ops, list):
+        raise ValueError("must be a list of operations")
+    if not ops:
+        raise ValueError("nothing to change")
+    errors = []
+    for i, op in enumerate(ops):
+        if not isinstance(op, dict) or op.get("op") not in OPS:
+            errors.append("operation {}: op must be one of {}".format(i, ", ".join(OPS)))
+            continue
+        for member in OPS[op["op"]]:
+            if member not in op:
+                errors.append("operation {}: missing '{}'".format(i, member))
+            elif member != "value":
+                try:
+                    parse_pointer(op[member])
+                except ValueError as err:
+                    errors.append("operation {}: {}".format(i, err))
+    if errors:
+        raise ValueError("; ".join(errors))
+    return ops
+
+# Top-level names the patch reads or writes, or None if it works on the
+# whole document
+def sections(ops):
+    out = set()
+    for op in ops:
+        for member in ("from", "path"):
+            if member in op:
+                tokens = parse_pointer(op[member])
+                if not tokens:
+                    return None
+                out.add(tokens[0])
+    return out
+
+def index(container, token, pointer, end = False):
+    if end and token == "-":
+        return len(container)
+    if not token.isdigit() or (token != "0" and token.startswith("0")):
+        raise ValueError("invalid index in '{}'".format(pointer))
+    i = int(token)
+    if i > len(container) or (i == len(container) and not end):
+        raise ValueError("index out of range in '{}'".format(pointer))
+    return i
+
+# The container holding pointer's target, and the target's key in it
+def resolve(doc, pointer):
+    tokens = parse_pointer(pointer)
+    parent = doc
+    for token in tokens[:-1]:
+        if isinstance(parent, list):
+            parent = parent[index(parent, token, pointer)]
+        elif isinstance(parent, dict) and token in parent:
+            parent = parent[token]
+        else:
+            raise ValueError("path '{}' not found".format(pointer))
+    if not isinstance(parent, (list, dict)):
+        raise ValueError("path '{}' not found".format(pointer))
+    return parent, tokens[-1]
+
+def get(doc, pointer):
+    if not pointer:
+        return doc
+    parent, key = resolve(doc, pointer)
+    if isinstance(parent, list):
+        return parent[index(parent, key, pointer)]
+    if key not in parent:
+        raise ValueError("path '{}' not found".format(pointer))
+    return parent[key]
+
+# JSON's idea of equal: true isn't 1
+def equal(a, b):
+    if isinstance(a, bool) or isinstance(b, bool):
+        return type(a) is type(b) and a == b
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(equal(a[k], b[k]) for k in a)
+    return a == b
+
+# Applies ops to doc in place; returns the patched document (a new one if
+# the patch replaced it at the root)
+def apply(doc, ops):
+    for op in ops:
+        name, path = op["op"], op["path"]
+        if name == "test":
+            if not equal(get(doc, path), op["value"]):
+                raise PatchConflict("test failed at '{}'".format(path))
+            continue
+        if name in ("move", "copy"):
+            if name == "move" and path != op["from"] and path.startswith(op["from"] + "/"):
+                raise ValueError("can't move '{}' into itself".format(op["from"]))
+            value = get(doc, op["from"])
+            if name == "move":
+                doc = remove(doc, op["from"])
+            else:
+                value = deepcopy(value)
+            doc = add(doc, path, value)
+        elif name == "remove":
+            doc = remove(doc, path)
+        elif name == "replace":
+            get(doc, path)
+            doc = remove(doc, path)
+            doc = add(doc, path, op["value"])
+        else:
+            doc = add(doc, path, op["value"])
+    return doc
+
+def add(doc, pointer, value):
+    if not pointer:
+        return value
+    parent, key = resolve(doc, pointer)
+    if isinstance(parent, list):
+        parent.insert(index(parent, key, pointer, end = True), value)
+    else:
+        parent[key] = value
+    return doc
+
+def remove(doc, pointer):
+    if not pointer:
+        return None
+    parent, key = resolve(doc, pointer)
+    if isinstance(parent, list):
+        del parent[index(parent, key, pointer)]
+    elif key in parent:
+        del parent[key]
+    else:
+        raise ValueError("path '{}' not found".format(pointer))
+    return doc
@@ -1,607 +1,561 @@
 #!/bin/python3
 
 import pythfinder as pf
-import json
-from flask import Flask, abort, request, Blueprint, session, g
+import codec
+import derived
+import filters
+import pages
+import patches
+import schemas
+from properties import PROPERTIES, validate, validate_all
+from flask import Flask, Response, abort, request, Blueprint, session, g, current_app
+from flask.json.provider import JSONProvider
+from flask.ctx import RequestContext
 from uuid import uuid4 as uuid
-from redis import Redis
-from flask_cors import CORS
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, Conflict, BadRequest, PreconditionFailed
+from werkzeug.local import LocalProxy
+from werkzeug.test import EnvironBuilder
+from threading import Lock
+from time import time, sleep
+from random import random
+from tracking import TrackedCharacter
+from cache import CharacterCache
+from store import CharacterStore, merge, snapshot_size, iter_json, UNCHANGED
+from formats import ValueFormat
+from lazy import LazyCharacter, BLANK_DOC, dependencies
+import metrics
 
-TIMEOUT = 14*24*60*60 # timeout in seconds; == 14 days
-HTTP_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE', 'PATCH']
-HEADER = {
-    "Content-Type": "application/json",
-    "Access-Control-Allow-Credentials": "true",
-    "Access-Control-Allow-Origin": "http://localhost:8000",
-    "Access-Control-Allow-Methods": "*"
+# Settings that differ between deployments. Each can be set in the
+# environment as PYTHFINDER_<name> (e.g. PYTHFINDER_REDIS_URL), or passed
+# to create_app().
+DEFAULT_CONFIG = {
+    "REDIS_URL": "redis://localhost:6379/0",
+    "REDIS_MAX_CONNECTIONS": 32, # per worker process, shared by its threads
+    "REDIS_POOL_TIMEOUT": 5, # seconds a request waits for a free connection before failing
+    "CHARACTER_TTL": 14*24*60*60, # seconds a character is kept after it was last used; == 14 days
+    "CORS_ORIGIN": "http://localhost:8000", # origin allowed to call the API from a browser ("" for none)
+    # secret development key (set PYTHFINDER_SECRET_KEY for deployment)
+    "SECRET_KEY": "this is the development server key for testing, please don't use this in production!"
+}
+TOUCH_INTERVAL = 24*60*60 # minimum seconds between TTL refreshes for unchanged characters
+CACHE_MAX_ENTRIES = 256 # hydrated characters kept per worker process
+CACHE_MAX_BYTES = 64*1024*1024 # measured as the size of each character's JSON
+SAVE_ATTEMPTS = 12 # times a request is run against fresh state before giving up with 409
+SAVE_BACKOFF = 0.005 # seconds; the jittered wait before a retry is up to this, doubled for each attempt so far
+SAVE_BACKOFF_MAX = 0.25 # seconds the wait before a retry can grow to
+STORAGE_BINARY = True # store values as MessagePack (needs msgpack; JSON otherwise)
+STORAGE_ZSTD_LEVEL = 3 # zstd level for binary values, 0 for none (needs zstandard)
+STORAGE_ZSTD_DICTIONARY = None # path to a dictionary from scripts/session_memory.py --train-dict
+STREAM_CHARACTER = True # send GET /character straight from the stored values, without building it
+SUMMARY_FIELDS = ("name", "race", "alignment", "hp", "classes") # character fields listed by GET /characters
+CHANGES_RETRY = 5000 # ms before a change feed client reconnects, when the server can't hold the stream open
+# The item each endpoint's POST or PATCH body is checked against (see
+# schemas.py); PUT /character and POST /characters check a whole
+# character, and PATCH /character a JSON patch
+PAYLOADS = {
+    "character": "character",
+    "account_characters": "character",
+    "character_equipment": "equipment",
+    "character_equipment_specific": "equipment",
+    "character_abilities_specific": "abilities",
+    "character_saving_throws_specific": "saving_throws",
+    "character_classes": "classes",
+    "character_classes_specific": "classes",
+    "character_feats": "feats",
+    "character_feats_specific": "feats",
+    "character_traits": "traits",
+    "character_traits_specific": "traits",
+    "character_specials": "special",
+    "character_specials_specific": "special",
+    "character_skills": "skills",
+    "character_skills_specific": "skills",
+    "character_spells": "spells",
+    "character_spells_specific": "spells",
+    "character_armor": "armor",
+    "character_armor_specific": "armor",
+    "character_attacks": "attacks",
+    "character_attacks_specific": "attacks"
 }
+HTTP_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE', 'PATCH']
+
+# What an app from create_app() keeps between requests. Redis is imported
+# and its client made the first time the store is needed; the pool opens
+# connections as requests use them.
+class AppState:
+    def __init__(self, config):
+        self.config = config
+        self.characters = CharacterCache(max_entries = CACHE_MAX_ENTRIES, max_bytes = CACHE_MAX_BYTES)
+        self.header = {"Content-Type": "application/json"}
+        if config["CORS_ORIGIN"]:
+            self.header.update({
+                "Access-Control-Allow-Credentials": "true",
+                "Access-Control-Allow-Origin": config["CORS_ORIGIN"],
+                "Access-Control-Allow-Methods": "*",
+                "Access-Control-Expose-Headers": "ETag, X-Redis-Round-Trips"
+            })
+        self.lock = Lock()
+        self.pool = self.r = self.store = None
+
+    def connect(self):
+        if self.store is None:
+            with self.lock:
+                if self.store is None:
+                    from redis import Redis, BlockingConnectionPool, Connection
+                    # the pool counts round trips for metrics; one set
+                    # beforehand (bench/load.py's fakeredis one) is used as is
+                    if self.pool is None:
+                        self.pool = BlockingConnectionPool.from_url(
+                            self.config["REDIS_URL"],
+                            max_connections = self.config["REDIS_MAX_CONNECTIONS"],
+                            timeout = self.config["REDIS_POOL_TIMEOUT"],
+                            connection_class = metrics.counting(Connection)
+                        )
+                    self.r = Redis(connection_pool = self.pool)
+                    self.store = CharacterStore(self.r, ttl = self.config["CHARACTER_TTL"], format = ValueFormat(
+                        binary = STORAGE_BINARY,
+                        level = STORAGE_ZSTD_LEVEL,
+                        dictionary = STORAGE_ZSTD_DICTIONARY
+                    ), derived = derived_stats)
+        return self.store
 
-# initialize redis connector
-r = Redis(host = "localhost", port = 6379, db = 0, decode_responses = True)
+derived_stats = derived.DerivedStats(BLANK_DOC)
+BLANK_STATS = derived_stats.compute(None)
+
+# the current app's state, used like module globals by the handlers
+state = LocalProxy(lambda: current_app.extensions["pythfinder"])
+store = LocalProxy(lambda: state.connect())
+characters = LocalProxy(lambda: state.characters)
+HEADER = LocalProxy(lambda: state.header)
 
 bp = Blueprint('pythfinder-flask', __name__, url_prefix = "/api/v0")
-CORS(bp, supports_credentials = True)
-app = Flask(__name__)
+# endpoints about the session's characters rather than the active one
+accounts = Blueprint('pythfinder-flask-accounts', __name__, url_prefix = "/api/v0")
+
+# request bodies go through the same codec as everything else
+class CodecJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return codec.dumps(obj)
 
-# secret development key (set this locally in config for deployment)
-app.secret_key = b"this is the development server key for testing, please don't use this in production!"
+    def loads(self, s, **kwargs):
+        return codec.loads(s)
 
-def return_json(status = 200, message = "", data = {}):
-    return {
+def return_json(status = 200, message = "", data = {}, page = None):
+    out = {
         "status": status,
         "message": message,
         "data": data
     }
+    if page is not None:
+        out["page"] = page
+    return out
+
+BLANK_JSON = codec.dumps(return_json(data = BLANK_DOC))
+BLANK_SUMMARY = {name: BLANK_DOC.get(name) for name in SUMMARY_FIELDS}
 
-@app.errorhandler(HTTPException)
 def handle_exception(e):
     response = e.get_response()
-    response.data = json.dumps(return_json(status = e.code, message = str(e)))
-    response.headers = HEADER
+    response.data = codec.dumps(return_json(status = e.code, message = str(e)))
+    response.headers.update(HEADER)
     return response
 
-@app.before_request
-def setup_request_context():
-    session_keys = session.keys()
-    # Fresh session; generate new id
-    if "id" not in session_keys:
-        session["id"] = str(uuid())
-    if not r.exists(session["id"]):
-        blank_character = pf.Character()
-        raw_json = blank_character.get_json()
-        r.set(session["id"], raw_json)
-    c_data = json.loads(r.get(session["id"]))
-    g.c = pf.Character(data = c_data)
-
-@app.after_request
-def cache_character(response):
-    c_data = g.c.get_json()
-    r.set(session["id"], c_data)
-    r.expire(session["id"], TIMEOUT)
-    return response
+# One round trip: the cached character is used if Redis still has its
+# version, and the character is read in full otherwise. Under the async
+# server (asgi.py) that's been done before the request started.
+def load_character():
+    # a conditional request has already read the version
+    g.version = g.pop("read_version", None)
+    if "id" not in session:
+        # a session that has never written has nothing stored
+        g.version, cached = 0, LazyCharacter(None)
+    elif g.get("prefetched") is not None:
+        g.version, cached = g.prefetched
+        g.prefetched = None
+    else:
+        snapshot = UNCHANGED
+        if g.version is None:
+            g.version, snapshot = store.load(session["id"], unless_version = characters.version(session["id"]))
+        cached = characters.checkout(session["id"], g.version)
+        if not cached:
+            if snapshot is UNCHANGED:
+                g.version, snapshot = store.load(session["id"])
+            cached = LazyCharacter(snapshot)
+    if g.get("if_match") is not None and g.version != g.if_match:
+        abort(412, description = "character has changed since it was last fetched")
+    return cached
 
-@app.route("/favicon.ico")
-def favicon():
-    return "", 204, HEADER
-
-@app.route("/")
-def index():
-    abort(404, description = "browse to /api/v0/character to view character json")
+# Serializes the sections this request used and writes the ones that differ
+# from what was loaded; a character that was never saved (or was replaced
+# outright) is written in full
+def save_character():
+    if "id" not in session:
+        start_session()
+    lazy = g.c.character
+    sections = None if lazy.snapshot is None else g.c.touched
+    snapshot = store.encode(lazy.document(sections))
+    version = store.write(session["id"], g.version, snapshot, lazy.snapshot, sections, owner = session["user"])
+    if version < 0:
+        return False
+    g.version = version
+    lazy.snapshot = merge(lazy.snapshot, snapshot, sections)
+    return True
 
-@bp.route("/character", methods = ["GET", "PUT"])
-def character():
-    if request.method == "GET":
-        data = json.loads(g.c.get_json())
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        new_c = request.get_json()
-        if new_c:
-            new_c_character = pf.Character(data = new_c)
-            new_c_json = new_c_character.get_json()
-            r.set(session["id"], new_c_json)
-            g.c = pf.Character(data = json.loads(r.get(session["id"])))
-            return "", 204, HEADER
-        else:
-            abort(400, description = "invalid character data or content type")
-    return json.dumps(out), out["status"], HEADER
+# The simple property endpoints read and write their fields in Redis
+# without loading the character. Inside a batch they go through g.c
+# instead, so they see earlier operations and are saved (or not) with them;
+# so they do under the async server, which has loaded it already.
+def get_field(name):
+    if g.get("batch") or g.get("deferred"):
+        return getattr(g.c, name)
+    if "id" not in session:
+        g.version = 0
+        return BLANK_DOC.get(name)
+    g.version, value = store.get_field(session["id"], name, BLANK_DOC.get(name))
+    return value
 
-@bp.route("/character/name", methods = ["GET", "PUT"])
-def character_name():
-    if request.method == "GET":
-        data = {
-            "name": g.c.name
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        name = request.get_json()
-        keys = name.keys()
-        if name and "name" in keys:
-            data = name
-            g.c.name = name["name"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'name' key")
-    return json.dumps(out), out["status"], HEADER
+def set_fields(values):
+    if g.get("batch") or g.get("deferred"):
+        for name, value in values.items():
+            setattr(g.c, name, value)
+        return
+    if "id" not in session:
+        start_session()
+    version = store.set_fields(session["id"], values, g.get("if_match"), owner = session["user"])
+    if version < 0:
+        abort(412, description = "character has changed since it was last fetched")
+    g.version = version
 
-@bp.route("/character/race", methods = ["GET", "PUT"])
-def character_race():
-    if request.method == "GET":
-        data = {
-            "race": g.c.race
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        race = request.get_json()
-        keys = race.keys()
-        if race and "race" in keys:
-            data = race
-            g.c.race = race["race"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'race' key.")
-    return json.dumps(out), out["status"], HEADER
+# Derived stats (see derived.py), read from Redis without loading the
+# character; in a batch or under the async server, worked out from the
+# character in hand instead, as get_field does
+def get_derived():
+    if g.get("batch") or g.get("deferred"):
+        snapshot = g.c.character.snapshot
+        if g.c.dirty:
+            snapshot = store.encode(g.c.character.document(set(derived.INPUTS)))
+        return derived_stats.compute(snapshot)
+    if "id" not in session:
+        g.version = 0
+        return BLANK_STATS
+    g.version, stats = store.get_derived(session["id"])
+    return stats
 
-@bp.route("/character/deity", methods = ["GET", "PUT"])
-def character_deity():
-    if request.method == "GET":
-        data = {
-            "deity": g.c.deity
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        deity = request.get_json()
-        keys = deity.keys()
-        if deity and "deity" in keys:
-            data = deity
-            g.c.deity = deity["deity"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'deity' key.")
-    return json.dumps(out), out["status"], HEADER
+# Items of a section matching the request's query string; get is the
+# section's get_* method, for the filters only pythfinder can evaluate
+def query(section, get):
+    try:
+        query_filter = filters.compile(section, request.args)
+    except ValueError as err:
+        abort(400, description = "invalid filter: {}".format(err))
+    return query_filter.apply(getattr(g.c, section), get)
 
-@bp.route("/character/notes", methods = ["GET", "PUT"])
-def character_notes():
-    if request.method == "GET":
-        data = {
-            "notes": g.c.notes
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        notes = request.get_json()
-        keys = notes.keys()
-        if notes and "notes" in keys:
-            data = notes
-            g.c.notes = notes["notes"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'notes' key.")
-    return json.dumps(out), out["status"], HEADER
+# Envelope for a collection GET, sorted, paged and projected as the query
+# string asks; to_dict turns an item into its JSON
+def collection_json(items, to_dict):
+    try:
+        data, page = pages.Listing(request.args).apply(items, to_dict)
+    except ValueError as err:
+        abort(400, description = "invalid listing: {}".format(err))
+    return return_json(data = data, page = page)
 
-@bp.route("/character/gender", methods = ["GET", "PUT"])
-def character_gender():
-    if request.method == "GET":
-        data = {
-            "gender": g.c.gender
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        gender = request.get_json()
-        keys = gender.keys()
-        if gender and "gender" in keys:
-            data = gender
-            g.c.gender = gender["gender"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'gender' key.")
-    return json.dumps(out), out["status"], HEADER
+# GET /character's response body, streamed from a snapshot: the same bytes
+# return_json would give, written a section at a time
+def stream_character(snapshot):
+    yield b'{"status":200,"message":"","data":'
+    yield from iter_json(snapshot, BLANK_DOC)
+    yield b"}"
 
-@bp.route("/character/homeland", methods = ["GET", "PUT"])
-def character_homeland():
-    if request.method == "GET":
-        data = {
-            "homeland": g.c.homeland
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        homeland = request.get_json()
-        keys = homeland.keys()
-        if homeland and "homeland" in keys:
-            data = homeland
-            g.c.homeland = homeland["homeland"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'homeland' key.")
-    return json.dumps(out), out["status"], HEADER
+def get_item(collection, uuid):
+    if g.get("batch") or g.get("deferred") or "id" not in session:
+        return None
+    g.version, item = store.get_item(session["id"], collection, uuid)
+    return item
 
-@bp.route("/character/CMB", methods = ["GET", "PUT"])
-def character_CMB():
-    if request.method == "GET":
-        data = {
-            "CMB": g.c.CMB
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        CMB = request.get_json()
-        keys = CMB.keys()
-        if CMB and "CMB" in keys:
-            data = CMB
-            g.c.CMB = CMB["CMB"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'CMB' key.")
-    return json.dumps(out), out["status"], HEADER
+# ETags are the character's stored version, which changes with every save,
+# so one tag covers every endpoint's view of the character
+def etag(version):
+    return "v{}".format(version)
 
-@bp.route("/character/CMD", methods = ["GET", "PUT"])
-def character_CMD():
-    if request.method == "GET":
-        data = {
-            "CMD": g.c.CMD
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        CMD = request.get_json()
-        keys = CMD.keys()
-        if CMD and "CMD" in keys:
-            data = CMD
-            g.c.CMD = CMD["CMD"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'CMD' key.")
-    return json.dumps(out), out["status"], HEADER
+# Seconds to wait before retrying a save that's lost attempts races. The
+# window doubles each time, so writers piling onto one character spread
+# out instead of colliding again; the wait is anywhere in it ("full
+# jitter").
+def save_backoff(attempts):
+    return random() * min(SAVE_BACKOFF_MAX, SAVE_BACKOFF * 2 ** attempts)
 
-@bp.route("/character/initiative_mods", methods = ["GET", "PUT"])
-def character_initiative_mods():
-    if request.method == "GET":
-        data = {
-            "initiative_mods": g.c.initiative_mods
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        initiative_mods = request.get_json()
-        keys = initiative_mods.keys()
-        if initiative_mods and "initiative_mods" in keys:
-            data = initiative_mods
-            g.c.initiative_mods = initiative_mods["initiative_mods"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'initiative_mods' key.")
-    return json.dumps(out), out["status"], HEADER
+# Runs the current request's view again; used after losing a save race, so
+# the request's change is applied on top of the other request's
+def replay_request():
+    try:
+        rv = current_app.dispatch_request()
+    except HTTPException as e:
+        return handle_exception(e)
+    return current_app.make_response(rv)
 
-@bp.route("/character/alignment", methods = ["GET", "PUT"])
-def character_alignment():
-    if request.method == "GET":
-        data = {
-            "alignment": g.c.alignment
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        alignment = request.get_json()
-        keys = alignment.keys()
-        if alignment and "alignment" in keys:
-            data = alignment
-            g.c.alignment = alignment["alignment"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'alignment' key.")
-    return json.dumps(out), out["status"], HEADER
+# The version the request's character is at, for conditional requests
+def stored_version():
+    if g.get("deferred"):
+        return g.prefetched[0]
+    if "id" not in session:
+        return 0
+    return store.version(session["id"])
 
-@bp.route("/character/description", methods = ["GET", "PUT"])
-def character_description():
-    if request.method == "GET":
-        data = {
-            "description": g.c.description
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        description = request.get_json()
-        keys = description.keys()
-        if description and "description" in keys:
-            data = description
-            g.c.description = description["description"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'description' key.")
-    return json.dumps(out), out["status"], HEADER
+# What's wrong with data as the body of a request to endpoint, or None if
+# it's fine or isn't checked
+def payload_error(endpoint, method, data):
+    section = PAYLOADS.get(endpoint.rpartition(".")[2])
+    if section is None or method not in ("POST", "PUT", "PATCH"):
+        return None
+    try:
+        schemas.check(section, data, partial = method == "PATCH")
+    except ValueError as err:
+        return "invalid {} data: {}".format(section.replace("_", " "), err)
+    return None
 
-@bp.route("/character/height", methods = ["GET", "PUT"])
-def character_height():
-    if request.method == "GET":
-        data = {
-            "height": g.c.height
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        height = request.get_json()
-        keys = height.keys()
-        if height and "height" in keys:
-            data = height
-            g.c.height = height["height"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'height' key.")
-    return json.dumps(out), out["status"], HEADER
+def check_payload():
+    if request.endpoint is not None and request.method in ("POST", "PUT", "PATCH"):
+        error = payload_error(request.endpoint, request.method, request.get_json())
+        if error is not None:
+            abort(400, description = error)
 
-@bp.route("/character/weight", methods = ["GET", "PUT"])
-def character_weight():
-    if request.method == "GET":
-        data = {
-            "weight": g.c.weight
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        weight = request.get_json()
-        keys = weight.keys()
-        if weight and "weight" in keys:
-            data = weight
-            g.c.weight = weight["weight"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'weight' key.")
-    return json.dumps(out), out["status"], HEADER
+# Sessions get their id, their account and a place in Redis only when a
+# request first writes to their character, or adds one; until then they're
+# served the blank one, and an account with no characters, without
+# touching Redis
+def start_session():
+    session["id"] = str(uuid())
+    session["user"] = str(uuid())
+    # nothing stored yet whose TTL would need refreshing
+    session["touched"] = time()
+    store.add_character(session["user"], session["id"])
 
-@bp.route("/character/size", methods = ["GET", "PUT"])
-def character_size():
-    if request.method == "GET":
-        data = {
-            "size": g.c.size
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        size = request.get_json()
-        keys = size.keys()
-        if size and "size" in keys:
-            data = size
-            g.c.size = size["size"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'size' key.")
-    return json.dumps(out), out["status"], HEADER
+def setup_request_context():
+    # The async server reads the character before the request and makes
+    # its writes after it (see defer_writes), counting round trips itself
+    g.prefetched = request.environ.get("pythfinder.prefetched")
+    g.deferred = g.prefetched is not None
+    if not g.deferred:
+        metrics.start()
+    session_keys = session.keys()
+    g.c = TrackedCharacter(load = load_character)
+    # bad bodies are turned away before anything is read from Redis;
+    # POST /characters may have none
+    if request.blueprint == bp.name or request.get_data():
+        check_payload()
+    if "id" not in session_keys:
+        # POST /characters needs an account to add to
+        if request.blueprint != bp.name and request.method == "POST":
+            start_session()
+    elif "user" not in session_keys:
+        # sessions from before accounts keep their character as the first one
+        session["user"] = str(uuid())
+        store.add_character(session["user"], session["id"])
+    if request.blueprint != bp.name:
+        return
+    # Conditional requests are answered from the version alone. Otherwise
+    # g.version is set by whatever reads the character, with the version
+    # read first so an ETag is never newer than the body it's sent with.
+    if request.method in ("GET", "HEAD") and request.if_none_match:
+        g.version = g.read_version = stored_version()
+        if request.if_none_match.contains_weak(etag(g.version)):
+            return "", 304, HEADER
+    elif request.method not in ("GET", "HEAD") and request.if_match:
+        version = g.read_version = stored_version()
+        # "*" only matches a character that's been saved
+        if not request.if_match.contains(etag(version)) or (request.if_match.star_tag and version == 0):
+            abort(412, description = "character has changed since it was last fetched")
+        # the save must then be against this version; see load_character
+        g.if_match = version
 
-@bp.route("/character/age", methods = ["GET", "PUT"])
-def character_age():
-    if request.method == "GET":
-        data = {
-            "age": g.c.age
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        age = request.get_json()
-        keys = age.keys()
-        if age and "age" in keys:
-            data = age
-            g.c.age = age["age"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'age' key.")
-    return json.dumps(out), out["status"], HEADER
+def count_round_trips(response):
+    if g.get("deferred"):
+        return response
+    response.headers["X-Redis-Round-Trips"] = str(metrics.finish())
+    return response
 
-@bp.route("/character/hair", methods = ["GET", "PUT"])
-def character_hair():
-    if request.method == "GET":
-        data = {
-            "hair": g.c.hair
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        hair = request.get_json()
-        keys = hair.keys()
-        if hair and "hair" in keys:
-            data = hair
-            g.c.hair = hair["hair"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'hair' key.")
-    return json.dumps(out), out["status"], HEADER
+# Under the async server, hands what cache_character would write to the
+# server in the request's environ: the character, the changed sections'
+# snapshot if it needs saving, and whether its TTL needs refreshing. The
+# server makes the writes, checks the character back into the cache, and
+# runs the request again if the save loses a race.
+def defer_writes(response):
+    now = time()
+    save = None
+    if g.c.dirty:
+        lazy = g.c.character
+        sections = None if lazy.snapshot is None else g.c.touched
+        save = (store.encode(lazy.document(sections)), sections)
+    touch = save is None and now - session.get("touched", 0) > TOUCH_INTERVAL
+    if save is not None or touch:
+        session["touched"] = now
+    version, character = g.get("version"), None
+    if g.c.loaded:
+        character = g.c.character
+    elif g.get("prefetched") is not None:
+        # never used, so it goes back to the cache as it was
+        version, character = g.prefetched
+    request.environ["pythfinder.deferred"] = {
+        "id": session["id"],
+        "owner": session["user"],
+        "version": version,
+        "if_match": g.get("if_match"),
+        "character": character,
+        "save": save,
+        "touch": touch
+    }
+    if request.blueprint == bp.name and g.get("version") is not None and (response.status_code < 300 or response.status_code == 304):
+        response.set_etag(etag(g.version))
+    return response
 
-@bp.route("/character/eyes", methods = ["GET", "PUT"])
-def character_eyes():
-    if request.method == "GET":
-        data = {
-            "eyes": g.c.eyes
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        eyes = request.get_json()
-        keys = eyes.keys()
-        if eyes and "eyes" in keys:
-            data = eyes
-            g.c.eyes = eyes["eyes"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'eyes' key.")
-    return json.dumps(out), out["status"], HEADER
+def cache_character(response):
+    if g.get("deferred"):
+        return defer_writes(response)
+    # Only changed characters are serialized and written back; unchanged
+    # ones just get their TTL refreshed, at most once per TOUCH_INTERVAL
+    now = time()
+    if g.c.dirty:
+        attempts = 1
+        while not save_character():
+            if g.get("if_match") is not None:
+                return handle_exception(PreconditionFailed(description = "character has changed since it was last fetched"))
+            if attempts == SAVE_ATTEMPTS:
+                return handle_exception(Conflict(description = "character was changed by another request; try again"))
+            sleep(save_backoff(attempts))
+            attempts += 1
+            g.c = TrackedCharacter(load = load_character)
+            response = replay_request()
+            if not g.c.dirty:
+                break
+        session["touched"] = now
+    elif "id" in session and now - session.get("touched", 0) > TOUCH_INTERVAL:
+        store.touch(session["id"], owner = session["user"])
+        session["touched"] = now
+    if g.c.loaded and g.c.character.snapshot is not None:
+        characters.checkin(session["id"], g.version, g.c.character, snapshot_size(g.c.character.snapshot))
+    if request.blueprint == bp.name and g.get("version") is not None and (response.status_code < 300 or response.status_code == 304):
+        response.set_etag(etag(g.version))
+    return response
 
-@bp.route("/character/languages", methods = ["GET", "PUT"])
-def character_languages():
-    if request.method == "GET":
-        data = {
-            "languages": g.c.languages
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        languages = request.get_json()
-        keys = languages.keys()
-        if languages and "languages" in keys:
-            data = languages
-            g.c.languages = languages["languages"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'languages' key.")
-    return json.dumps(out), out["status"], HEADER
+def favicon():
+    return "", 204, HEADER
 
-@bp.route("/character/spells_per_day", methods = ["GET", "PUT"])
-def character_spells_per_day():
-    if request.method == "GET":
-        data = {
-            "spells_per_day": g.c.spells_per_day
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        spells_per_day = request.get_json()
-        keys = spells_per_day.keys()
-        if spells_per_day and "spells_per_day" in keys:
-            data = spells_per_day
-            g.c.spells_per_day = spells_per_day["spells_per_day"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'spells_per_day' key.")
-    return json.dumps(out), out["status"], HEADER
+def redis_metrics():
+    return codec.dumps(return_json(data = {"round_trips": metrics.report(), "cache": characters.stats})), 200, HEADER
 
-@bp.route("/character/spells_known", methods = ["GET", "PUT"])
-def character_spells_known():
-    if request.method == "GET":
-        data = {
-            "spells_known": g.c.spells_known
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        spells_known = request.get_json()
-        keys = spells_known.keys()
-        if spells_known and "spells_known" in keys:
-            data = spells_known
-            g.c.spells_known = spells_known["spells_known"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'spells_known' key.")
-    return json.dumps(out), out["status"], HEADER
+def index():
+    abort(404, description = "browse to /api/v0/character to view character json")
 
-@bp.route("/character/bonus_spells", methods = ["GET", "PUT"])
-def character_bonus_spells():
-    if request.method == "GET":
-        data = {
-            "bonus_spells": g.c.bonus_spells
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        bonus_spells = request.get_json()
-        keys = bonus_spells.keys()
-        if bonus_spells and "bonus_spells" in keys:
-            data = bonus_spells
-            g.c.bonus_spells = bonus_spells["bonus_spells"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'bonus_spells' key.")
-    return json.dumps(out), out["status"], HEADER
+# Applies a JSON patch (see patches.py) to the sections of the character it
+# reaches, which are all that's checked and saved. Sections they're built
+# from (lazy.DEPENDS) are passed along as they are.
+def patch_character(ops):
+    names = patches.sections(ops)
+    names = set(BLANK_DOC) if names is None else names
+    unknown = names - set(BLANK_DOC)
+    if unknown:
+        abort(400, description = "invalid character data: unknown field '{}'".format(sorted(unknown)[0]))
+    doc = g.c.character.document(names)
+    try:
+        doc = patches.apply(doc, ops)
+        if not isinstance(doc, dict):
+            raise ValueError("must leave an object")
+        schemas.check_character(doc)
+    except patches.PatchConflict as err:
+        abort(409, description = str(err))
+    except ValueError as err:
+        abort(400, description = "invalid character data: {}".format(err))
+    depends = dependencies(names)
+    built = pf.Character(data = {**BLANK_DOC, **(g.c.character.document(depends) if depends else {}), **doc})
+    for name in names:
+        setattr(g.c, name, getattr(built, name))
 
-@bp.route("/character/base_attack_bonus", methods = ["GET", "PUT"])
-def character_base_attack_bonus():
+@bp.route("/character", methods = ["GET", "PUT", "PATCH"])
+def character():
     if request.method == "GET":
-        data = {
-            "base_attack_bonus": g.c.base_attack_bonus
-        }
+        # anything this request changed has to be serialized from the
+        # character itself
+        if STREAM_CHARACTER and g.c.character.snapshot is not None and not g.c.dirty:
+            return Response(stream_character(g.c.character.snapshot), 200, HEADER)
+        if g.c.character.snapshot is None and not g.c.dirty:
+            # nothing stored, so it's the blank character
+            return BLANK_JSON, 200, HEADER
+        data = codec.loads(g.c.get_json())
         out = return_json(data = data)
     elif request.method == "PUT":
-        base_attack_bonus = request.get_json()
-        keys = base_attack_bonus.keys()
-        if base_attack_bonus and "base_attack_bonus" in keys:
-            data = base_attack_bonus
-            g.c.base_attack_bonus = base_attack_bonus["base_attack_bonus"]
-            out = return_json(data = data)
+        new_c = request.get_json()
+        if new_c:
+            g.c = TrackedCharacter(LazyCharacter(None, pf.Character(data = new_c)), dirty = True)
+            g.version = g.get("if_match")
+            return "", 204, HEADER
         else:
-            abort(400, description = "improper data format: JSON must contain a 'base_attack_bonus' key.")
-    return json.dumps(out), out["status"], HEADER
+            abort(400, description = "invalid character data or content type")
+    elif request.method == "PATCH":
+        patch_character(request.get_json())
+        return "", 204, HEADER
+    return codec.dumps(out), out["status"], HEADER
 
-@bp.route("/character/gold", methods = ["GET", "PUT"])
-def character_gold():
+# GET and PUT for each of the simple properties in properties.py
+@bp.route("/character/<any({}):name>".format(", ".join(PROPERTIES)), methods = ["GET", "PUT"])
+def character_property(name):
     if request.method == "GET":
-        data = {
-            "gold": g.c.gold
-        }
-        out = return_json(data = data)
+        out = return_json(data = {name: get_field(name)})
     elif request.method == "PUT":
-        gold = request.get_json()
-        keys = gold.keys()
-        if gold and "gold" in keys:
-            data = gold
-            g.c.gold = gold["gold"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'gold' key.")
-    return json.dumps(out), out["status"], HEADER
-
-@bp.route("/character/AC", methods = ["GET", "PUT"])
-def character_AC():
-    if request.method == "GET":
-        data = {
-            "AC": g.c.AC
-        }
+        data = request.get_json()
+        if not isinstance(data, dict) or name not in data:
+            abort(400, description = "improper data format: JSON must contain a '{}' key".format(name))
+        try:
+            value = validate(name, data[name])
+        except ValueError as err:
+            abort(400, description = str(err))
+        set_fields({name: value})
         out = return_json(data = data)
-    elif request.method == "PUT":
-        AC = request.get_json()
-        keys = AC.keys()
-        if AC and "AC" in keys:
-            data = AC
-            g.c.AC = AC["AC"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'AC' key.")
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
-@bp.route("/character/speed", methods = ["GET", "PUT"])
-def character_speed():
-    if request.method == "GET":
-        data = {
-            "speed": g.c.speed
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        speed = request.get_json()
-        keys = speed.keys()
-        if speed and "speed" in keys:
-            data = speed
-            g.c.speed = speed["speed"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'speed' key.")
-    return json.dumps(out), out["status"], HEADER
+# Sets several simple properties in one write; nothing is set unless all
+# of them are valid
+@bp.route("/character/properties", methods = ["PATCH"])
+def character_properties():
+    data = request.get_json()
+    if not isinstance(data, dict) or not data:
+        abort(400, description = "improper data format: JSON must be an object of properties and their values")
+    try:
+        values = validate_all(data)
+    except ValueError as err:
+        abort(400, description = str(err))
+    set_fields(values)
+    out = return_json(data = values)
+    return codec.dumps(out), out["status"], HEADER
 
-@bp.route("/character/hp", methods = ["GET", "PUT"])
-def character_hp():
-    if request.method == "GET":
-        data = {
-            "hp": g.c.hp
-        }
-        out = return_json(data = data)
-    elif request.method == "PUT":
-        hp = request.get_json()
-        keys = hp.keys()
-        if hp and "hp" in keys:
-            data = hp
-            g.c.hp = hp["hp"]
-            out = return_json(data = data)
-        else:
-            abort(400, description = "improper data format: JSON must contain a 'hp' key.")
-    return json.dumps(out), out["status"], HEADER
+# Totals worked out from the abilities, saving throws, skills and attacks
+@bp.route("/character/derived", methods = ["GET"])
+def character_derived():
+    out = return_json(data = derived.present(get_derived()))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/equipment", methods = ["GET", "POST"])
 def character_equipment():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        weight = request.args.get("weight") if request.args.get("weight") else {}
-        if weight:
-            weight = json.loads(str(request.args.get("weight")).replace("'", '"')) 
-        count = request.args.get("count") if request.args.get("count") else {}
-        if count:
-            count = json.loads(str(request.args.get("count")).replace("'", '"')) 
-        camp = request.args.get("camp").split(",") if request.args.get("camp") else []
-        on_person = request.args.get("on_person").split(",") if request.args.get("on_person") else []
-        location = request.args.get("location").split(",") if request.args.get("location") else []
-        notes = request.args.get("notes").split(",") if request.args.get("notes") else []
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "weight": weight,
-            "count": count,
-            "camp": camp,
-            "on_person": on_person,
-            "location": location,
-            "notes": notes
-        }
         try:
-            data = g.c.get_equipment(data = get_data)
-            out_list = [d.__dict__ for d in data]
-            out = return_json(data = out_list)
+            data = query("equipment", g.c.get_equipment)
+            out = collection_json(data, lambda d: d.__dict__)
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data:
-            try:
-                item = g.c.add_equipment(data = post_data)
-                out = return_json(data = item.__dict__, status = 201)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            item = g.c.add_equipment(data = post_data)
+            out = return_json(data = item.__dict__, status = 201)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/equipment/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_equipment_specific(uuid):
-    item_list = g.c.get_equipment(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("equipment", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    item_list = g.c.find("equipment", uuid = uuid)
     if not item_list:
         abort(404, description = "item not found with uuid '{}'".format(uuid))
     item = item_list[0]
@@ -609,14 +563,12 @@ def character_equipment_specific(uuid):
         out = return_json(data = item.__dict__)
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = item.update(data = patch_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = item.update(data = patch_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_equipment(item)
@@ -624,39 +576,20 @@ def character_equipment_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/abilities", methods = ["GET"])
 def character_abilities():
-    name = request.args.get("name").split(",") if request.args.get("name") else []
-    name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-    base = request.args.get("base") if request.args.get("base") else {}
-    if base:
-        base = json.loads(str(request.args.get("base")).replace("'", '"')) 
-    modifier = request.args.get("modifier") if request.args.get("modifier") else {}
-    if modifier:
-        modifier = json.loads(str(request.args.get("modifier")).replace("'", '"')) 
-    misc = request.args.get("misc") if request.args.get("misc") else {}
-    if misc:
-        misc = json.loads(str(request.args.get("misc")).replace("'", '"')) 
-    get_data = {
-        "name": name,
-        "name_search_type": name_search_type,
-        "base": base,
-        "modifier": modifier,
-        "misc": misc
-    }
     try:
-        data = g.c.get_abilities(data = get_data)
-        out_list = [d.get_dict() for d in data]
-        out = return_json(data = out_list)
+        data = query("abilities", g.c.get_abilities)
+        out = collection_json(data, lambda d: d.get_dict())
     except (KeyError, ValueError) as err:
         abort(400, description = "pythfinder error: {}".format(err))
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/abilities/<name>", methods = ["GET", "PATCH"])
 def character_abilities_specific(name):
-    ability_list = g.c.get_abilities(name = name, name_search_type = "absolute") 
+    ability_list = g.c.find("abilities", name = name)
     if not ability_list:
         abort(404, description = "ability not found with name '{}'".format(name))
     ability = ability_list[0]
@@ -664,45 +597,28 @@ def character_abilities_specific(name):
         out = return_json(data = ability.get_dict())
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = ability.update(data = patch_data)
-                out = return_json(data = data.get_dict())
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            g.c.mark_dirty()
+            data = ability.update(data = patch_data)
+            out = return_json(data = data.get_dict())
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/saving_throws", methods = ["GET"])
 def character_saving_throws():
-    name = request.args.get("name").split(",") if request.args.get("name") else []
-    name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-    base = request.args.get("base") if request.args.get("base") else {}
-    if base:
-        base = json.loads(str(request.args.get("base")).replace("'", '"')) 
-    misc = request.args.get("misc") if request.args.get("misc") else {}
-    if misc:
-        misc = json.loads(str(request.args.get("misc")).replace("'", '"')) 
-    get_data = {
-        "name": name,
-        "name_search_type": name_search_type,
-        "base": base,
-        "misc": misc
-    }
     try:
-        data = g.c.get_saving_throws(data = get_data)
-        out_list = [d.get_dict() for d in data]
-        out = return_json(data = out_list)
+        data = query("saving_throws", g.c.get_saving_throws)
+        out = collection_json(data, lambda d: d.get_dict())
     except (KeyError, ValueError) as err:
         message = "pythfinder error: {}".format(err)
         status = 400
         out = return_json(message = message, status = status)
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/saving_throws/<name>", methods = ["GET", "PATCH"])
 def character_saving_throws_specific(name):
-    saving_throw_list = g.c.get_saving_throws(name = name, name_search_type = "absolute") 
+    saving_throw_list = g.c.find("saving_throws", name = name)
     if not saving_throw_list:
         abort(404, description = "saving_throw not found with name '{}'".format(name))
     saving_throw = saving_throw_list[0]
@@ -710,52 +626,39 @@ def character_saving_throws_specific(name):
         out = return_json(data = saving_throw.get_dict())
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = saving_throw.update(data = patch_data)
-                out = return_json(data = data.get_dict())
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            g.c.mark_dirty()
+            data = saving_throw.update(data = patch_data)
+            out = return_json(data = data.get_dict())
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/classes", methods = ["GET", "POST"])
 def character_classes():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        archetypes = request.args.get("archetypes").split(",") if request.args.get("archetypes") else []
-        level = request.args.get("level") if request.args.get("level") else {}
-        if level:
-            level = json.loads(str(request.args.get("level")).replace("'", '"')) 
-        get_data = {
-            "name": name,
-            "name_search_type": name_search_type,
-            "archetypes": archetypes,
-            "level": level
-        }
         try:
-            data = g.c.get_classes(data = get_data)
-            out_list = [d.__dict__ for d in data]
-            out = return_json(data = out_list)
+            data = query("classes", g.c.get_classes)
+            out = collection_json(data, lambda d: d.__dict__)
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data:
-            try:
-                data = g.c.add_class(data = post_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_class(data = post_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/classes/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_classes_specific(uuid):
-    class_list = g.c.get_classes(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("classes", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    class_list = g.c.find("classes", uuid = uuid)
     if not class_list:
         abort(404, description = "class not found with uuid '{}'".format(uuid))
     character_class = class_list[0]
@@ -763,14 +666,12 @@ def character_classes_specific(uuid):
         out = return_json(data = character_class.__dict__)
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = character_class.update(data = patch_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = character_class.update(data = patch_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_class(character_class)
@@ -778,44 +679,33 @@ def character_classes_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/feats", methods = ["GET", "POST"])
 def character_feats():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        description = request.args.get("description").split(",") if request.args.get("description") else []
-        notes = request.args.get("notes").split(",") if request.args.get("notes") else []
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "description": description,
-            "notes": notes
-        }
         try:
-            data = g.c.get_feats(data = get_data)
-            out_list = [d.__dict__ for d in data]
-            out = return_json(data = out_list)
+            data = query("feats", g.c.get_feats)
+            out = collection_json(data, lambda d: d.__dict__)
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data or post_data == {}:
-            try:
-                data = g.c.add_feat(data = post_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_feat(data = post_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/feats/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_feats_specific(uuid):
-    feat_list = g.c.get_feats(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("feats", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    feat_list = g.c.find("feats", uuid = uuid)
     if not feat_list:
         abort(404, description = "feat not found with uuid '{}'".format(uuid))
     feat = feat_list[0]
@@ -823,14 +713,12 @@ def character_feats_specific(uuid):
         out = return_json(data = feat.__dict__)
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = feat.update(data = patch_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = feat.update(data = patch_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_feat(feat)
@@ -838,44 +726,33 @@ def character_feats_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/traits", methods = ["GET", "POST"])
 def character_traits():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        description = request.args.get("description").split(",") if request.args.get("description") else []
-        notes = request.args.get("notes").split(",") if request.args.get("notes") else []
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "description": description,
-            "notes": notes
-        }
         try:
-            data = g.c.get_traits(data = get_data)
-            out_list = [d.__dict__ for d in data]
-            out = return_json(data = out_list)
+            data = query("traits", g.c.get_traits)
+            out = collection_json(data, lambda d: d.__dict__)
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data or post_data == {}:
-            try:
-                data = g.c.add_trait(data = post_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_trait(data = post_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/traits/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_traits_specific(uuid):
-    trait_list = g.c.get_traits(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("traits", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    trait_list = g.c.find("traits", uuid = uuid)
     if not trait_list:
         abort(404, description = "trait not found with uuid '{}'".format(uuid))
     trait = trait_list[0]
@@ -883,14 +760,12 @@ def character_traits_specific(uuid):
         out = return_json(data = trait.__dict__)
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = trait.update(data = patch_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = trait.update(data = patch_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_trait(trait)
@@ -898,44 +773,33 @@ def character_traits_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/specials", methods = ["GET", "POST"])
 def character_specials():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        description = request.args.get("description").split(",") if request.args.get("description") else []
-        notes = request.args.get("notes").split(",") if request.args.get("notes") else []
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "description": description,
-            "notes": notes
-        }
         try:
-            data = g.c.get_specials(data = get_data)
-            out_list = [d.__dict__ for d in data]
-            out = return_json(data = out_list)
+            data = query("special", g.c.get_specials)
+            out = collection_json(data, lambda d: d.__dict__)
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data or post_data == {}:
-            try:
-                data = g.c.add_special(data = post_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_special(data = post_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/specials/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_specials_specific(uuid):
-    special_list = g.c.get_specials(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("special", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    special_list = g.c.find("special", uuid = uuid)
     if not special_list:
         abort(404, description = "special not found with uuid '{}'".format(uuid))
     special = special_list[0]
@@ -943,14 +807,12 @@ def character_specials_specific(uuid):
         out = return_json(data = special.__dict__)
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = special.update(data = patch_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = special.update(data = patch_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_special(special)
@@ -958,62 +820,33 @@ def character_specials_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/skills", methods = ["GET", "POST"])
 def character_skills():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        rank = request.args.get("rank") if request.args.get("rank") else {}
-        if rank:
-            rank = json.loads(str(request.args.get("rank")).replace("'", '"')) 
-        if request.args.get("is_class") == None:
-            is_class = []
-        else:
-            is_class = request.args.get("is_class") == "true"
-        mod = request.args.get("mod").split(",") if request.args.get("mod") else []
-        notes = request.args.get("notes").split(",") if request.args.get("notes") else []
-        if request.args.get("use_untrained") == None:
-            use_untrained = []
-        else:
-            use_untrained = request.args.get("use_untrained") == "true"
-        misc = request.args.get("misc") if request.args.get("misc") else {}
-        if misc:
-            misc = json.loads(str(request.args.get("misc")).replace("'", '"')) 
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "rank": rank,
-            "is_class": is_class,
-            "mod": mod,
-            "notes": notes,
-            "use_untrained": use_untrained,
-            "misc": misc
-        }
         try:
-            data = g.c.get_skills(data = get_data)
-            out_list = [d.get_dict() for d in data]
-            out = return_json(data = out_list)
+            data = query("skills", g.c.get_skills)
+            out = collection_json(data, lambda d: d.get_dict())
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data or post_data == {}:
-            try:
-                data = g.c.add_skill(data = post_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_skill(data = post_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/skills/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_skills_specific(uuid):
-    skill_list = g.c.get_skills(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("skills", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    skill_list = g.c.find("skills", uuid = uuid)
     if not skill_list:
         abort(404, description = "skill not found with uuid '{}'".format(uuid))
     skill = skill_list[0]
@@ -1021,14 +854,12 @@ def character_skills_specific(uuid):
         out = return_json(data = skill.get_dict())
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = skill.update(data = patch_data)
-                out = return_json(data = data.get_dict())
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = skill.update(data = patch_data)
+            out = return_json(data = data.get_dict())
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_skill(skill)
@@ -1036,54 +867,33 @@ def character_skills_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/spells", methods = ["GET", "POST"])
 def character_spells():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        level = request.args.get("level") if request.args.get("level") else {}
-        if level:
-            level = json.loads(str(request.args.get("level")).replace("'", '"')) 
-        description = request.args.get("description").split(",") if request.args.get("description") else []
-        prepared = request.args.get("prepared") if request.args.get("prepared") else {}
-        if prepared:
-            prepared = json.loads(str(request.args.get("prepared")).replace("'", '"')) 
-        cast = request.args.get("cast") if request.args.get("cast") else {}
-        if cast:
-            cast = json.loads(str(request.args.get("cast")).replace("'", '"')) 
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "level": level,
-            "description": description,
-            "prepared": prepared,
-            "cast": cast
-        }
         try:
-            data = g.c.get_spells(data = get_data)
-            out_list = [d.__dict__ for d in data]
-            out = return_json(data = out_list)
+            data = query("spells", g.c.get_spells)
+            out = collection_json(data, lambda d: d.__dict__)
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data or post_data == {}:
-            try:
-                data = g.c.add_spell(data = post_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_spell(data = post_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/spells/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_spells_specific(uuid):
-    spell_list = g.c.get_spells(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("spells", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    spell_list = g.c.find("spells", uuid = uuid)
     if not spell_list:
         abort(404, description = "spell not found with uuid '{}'".format(uuid))
     spell = spell_list[0]
@@ -1091,14 +901,12 @@ def character_spells_specific(uuid):
         out = return_json(data = spell.__dict__)
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = spell.update(data = patch_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = spell.update(data = patch_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_spell(spell)
@@ -1106,58 +914,33 @@ def character_spells_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/armor", methods = ["GET", "POST"])
 def character_armor():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        acBonus = request.args.get("acBonus") if request.args.get("acBonus") else {}
-        if acBonus:
-            acBonus = json.loads(str(request.args.get("acBonus")).replace("'", '"')) 
-        acPenalty = request.args.get("acPenalty") if request.args.get("acPenalty") else {}
-        if acPenalty:
-            acPenalty = json.loads(str(request.args.get("acPenalty")).replace("'", '"')) 
-        maxDexBonus = request.args.get("maxDexBonus") if request.args.get("maxDexBonus") else {}
-        if maxDexBonus:
-            maxDexBonus = json.loads(str(request.args.get("maxDexBonus")).replace("'", '"')) 
-        arcaneFailureChance = request.args.get("arcaneFailureChance") if request.args.get("arcaneFailureChance") else {}
-        if arcaneFailureChance:
-            arcaneFailureChance = json.loads(str(request.args.get("arcaneFailureChance")).replace("'", '"')) 
-        type_ = request.args.get("type").split(",") if request.args.get("type") else []
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "acBonus": acBonus,
-            "acPenalty": acPenalty,
-            "maxDexBonus": maxDexBonus,
-            "arcaneFailureChance": arcaneFailureChance,
-            "type": type_,
-        }
         try:
-            data = g.c.get_armor(data = get_data)
-            out_list = [d.__dict__ for d in data]
-            out = return_json(data = out_list)
+            data = query("armor", g.c.get_armor)
+            out = collection_json(data, lambda d: d.__dict__)
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data or post_data == {}:
-            try:
-                data = g.c.add_armor(data = post_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_armor(data = post_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/armor/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_armor_specific(uuid):
-    armor_list = g.c.get_armor(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("armor", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    armor_list = g.c.find("armor", uuid = uuid)
     if not armor_list:
         abort(404, description = "armor not found with uuid '{}'".format(uuid))
     armor = armor_list[0]
@@ -1165,14 +948,12 @@ def character_armor_specific(uuid):
         out = return_json(data = armor.__dict__)
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = armor.update(data = patch_data)
-                out = return_json(data = data.__dict__)
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = armor.update(data = patch_data)
+            out = return_json(data = data.__dict__)
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_armor(armor)
@@ -1180,64 +961,33 @@ def character_armor_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/attacks", methods = ["GET", "POST"])
 def character_attacks():
     if request.method == "GET":
-        name = request.args.get("name").split(",") if request.args.get("name") else []
-        uuid = request.args.get("uuid").split(",") if request.args.get("uuid") else []
-        name_search_type = request.args.get("name_search_type") if request.args.get("name_search_type") else ""
-        attack_type = request.args.get("attack_type").split(",") if request.args.get("attack_type") else []
-        damage_type = request.args.get("damage_type").split(",") if request.args.get("damage_type") else []
-        attack_mod = request.args.get("attack_mod").split(",") if request.args.get("attack_mod") else []
-        damage_mod = request.args.get("damage_mod").split(",") if request.args.get("damage_mod") else []
-        damage = request.args.get("damage").split(",") if request.args.get("damage") else []
-        crit_roll = request.args.get("crit_roll") if request.args.get("crit_roll") else {}
-        if crit_roll:
-            crit_roll = json.loads(str(request.args.get("crit_roll")).replace("'", '"')) 
-        crit_multi = request.args.get("crit_multi") if request.args.get("crit_multi") else {}
-        if crit_multi:
-            crit_multi = json.loads(str(request.args.get("crit_multi")).replace("'", '"')) 
-        range_ = request.args.get("range") if request.args.get("range") else {}
-        if range_:
-            range_ = json.loads(str(request.args.get("range")).replace("'", '"')) 
-        notes = request.args.get("notes").split(",") if request.args.get("notes") else []
-        get_data = {
-            "name": name,
-            "uuid": uuid,
-            "name_search_type": name_search_type,
-            "attack_type": attack_type,
-            "damage_type": damage_type,
-            "attack_mod": attack_mod,
-            "damage_mod": damage_mod,
-            "damage": damage,
-            "crit_roll": crit_roll,
-            "crit_multi": crit_multi,
-            "range": range_,
-            "notes": notes
-        }
         try:
-            data = g.c.get_attacks(data = get_data)
-            out_list = [d.get_dict() for d in data]
-            out = return_json(data = out_list)
+            data = query("attacks", g.c.get_attacks)
+            out = collection_json(data, lambda d: d.get_dict())
         except (KeyError, ValueError) as err:
             abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "POST":
         post_data = request.get_json()
-        if post_data or post_data == {}:
-            try:
-                data = g.c.add_attack(data = post_data)
-                out = return_json(data = data.get_dict())
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid post data")
-    return json.dumps(out), out["status"], HEADER
+        try:
+            data = g.c.add_attack(data = post_data)
+            out = return_json(data = data.get_dict())
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
+    return codec.dumps(out), out["status"], HEADER
 
 @bp.route("/character/attacks/<uuid>", methods = ["GET", "PATCH", "DELETE"])
 def character_attacks_specific(uuid):
-    attack_list = g.c.get_attacks(uuid = uuid)
+    if request.method == "GET":
+        item = get_item("attacks", uuid)
+        if item is not None:
+            out = return_json(data = item)
+            return codec.dumps(out), out["status"], HEADER
+    attack_list = g.c.find("attacks", uuid = uuid)
     if not attack_list:
         abort(404, description = "attack not found with uuid '{}'".format(uuid))
     attack = attack_list[0]
@@ -1245,14 +995,12 @@ def character_attacks_specific(uuid):
         out = return_json(data = attack.get_dict())
     elif request.method == "PATCH":
         patch_data = request.get_json()
-        if patch_data:
-            try:
-                data = attack.update(data = patch_data)
-                out = return_json(data = data.get_dict())
-            except ValueError as err:
-                abort(400, description = "pythfinder error: {}".format(err))
-        else:
-            abort(400, description = "invalid patch data")
+        try:
+            g.c.mark_dirty()
+            data = attack.update(data = patch_data)
+            out = return_json(data = data.get_dict())
+        except ValueError as err:
+            abort(400, description = "pythfinder error: {}".format(err))
     elif request.method == "DELETE":
         try:
             g.c.delete_attack(attack)
@@ -1260,6 +1008,236 @@ def character_attacks_specific(uuid):
             abort(400, description = "pythfinder error: {}".format(err))
         else:
             return "", 204, HEADER
-    return json.dumps(out), out["status"], HEADER
+    return codec.dumps(out), out["status"], HEADER
+
+# Change feeds: each write to a character as a Server-Sent Event, with the
+# version it made as the event id. Patch events hold the write's JSON patch
+# (RFC 6902) against GET /character's data; a reset event means the
+# character was replaced, or the writes since the client's last event are
+# no longer logged, and should be fetched again.
+#
+# Here, the response is just the writes since the client's Last-Event-ID
+# (or ?since=), telling it to come back after CHANGES_RETRY ms, which
+# EventSource does by itself. The async server (asgi.py) holds the stream
+# open instead and sends writes as they're published.
+
+def last_event_id(req):
+    value = req.headers.get("Last-Event-ID") or req.args.get("since")
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, description = "invalid event id '{}'".format(value))
+
+def reset_event(version):
+    return 'event: reset\nid: {0}\ndata: {{"version":{0}}}\n\n'.format(version)
+
+# Events for the result of store.changes(); with no changes, just the
+# current version as the id to resume from
+def change_events(version, changes):
+    if changes is None:
+        return reset_event(version)
+    if not changes:
+        return "id: {}\n\n".format(version)
+    out = []
+    for change_version, patch in changes:
+        if patch is None:
+            out.append(reset_event(change_version))
+        else:
+            out.append("event: patch\nid: {}\ndata: {}\n\n".format(change_version, patch))
+    return "".join(out)
+
+def change_feed(id):
+    since = last_event_id(request)
+    if id is None:
+        version, changes = 0, []
+    elif since is None:
+        version, changes = store.version(id), []
+    else:
+        version, changes = store.changes(id, since)
+    headers = {**HEADER, "Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+    return "retry: {}\n{}".format(CHANGES_RETRY, change_events(version, changes)), 200, headers
+
+@bp.route("/character/changes", methods = ["GET"])
+def character_changes():
+    return change_feed(session.get("id"))
+
+# The same log as the change feed, for clients that sync by asking: the
+# patches taking the character from version ?since= to the version given
+# with them. 410 means they aren't all kept, and the character should be
+# fetched again.
+@bp.route("/character/patches", methods = ["GET"])
+def character_patches():
+    try:
+        since = int(request.args["since"])
+    except (KeyError, ValueError):
+        abort(400, description = "improper query: 'since' must be a version")
+    if "id" in session:
+        version, changes = store.changes(session["id"], since)
+    else:
+        version, changes = 0, [] if since == 0 else None
+    if changes is None or any(patch is None for _, patch in changes):
+        abort(410, description = "patches since version {} are no longer kept; fetch the character again".format(since))
+    g.version = version
+    out = return_json(data = {
+        "version": changes[-1][0] if changes else version,
+        "patches": [{"version": change_version, "patch": codec.loads(patch)} for change_version, patch in changes]
+    })
+    return codec.dumps(out), out["status"], HEADER
+
+# Runs one batch operation as a request of its own, sharing this request's
+# session and g (and so g.c)
+def run_operation(op):
+    path = op["path"] if op["path"].startswith(bp.url_prefix) else bp.url_prefix + op["path"]
+    environ = EnvironBuilder(path, base_url = request.host_url, method = str(op.get("method", "GET")).upper(), json = op.get("body")).get_environ()
+    with RequestContext(current_app._get_current_object(), environ, session = session._get_current_object()):
+        if request.endpoint == bp.name + ".batch":
+            return handle_exception(BadRequest(description = "batches can't be nested"))
+        if request.endpoint in (bp.name + ".character_changes", bp.name + ".character_patches"):
+            # they read the saved log, which can't see the batch's changes
+            return handle_exception(BadRequest(description = "change logs can't be batched"))
+        if request.url_rule is not None and request.blueprint != bp.name:
+            return handle_exception(BadRequest(description = "only endpoints of the active character can be batched"))
+        try:
+            check_payload()
+            rv = current_app.dispatch_request()
+        except HTTPException as e:
+            return handle_exception(e)
+        return current_app.make_response(rv)
+
+@bp.route("/batch", methods = ["POST"])
+def batch():
+    operations = request.get_json()
+    if isinstance(operations, dict):
+        operations = operations.get("operations")
+    if not isinstance(operations, list) or not all(isinstance(op, dict) and isinstance(op.get("path"), str) for op in operations):
+        abort(400, description = "improper data format: JSON must be a list of operations, each with a 'path'")
+    g.batch = True
+    results = []
+    for i, op in enumerate(operations):
+        try:
+            response = run_operation(op)
+        except Exception:
+            # nothing from a batch is saved unless all of it succeeded
+            g.c = TrackedCharacter(load = load_character)
+            raise
+        body = response.get_data()
+        results.append(codec.loads(body) if body else return_json(status = response.status_code))
+        if response.status_code >= 400:
+            g.c = TrackedCharacter(load = load_character)
+            out = return_json(status = response.status_code, message = "operation {} failed; no changes were saved".format(i), data = results)
+            return codec.dumps(out), out["status"], HEADER
+    out = return_json(data = results)
+    return codec.dumps(out), out["status"], HEADER
+
+# Character ids are only accepted if they're in the session's index
+def account_ids(ids = None):
+    owned = store.characters(session["user"]) if "user" in session else []
+    if ids is None:
+        return owned
+    for id in ids:
+        if id not in owned:
+            abort(404, description = "character not found with id '{}'".format(id))
+    return ids
+
+# Summaries of the given characters. Ones that have expired are dropped
+# from the index, except the active one, which is blank until it's saved
+# again.
+def summaries(ids):
+    if not ids:
+        return []
+    data = store.summaries(ids, SUMMARY_FIELDS, BLANK_DOC, session["user"])
+    out = []
+    for id, summary in zip(ids, data):
+        if summary is None and id != session["id"]:
+            store.delete_character(session["user"], id)
+        else:
+            out.append({"id": id, "active": id == session["id"], **(summary or BLANK_SUMMARY)})
+    return out
+
+def select_character(id):
+    session["id"] = id
+    g.c = TrackedCharacter(load = load_character)
+    g.version = None
+
+@accounts.route("/characters", methods = ["GET", "POST"])
+def account_characters():
+    if request.method == "GET":
+        ids = request.args.get("ids").split(",") if request.args.get("ids") else None
+        out = return_json(data = summaries(account_ids(ids)))
+    elif request.method == "POST":
+        # a new character, made active; with a body it starts as that
+        # character, like PUT /character
+        new_c = request.get_data() and request.get_json()
+        id = str(uuid())
+        store.add_character(session["user"], id)
+        select_character(id)
+        if new_c:
+            g.c = TrackedCharacter(LazyCharacter(None, pf.Character(data = new_c)), dirty = True)
+        out = return_json(data = {"id": id}, status = 201)
+    return codec.dumps(out), out["status"], HEADER
+
+@accounts.route("/characters/active", methods = ["GET", "PUT"])
+def account_characters_active():
+    if request.method == "PUT":
+        active = request.get_json()
+        if not active or "id" not in active.keys():
+            abort(400, description = "improper data format: JSON must contain an 'id' key")
+        select_character(account_ids([active["id"]])[0])
+    out = return_json(data = {"id": session.get("id")})
+    return codec.dumps(out), out["status"], HEADER
+
+@accounts.route("/characters/<id>/changes", methods = ["GET"])
+def account_character_changes(id):
+    account_ids([id])
+    return change_feed(id)
+
+@accounts.route("/characters/<id>", methods = ["GET", "DELETE"])
+def account_characters_specific(id):
+    account_ids([id])
+    if request.method == "GET":
+        found = summaries([id])
+        if not found:
+            abort(404, description = "character not found with id '{}'".format(id))
+        out = return_json(data = found[0])
+    elif request.method == "DELETE":
+        store.delete_character(session["user"], id)
+        characters.discard(id)
+        if id == session["id"]:
+            # fall back to the newest remaining character, or a new one
+            remaining = store.characters(session["user"])
+            if not remaining:
+                remaining = [str(uuid())]
+                store.add_character(session["user"], remaining[0])
+            select_character(remaining[-1])
+        return "", 204, HEADER
+    return codec.dumps(out), out["status"], HEADER
 
-app.register_blueprint(bp)
+# Builds the app. Settings are DEFAULT_CONFIG's, overridden by the
+# environment, overridden by config. Nothing is connected or imported for
+# Redis until a request needs it.
+def create_app(config = None):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_prefixed_env("PYTHFINDER")
+    app.config.update(config or {})
+    app.json = CodecJSONProvider(app)
+    app.extensions["pythfinder"] = AppState(app.config)
+    if app.config["CORS_ORIGIN"]:
+        from flask_cors import CORS
+        CORS(app, resources = {r"/api/*": {"origins": app.config["CORS_ORIGIN"]}}, supports_credentials = True)
+    app.register_error_handler(HTTPException, handle_exception)
+    # Only the API's blueprints have sessions and characters; /, /metrics,
+    # /favicon.ico and unknown URLs skip all of it. after_request functions
+    # run last-registered first, so round trips are counted after
+    # cache_character's.
+    for name in (bp.name, accounts.name):
+        app.before_request_funcs.setdefault(name, []).append(setup_request_context)
+        app.after_request_funcs.setdefault(name, []).extend([count_round_trips, cache_character])
+    app.add_url_rule("/favicon.ico", view_func = favicon)
+    app.add_url_rule("/metrics", view_func = redis_metrics)
+    app.add_url_rule("/", view_func = index)
+    app.register_blueprint(bp)
+    app.register_blueprint(accounts)
+    return app
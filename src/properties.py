@@ -0,0 +1,125 @@
+# Simple character properties: the top-level fields that are read and
+# written whole, each at /character/<name>, or several at once with
+# PATCH /character/properties
+#
+# PROPERTIES maps each one to its validator, a function that returns the
+# value to store or raises ValueError saying what it should have been.
+# Adding a property is adding it here.
+
+def string(value):
+    if not isinstance(value, str):
+        raise ValueError("must be a string")
+    return value
+
+# bools are ints to Python, but not to anyone sending JSON
+def integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("must be an integer")
+    return value
+
+def number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("must be a number")
+    return value
+
+def boolean(value):
+    if not isinstance(value, bool):
+        raise ValueError("must be true or false")
+    return value
+
+def array(value):
+    if not isinstance(value, list):
+        raise ValueError("must be a list")
+    return value
+
+def mapping(value):
+    if not isinstance(value, dict):
+        raise ValueError("must be an object")
+    return value
+
+def list_of(validate, what):
+    def validate_list(value):
+        if not isinstance(value, list):
+            raise ValueError("must be a list of {}".format(what))
+        for item in value:
+            try:
+                validate(item)
+            except ValueError:
+                raise ValueError("must be a list of {}".format(what))
+        return value
+    return validate_list
+
+def mapping_of(validate, what):
+    def validate_mapping(value):
+        if not isinstance(value, dict):
+            raise ValueError("must be an object of {}".format(what))
+        for item in value.values():
+            try:
+                validate(item)
+            except ValueError:
+                raise ValueError("must be an object of {}".format(what))
+        return value
+    return validate_mapping
+
+# The first of validators that accepts the value, for fields that are
+# written more than one way
+def either(*validators, what):
+    def validate_either(value):
+        for validate in validators:
+            try:
+                return validate(value)
+            except ValueError:
+                pass
+        raise ValueError("must be {}".format(what))
+    return validate_either
+
+PROPERTIES = {
+    "name": string,
+    "race": string,
+    "deity": string,
+    "notes": string,
+    "gender": string,
+    "homeland": string,
+    "CMB": integer,
+    "CMD": integer,
+    "initiative_mods": list_of(integer, "integers"),
+    "alignment": string,
+    "description": string,
+    "height": string,
+    "weight": number,
+    "size": string,
+    "age": integer,
+    "hair": string,
+    "eyes": string,
+    "languages": list_of(string, "strings"),
+    "spells_per_day": mapping_of(integer, "integers"),
+    "spells_known": mapping,
+    "bonus_spells": mapping,
+    "base_attack_bonus": integer,
+    "gold": number,
+    "AC": array,
+    "speed": mapping_of(number, "numbers"),
+    "hp": mapping_of(number, "numbers")
+}
+
+# Raises ValueError for unknown properties and invalid values
+def validate(name, value):
+    if name not in PROPERTIES:
+        raise ValueError("unknown property '{}'".format(name))
+    try:
+        return PROPERTIES[name](value)
+    except ValueError as err:
+        raise ValueError("invalid value for '{}': {}".format(name, err))
+
+# Validates several properties at once; the error lists every problem
+def validate_all(values):
+    out = {}
+    errors = []
+    for name, value in values.items():
+        try:
+            out[name] = validate(name, value)
+        except ValueError as err:
+            errors.append(str(err))
+    if errors:
+        raise ValueError("; ".join(errors))
+    return out
@@ -1,4 +1,14 @@
 #!/bin/sh
 
+# sh run.sh        Flask's development server
+# sh run.sh async  the async server (asgi.py) under uvicorn, on the same port
+# sh run.sh prod   pre-forked workers under gunicorn (see gunicorn.conf.py)
+
 export FLASK_APP=pf-flask.py
-flask run
+if [ "$1" = "async" ]; then
+    uvicorn asgi:app --port "${FLASK_RUN_PORT:-5000}"
+elif [ "$1" = "prod" ]; then
+    gunicorn -c gunicorn.conf.py "wsgi:create_app()"
+else
+    flask run
+fi
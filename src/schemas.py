@@ -0,0 +1,93 @@
+# Request bodies for the collection endpoints: what POST (a new item) and
+# PATCH (changes to one) may send for each kind of item, checked before the
+# character is loaded so a bad body costs neither a Redis read nor a
+# pf.Character.
+#
+# Field names are pythfinder's, as in filters.PARAMS. Only the types of
+# known fields are checked; fields pythfinder doesn't have are still left
+# for it to turn away, as before.
+
+import patches
+from properties import PROPERTIES, string, integer, number, boolean, array, list_of, either
+
+# required is what a new item has to have; only equipment and classes
+# need a name, the others can be made from {}
+class Schema:
+    def __init__(self, fields, required = ()):
+        self.fields = fields
+        self.required = required
+
+    # Raises ValueError listing every problem with data; with partial (for
+    # PATCH) nothing is required, but something has to be there
+    def check(self, data, partial = False):
+        if not isinstance(data, dict):
+            raise ValueError("must be an object")
+        errors = []
+        if partial and not data:
+            errors.append("nothing to change")
+        elif not partial:
+            errors.extend("missing '{}'".format(name) for name in self.required if name not in data)
+        for name, value in data.items():
+            validate = self.fields.get(name)
+            if validate is None:
+                continue
+            try:
+                validate(value)
+            except ValueError as err:
+                errors.append("invalid value for '{}': {}".format(name, err))
+        if errors:
+            raise ValueError("; ".join(errors))
+        return data
+
+# feats, traits and specials
+TEXT = {"name": string, "uuid": string, "description": string, "notes": string}
+
+SCHEMAS = {
+    "equipment": Schema({"name": string, "uuid": string, "weight": number, "count": integer, "camp": boolean, "on_person": boolean, "location": string, "notes": string}, required = ("name",)),
+    "abilities": Schema({"name": string, "base": integer, "misc": array}),
+    "saving_throws": Schema({"name": string, "base": integer, "misc": array}),
+    "classes": Schema({"name": string, "archetypes": list_of(string, "strings"), "level": integer}, required = ("name",)),
+    "feats": Schema(TEXT),
+    "traits": Schema(TEXT),
+    "special": Schema(TEXT),
+    "skills": Schema({"name": string, "uuid": string, "rank": integer, "is_class": boolean, "mod": string, "notes": string, "use_untrained": boolean, "misc": array}),
+    "spells": Schema({"name": string, "uuid": string, "level": integer, "description": string, "prepared": integer, "cast": integer}),
+    "armor": Schema({"name": string, "uuid": string, "acBonus": integer, "acPenalty": integer, "maxDexBonus": integer, "arcaneFailureChance": integer, "type": string}),
+    "attacks": Schema({"name": string, "uuid": string, "attack_type": string, "damage_type": either(string, list_of(string, "strings"), what = "a string or a list of strings"), "attack_mod": string, "damage_mod": string, "damage": string, "crit_roll": integer, "crit_multi": integer, "range": integer, "notes": string})
+}
+
+# A whole character, for PUT /character: its simple properties as
+# properties.py has them, and its collections as lists of items (or, for
+# older characters, objects of them by name)
+def check_character(data):
+    if not isinstance(data, dict):
+        raise ValueError("must be an object")
+    errors = []
+    for name, value in data.items():
+        if name in PROPERTIES:
+            try:
+                PROPERTIES[name](value)
+            except ValueError as err:
+                errors.append("invalid value for '{}': {}".format(name, err))
+        elif name in SCHEMAS:
+            if isinstance(value, dict):
+                # items of older characters are named by their keys
+                value = [dict(item, name = key) if isinstance(item, dict) else item for key, item in value.items()]
+            if not isinstance(value, list):
+                errors.append("invalid value for '{}': must be a list".format(name))
+                continue
+            for item in value:
+                try:
+                    SCHEMAS[name].check(item)
+                except ValueError as err:
+                    errors.append("invalid item in '{}': {}".format(name, err))
+    if errors:
+        raise ValueError("; ".join(errors))
+    return data
+
+# Raises ValueError saying what's wrong with a body for section ("character"
+# for the whole thing, or with partial, a JSON patch to it)
+def check(section, data, partial = False):
+    if section == "character":
+        return patches.check(data) if partial else check_character(data)
+    return SCHEMAS[section].check(data, partial)
@@ -0,0 +1,545 @@
+# Field-level Redis storage for characters
+#
+# A character with session id <id> is kept in these keys:
+#
+#   <id>:version       save counter, bumped on every write
+#   <id>:fields        hash of top-level property -> value
+#   <id>:<collection>  hash of uuid -> item, plus ORDER -> list of uuids, for
+#                      each of COLLECTIONS
+#   <id>:derived       hash of derived stat -> value (see derived.py), plus
+#                      COMPLETE once it has all of them
+#   <id>:changes       stream of the last CHANGES_MAX writes' JSON patches,
+#                      each with the version it made as its id (<version>-0)
+#                      and published to the channel of the same name
+#
+# and each user's characters are listed, oldest first, in
+#
+#   user:<user>:characters  sorted set of character ids by creation time
+#
+# which writes to any of them keep alive for as long as the characters.
+#
+# Values are encoded with the store's ValueFormat (see formats.py).
+# Sections named in COLLECTIONS that aren't a list of items with uuids are
+# kept whole in <id>:fields like any other property. Characters stored in the
+# old format (one JSON string at <id>) are converted the first time they're
+# loaded.
+
+import codec
+import formats
+from time import time
+
+COLLECTIONS = ("equipment", "feats", "traits", "special", "skills", "spells", "armor", "attacks", "classes")
+ORDER = "_order"
+MISSING = object()
+UNCHANGED = object() # load() result for a character still at the version the caller has
+MAX_OP_ARGS = 1000 # keeps each command's argument list well inside Lua's stack limit; even, so field/value pairs aren't split
+CHANGES_MAX = 100 # writes kept in each character's change log (roughly; trimmed with ~)
+
+COMPLETE = "_complete"
+DERIVED = 4 + len(COLLECTIONS) # index of <id>:derived in a write's keys
+CHANGES = DERIVED + 1 # and of <id>:changes
+
+# Writes a list of HSET/HDEL/DEL ops and bumps the version, optionally only
+# if the version is still the expected one; returns the new version, or -1
+# on conflict. The write's JSON patch is added to the change log and
+# published as "<version> <patch>". Every key of the character gets its TTL
+# refreshed.
+# KEYS: version, fields, legacy, collections..., derived, changes, then any
+#       other keys to refresh
+# ARGV: expected version ("" to skip the check), ttl, "1" to write nothing
+#       and return -2 if there's an old-format blob ("" otherwise), patch
+#       ("" if the character was replaced outright), then for each op:
+#       command, key index, argument count, arguments...
+WRITE_SCRIPT = """
+if ARGV[1] ~= "" and tonumber(redis.call("GET", KEYS[1]) or "0") ~= tonumber(ARGV[1]) then
+    return -1
+end
+if ARGV[3] ~= "" and redis.call("EXISTS", KEYS[3]) == 1 then
+    return -2
+end
+local i = 5
+while i <= #ARGV do
+    local n = tonumber(ARGV[i + 2])
+    redis.call(ARGV[i], KEYS[tonumber(ARGV[i + 1])], unpack(ARGV, i + 3, i + 2 + n))
+    i = i + 3 + n
+end
+local version = redis.call("INCR", KEYS[1])
+-- pcall: a log left behind by a deleted version counter can't fail the write
+redis.pcall("XADD", KEYS[%(changes)d], "MAXLEN", "~", %(changes_max)d, version .. "-0", "patch", ARGV[4])
+redis.call("PUBLISH", KEYS[%(changes)d], version .. " " .. ARGV[4])
+for k = 1, #KEYS do
+    redis.call("EXPIRE", KEYS[k], ARGV[2])
+end
+return version
+""" % {"changes": CHANGES, "changes_max": CHANGES_MAX}
+
+# Replaces a character's derived stats, if it's still at the version they
+# were worked out from. Stats are set MAX_OP_ARGS arguments at a time, as
+# WRITE_SCRIPT's ops are.
+# KEYS: version, derived; ARGV: version, ttl, then stat, value, ...
+DERIVED_SCRIPT = """
+if tonumber(redis.call("GET", KEYS[1]) or "0") ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call("DEL", KEYS[2])
+for i = 3, #ARGV, %(max_op_args)d do
+    redis.call("HSET", KEYS[2], unpack(ARGV, i, math.min(i + %(max_op_args)d - 1, #ARGV)))
+end
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+return 1
+""" % {"max_op_args": MAX_OP_ARGS}
+
+# Reads a whole character in one round trip, or just its version if that's
+# the version given (the caller already has that character).
+# KEYS: as WRITE_SCRIPT; ARGV: version the caller has, or ""
+# Returns {version} or {version, fields, legacy, collections...}
+LOAD_SCRIPT = """
+local version = tonumber(redis.call("GET", KEYS[1]) or "0")
+if ARGV[1] ~= "" and version == tonumber(ARGV[1]) then
+    return {version}
+end
+local out = {version, redis.call("HGETALL", KEYS[2]), redis.call("GET", KEYS[3])}
+for k = 4, #KEYS do
+    out[k] = redis.call("HGETALL", KEYS[k])
+end
+return out
+"""
+
+def is_collection(value):
+    return isinstance(value, list) and all(isinstance(item, dict) and "uuid" in item for item in value)
+
+# Splits a character document into the values stored in each hash. The
+# result doubles as a snapshot of what's in Redis, which write() diffs
+# against so only changed fields and items get written.
+def encode(doc, dumps):
+    fields = {}
+    collections = {}
+    for name, value in doc.items():
+        if name in COLLECTIONS and is_collection(value):
+            items = {item["uuid"]: dumps(item) for item in value}
+            items[ORDER] = dumps([item["uuid"] for item in value])
+            collections[name] = items
+        else:
+            fields[name] = dumps(value)
+    return fields, collections
+
+# uuids of a collection hash in list order; items missing from the order
+# go last
+def item_order(items):
+    order = formats.loads(items[ORDER]) if ORDER in items else []
+    listed = set(order)
+    return [uuid for uuid in order if uuid in items] + [uuid for uuid in items if uuid != ORDER and uuid not in listed]
+
+def decode_items(items):
+    return [formats.loads(items[uuid]) for uuid in item_order(items)]
+
+def decode_section(snapshot, name):
+    fields, collections = snapshot
+    if name in fields:
+        return formats.loads(fields[name])
+    if collections.get(name):
+        return decode_items(collections[name])
+    return MISSING
+
+# The sections of a snapshot as one JSON object, in chunks of about
+# chunk_size bytes, without decoding more than one value at a time.
+# Sections missing from the snapshot are written from defaults.
+def iter_json(snapshot, defaults, chunk_size = 64*1024):
+    fields, collections = snapshot
+    out = bytearray(b"{")
+    for i, name in enumerate(defaults):
+        out += b"," if i else b""
+        out += codec.dumps(name).encode() + b":"
+        if name in fields:
+            out += formats.json_bytes(fields[name])
+        elif collections.get(name):
+            out += b"["
+            for j, uuid in enumerate(item_order(collections[name])):
+                out += b"," if j else b""
+                out += formats.json_bytes(collections[name][uuid])
+                if len(out) >= chunk_size:
+                    yield bytes(out)
+                    out.clear()
+            out += b"]"
+        else:
+            out += codec.dumps(defaults[name]).encode()
+        if len(out) >= chunk_size:
+            yield bytes(out)
+            out.clear()
+    out += b"}"
+    yield bytes(out)
+
+# Parts of a snapshot covering only the given sections (all if None)
+def restrict(snapshot, sections):
+    fields, collections = snapshot
+    if sections is None:
+        return snapshot
+    return {k: v for k, v in fields.items() if k in sections}, {k: v for k, v in collections.items() if k in sections}
+
+# Snapshot with the given sections replaced by the ones in new
+def merge(snapshot, new, sections):
+    if snapshot is None or sections is None:
+        return new
+    fields, collections = snapshot
+    return (
+        {**{k: v for k, v in fields.items() if k not in sections}, **new[0]},
+        {**{k: v for k, v in collections.items() if k not in sections}, **new[1]}
+    )
+
+# The JSON patch (RFC 6902) taking a character's document from one
+# snapshot's version of some sections to another's. Changed items are
+# replaced by index; items added at the end or removed without reordering
+# are added or removed, and a collection changed any other way is replaced
+# whole.
+def json_patch(new, old):
+    fields, collections = new
+    old_fields, old_collections = old
+    patch = []
+    for name, raw in fields.items():
+        if old_fields.get(name) != raw:
+            patch.append({"op": "replace", "path": "/" + name, "value": formats.loads(raw)})
+    for name in old_fields:
+        if name not in fields and name not in collections:
+            patch.append({"op": "remove", "path": "/" + name})
+    for name in COLLECTIONS:
+        items = collections.get(name, {})
+        old_items = old_collections.get(name, {})
+        if items != old_items and name not in fields:
+            patch += collection_patch(name, items, old_items)
+    return patch
+
+def collection_patch(name, items, old_items):
+    order = item_order(items)
+    old_order = item_order(old_items) if old_items else []
+    kept = [uuid for uuid in old_order if uuid in items]
+    if not old_items or (order != old_order and order[:len(old_order)] != old_order and order != kept):
+        return [{"op": "replace", "path": "/" + name, "value": decode_items(items)}]
+    patch = []
+    if order == kept and kept != old_order:
+        # removals, last first so earlier indexes still hold
+        for i in reversed(range(len(old_order))):
+            if old_order[i] not in items:
+                patch.append({"op": "remove", "path": "/{}/{}".format(name, i)})
+    for i, uuid in enumerate(order):
+        if uuid not in old_items:
+            patch.append({"op": "add", "path": "/{}/-".format(name), "value": formats.loads(items[uuid])})
+        elif old_items[uuid] != items[uuid]:
+            patch.append({"op": "replace", "path": "/{}/{}".format(name, i), "value": formats.loads(items[uuid])})
+    return patch
+
+def snapshot_size(snapshot):
+    fields, collections = snapshot
+    return sum(map(len, fields.values())) + sum(len(raw) for items in collections.values() for raw in items.values())
+
+# changes()'s result from the version and the log's entries after since
+def decode_changes(since, version, entries):
+    version = int(version or 0)
+    out = [(int(id.split(b"-")[0]), fields[b"patch"].decode() or None) for id, fields in entries]
+    if since != version and (not out or out[0][0] != since + 1):
+        return version, None
+    return version, out
+
+def decode_keys(h):
+    return {k.decode(): v for k, v in h.items()}
+
+# HGETALL's reply as returned from a script: a flat list of keys and values
+def decode_pairs(flat):
+    return {flat[i].decode(): flat[i + 1] for i in range(0, len(flat), 2)}
+
+class CharacterStore:
+    # r must be a client without decode_responses, since values can be
+    # binary. derived (a derived.DerivedStats) keeps derived stats up to
+    # date with every write.
+    def __init__(self, r, ttl, format = None, derived = None):
+        self.r = r
+        self.ttl = ttl
+        self.format = format or formats.ValueFormat()
+        self.derived = derived
+        self.write_script = r.register_script(WRITE_SCRIPT)
+        self.load_script = r.register_script(LOAD_SCRIPT)
+        self.derived_script = r.register_script(DERIVED_SCRIPT)
+
+    def encode(self, doc):
+        return encode(doc, self.format.dumps)
+
+    def keys(self, id):
+        return ["{}:version".format(id), "{}:fields".format(id), id] + ["{}:{}".format(id, name) for name in COLLECTIONS]
+
+    def index_key(self, user):
+        return "user:{}:characters".format(user)
+
+    def derived_key(self, id):
+        return "{}:derived".format(id)
+
+    # also the channel each write is published to
+    def changes_key(self, id):
+        return "{}:changes".format(id)
+
+    # keys a write refreshes: the character's, its derived stats and
+    # change log (at DERIVED and CHANGES), and its owner's index
+    def write_keys(self, id, owner):
+        return self.keys(id) + [self.derived_key(id), self.changes_key(id)] + ([self.index_key(owner)] if owner else [])
+
+    def version(self, id):
+        return int(self.r.get(self.keys(id)[0]) or 0)
+
+    # Returns (version, snapshot); snapshot is None for unknown ids, and
+    # UNCHANGED if the version is unless_version. Old-format characters are
+    # converted in Redis unless migrate is False.
+    def load(self, id, migrate = True, unless_version = None):
+        reply = self.load_script(keys = self.keys(id), args = ["" if unless_version is None else unless_version])
+        version, snapshot, legacy = self.decode_load(reply)
+        if not legacy or not migrate:
+            return version, snapshot
+        new_version = self.write(id, version, snapshot, None, drop_legacy = True)
+        if new_version < 0:
+            return self.load(id)
+        return new_version, snapshot
+
+    # LOAD_SCRIPT's reply as (version, snapshot, whether the character is
+    # in the old format)
+    def decode_load(self, reply):
+        version = int(reply[0])
+        if len(reply) == 1:
+            return version, UNCHANGED, False
+        fields, legacy, items = reply[1], reply[2], reply[3:]
+        if fields:
+            return version, (decode_pairs(fields), {name: decode_pairs(i) for name, i in zip(COLLECTIONS, items) if i}), False
+        if legacy:
+            return version, self.encode(codec.loads(legacy)), True
+        return version, None, False
+
+    # Writes whatever differs between two snapshots, looking only at the
+    # given sections if any; with no old snapshot the character is replaced
+    # outright. Returns the new version, or -1 if expected_version is given
+    # and no longer current.
+    def write(self, id, expected_version, snapshot, old_snapshot, sections = None, drop_legacy = False, owner = None):
+        args = self.write_args(expected_version, snapshot, old_snapshot, sections, drop_legacy)
+        if args is None:
+            return expected_version
+        return self.write_script(keys = self.write_keys(id, owner), args = args)
+
+    # WRITE_SCRIPT's arguments for write(), or None if nothing differs
+    def write_args(self, expected_version, snapshot, old_snapshot, sections = None, drop_legacy = False):
+        fields, collections = restrict(snapshot, sections)
+        old_fields, old_collections = restrict(old_snapshot, sections) if old_snapshot else ({}, {})
+        ops = []
+        if old_snapshot is None:
+            ops += [("DEL", 2)] + [("DEL", 4 + i) for i in range(len(COLLECTIONS))]
+        if drop_legacy:
+            ops.append(("DEL", 3))
+        ops += self.hash_ops(2, fields, old_fields)
+        for i, name in enumerate(COLLECTIONS):
+            items = collections.get(name, {})
+            old_items = old_collections.get(name, {})
+            if old_items and not items:
+                ops.append(("DEL", 4 + i))
+            else:
+                ops += self.hash_ops(4 + i, items, old_items)
+        if not ops and old_snapshot is not None:
+            return None
+        if self.derived is not None:
+            ops += self.derived_ops(snapshot, old_snapshot, sections)
+        # a character replaced outright is logged without a patch
+        patch = "" if old_snapshot is None else codec.dumps(json_patch((fields, collections), (old_fields, old_collections)))
+        args = ["" if expected_version is None else expected_version, self.ttl, "", patch]
+        for op, key, *op_args in ops:
+            args += [op, key, len(op_args)] + op_args
+        return args
+
+    # Ops bringing the derived stats in line with a write: just the ones the
+    # write changes, or all of them for a character replaced outright
+    def derived_ops(self, snapshot, old_snapshot, sections):
+        if old_snapshot is None:
+            stats = {name: self.format.dumps(stat) for name, stat in self.derived.compute(snapshot).items()}
+            stats[COMPLETE] = "1"
+            return [("DEL", DERIVED)] + self.hash_ops(DERIVED, stats, {})
+        stats, removed = self.derived.changes(old_snapshot, merge(old_snapshot, snapshot, sections))
+        return self.hash_ops(DERIVED, {name: self.format.dumps(stat) for name, stat in stats.items()}, dict.fromkeys(removed, ""))
+
+    def hash_ops(self, key, new, old):
+        changed = [x for name, raw in new.items() if old.get(name) != raw for x in (name, raw)]
+        removed = [name for name in old if name not in new]
+        return [("HSET", key, *changed[i:i + MAX_OP_ARGS]) for i in range(0, len(changed), MAX_OP_ARGS)] + \
+            [("HDEL", key, *removed[i:i + MAX_OP_ARGS]) for i in range(0, len(removed), MAX_OP_ARGS)]
+
+    def touch(self, id, owner = None):
+        pipe = self.r.pipeline(transaction = False)
+        for key in self.write_keys(id, owner):
+            pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    # Field access for the simple property endpoints; these never
+    # hydrate the character, and take one round trip. Characters still in
+    # the old format are converted first so the field isn't written next
+    # to a stale blob.
+
+    # Returns (version, value); the version is read first, so it's never
+    # newer than the value
+    def get_field(self, id, name, default = None):
+        keys = self.keys(id)
+        pipe = self.r.pipeline(transaction = False)
+        pipe.get(keys[0])
+        pipe.hget(keys[1], name)
+        pipe.exists(keys[2])
+        version, raw, legacy = pipe.execute()
+        if legacy:
+            version, snapshot = self.load(id)
+            raw = snapshot[0].get(name)
+        return int(version or 0), default if raw is None else formats.loads(raw)
+
+    # Sets top-level fields in one write; returns the new version, or -1 if
+    # expected_version is given and no longer current
+    def set_fields(self, id, values, expected_version = None, owner = None):
+        patch = codec.dumps([{"op": "replace", "path": "/" + name, "value": value} for name, value in values.items()])
+        args = ["" if expected_version is None else expected_version, self.ttl, "1", patch]
+        ops = self.hash_ops(2, {name: self.format.dumps(value) for name, value in values.items()}, {})
+        if self.derived is not None and self.derived.depends_on(values):
+            # worked out again the next time they're read
+            ops.append(("DEL", DERIVED))
+        for op, key, *op_args in ops:
+            args += [op, key, len(op_args)] + op_args
+        version = self.write_script(keys = self.write_keys(id, owner), args = args)
+        if version == -2:
+            self.load(id)
+            version = self.set_fields(id, values, expected_version, owner)
+        return version
+
+    # Returns (version, derived stats by name); read in one round trip
+    # unless they have to be worked out again
+    def get_derived(self, id):
+        pipe = self.r.pipeline(transaction = False)
+        pipe.get(self.keys(id)[0])
+        pipe.hgetall(self.derived_key(id))
+        version, stats = pipe.execute()
+        if COMPLETE.encode() in stats:
+            return int(version or 0), {name.decode(): formats.loads(raw) for name, raw in stats.items() if name != COMPLETE.encode()}
+        version, snapshot = self.load(id)
+        stats = self.derived.compute(snapshot)
+        if snapshot is not None:
+            args = [version, self.ttl, COMPLETE, "1"]
+            for name, stat in stats.items():
+                args += [name, self.format.dumps(stat)]
+            self.derived_script(keys = [self.keys(id)[0], self.derived_key(id)], args = args)
+        return version, stats
+
+    # Returns (version, [(version, patch), ...]) for the writes after
+    # version since, oldest first, with None for the patch of a write that
+    # replaced the character outright. The list is None if the log doesn't
+    # go back that far.
+    def changes(self, id, since):
+        pipe = self.r.pipeline(transaction = False)
+        pipe.get(self.keys(id)[0])
+        pipe.xrange(self.changes_key(id), min = "{}-0".format(since + 1), count = CHANGES_MAX)
+        return decode_changes(since, *pipe.execute())
+
+    # Returns (version, item), as get_field
+    def get_item(self, id, collection, uuid):
+        keys = self.keys(id)
+        pipe = self.r.pipeline(transaction = False)
+        pipe.get(keys[0])
+        pipe.hget("{}:{}".format(id, collection), uuid)
+        pipe.exists(keys[2])
+        version, raw, legacy = pipe.execute()
+        if legacy:
+            version, snapshot = self.load(id)
+            raw = snapshot[1].get(collection, {}).get(uuid)
+        return int(version or 0), None if raw is None else formats.loads(raw)
+
+    # Character index for multi-character accounts
+
+    def add_character(self, user, id):
+        pipe = self.r.pipeline()
+        pipe.zadd(self.index_key(user), {id: time()}, nx = True)
+        pipe.expire(self.index_key(user), self.ttl)
+        pipe.execute()
+
+    def characters(self, user):
+        return [id.decode() for id in self.r.zrange(self.index_key(user), 0, -1)]
+
+    def delete_character(self, user, id):
+        pipe = self.r.pipeline()
+        pipe.zrem(self.index_key(user), id)
+        pipe.delete(*self.keys(id), self.derived_key(id), self.changes_key(id))
+        pipe.execute()
+
+    # The named top-level fields of many characters, read in one round
+    # trip without loading them, which also refreshes their TTLs as a write
+    # does. Fields a character doesn't have are taken from defaults.
+    #
+    # A character whose keys are gone is None if it was added to owner's
+    # index more than a TTL ago: it was saved and has expired since, or was
+    # never saved at all. Newer ones are blank characters not saved yet.
+    def summaries(self, ids, names, defaults, owner):
+        collections = [name for name in names if name in COLLECTIONS]
+        pipe = self.r.pipeline(transaction = False)
+        for id in ids:
+            keys = self.keys(id)
+            pipe.exists(keys[0])
+            pipe.zscore(self.index_key(owner), id)
+            pipe.exists(keys[2])
+            pipe.hmget(keys[1], names)
+            for name in collections:
+                pipe.hgetall(keys[3 + COLLECTIONS.index(name)])
+            for key in self.write_keys(id, None):
+                pipe.expire(key, self.ttl)
+        results = iter(pipe.execute())
+        out = []
+        for id in ids:
+            saved = next(results)
+            added = next(results)
+            legacy = next(results)
+            fields = dict(zip(names, next(results)))
+            items = {name: decode_keys(next(results)) for name in collections}
+            for key in self.write_keys(id, None):
+                next(results)
+            if not saved and not legacy and (added or 0) + self.ttl <= time():
+                out.append(None)
+                continue
+            if legacy:
+                # not converted yet; load() does that
+                fields, items = self.load(id)[1]
+            snapshot = ({name: raw for name, raw in fields.items() if raw is not None}, items)
+            summary = {}
+            for name in names:
+                value = decode_section(snapshot, name)
+                summary[name] = defaults.get(name) if value is MISSING else value
+            out.append(summary)
+        return out
+
+# The parts of CharacterStore the async server (asgi.py) needs, over a
+# redis.asyncio client. Keys, encoding and scripts are the given store's.
+class AsyncCharacterStore:
+    def __init__(self, store, r):
+        self.store = store
+        self.r = r
+        self.write_script = r.register_script(WRITE_SCRIPT)
+        self.load_script = r.register_script(LOAD_SCRIPT)
+
+    async def load(self, id, migrate = True, unless_version = None):
+        reply = await self.load_script(keys = self.store.keys(id), args = ["" if unless_version is None else unless_version])
+        version, snapshot, legacy = self.store.decode_load(reply)
+        if not legacy or not migrate:
+            return version, snapshot
+        new_version = await self.write(id, version, snapshot, None, drop_legacy = True)
+        if new_version < 0:
+            return await self.load(id)
+        return new_version, snapshot
+
+    async def write(self, id, expected_version, snapshot, old_snapshot, sections = None, drop_legacy = False, owner = None):
+        args = self.store.write_args(expected_version, snapshot, old_snapshot, sections, drop_legacy)
+        if args is None:
+            return expected_version
+        return await self.write_script(keys = self.store.write_keys(id, owner), args = args)
+
+    async def touch(self, id, owner = None):
+        pipe = self.r.pipeline(transaction = False)
+        for key in self.store.write_keys(id, owner):
+            pipe.expire(key, self.store.ttl)
+        await pipe.execute()
+
+    async def changes(self, id, since):
+        pipe = self.r.pipeline(transaction = False)
+        pipe.get(self.store.keys(id)[0])
+        pipe.xrange(self.store.changes_key(id), min = "{}-0".format(since + 1), count = CHANGES_MAX)
+        return decode_changes(since, *await pipe.execute())
@@ -0,0 +1,72 @@
+# Dirty tracking for the character held in g.c
+#
+# Attribute assignment and any add_*/delete_*/update_* call on the wrapped
+# pf.Character marks it dirty. Changes made through objects returned by the
+# get_* methods (item.update(), etc.) can't be seen from here, so handlers
+# doing those call mark_dirty() themselves.
+#
+# The wrapped character is a LazyCharacter: each attribute access hydrates
+# just the sections it needs and records its own section in touched, so a
+# save only has to serialize what this request could have changed. The
+# sections a section is built from (lazy.DEPENDS) are hydrated with it but
+# not recorded, since changing them goes through their own attributes. Given a load
+# function instead of a character, nothing is loaded at all until g.c is
+# first used.
+#
+# find() looks items up by uuid or name through indexes kept on the
+# LazyCharacter, so they last as long as it stays in the cache.
+
+from lazy import section_for, sections_for
+
+MUTATOR_PREFIXES = ("add_", "delete_", "update_")
+
+class TrackedCharacter:
+    def __init__(self, character = None, load = None, dirty = False):
+        object.__setattr__(self, "_character", character)
+        object.__setattr__(self, "_load", load)
+        object.__setattr__(self, "dirty", dirty)
+        # sections used by this request; None once everything has been
+        object.__setattr__(self, "touched", set())
+
+    @property
+    def loaded(self):
+        return self._character is not None
+
+    @property
+    def character(self):
+        if self._character is None:
+            object.__setattr__(self, "_character", self._load())
+        return self._character
+
+    def mark_dirty(self):
+        object.__setattr__(self, "dirty", True)
+
+    def hydrate(self, name):
+        sections = sections_for(name)
+        if sections is None or self.touched is None:
+            object.__setattr__(self, "touched", None)
+        else:
+            self.touched.add(section_for(name))
+        return self.character.hydrate(sections)
+
+    # Indexed lookup of a section's items by uuid or name, e.g.
+    # find("spells", uuid = uuid); returns a list like get_spells() does
+    def find(self, section, **kwargs):
+        (key, value), = kwargs.items()
+        self.hydrate(section)
+        return self.character.find(section, key, value)
+
+    def __getattr__(self, name):
+        attr = getattr(self.hydrate(name), name)
+        if name.startswith(MUTATOR_PREFIXES) and callable(attr):
+            def mutator(*args, **kwargs):
+                self.mark_dirty()
+                result = attr(*args, **kwargs)
+                self.character.changed(name, args, result)
+                return result
+            return mutator
+        return attr
+
+    def __setattr__(self, name, value):
+        setattr(self.hydrate(name), name, value)
+        self.mark_dirty()
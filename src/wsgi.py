@@ -0,0 +1,26 @@
+#!/bin/python3
+
+# Production WSGI entry point, for gunicorn with gunicorn.conf.py (see
+# run.sh): the app is built once in the master process, before the workers
+# are forked, and each worker calls warm() once it's running.
+
+import importlib
+
+def create_app(config = None):
+    app = importlib.import_module("pf-flask").create_app(config)
+    # the Redis client (but no connection yet) is made here too, so redis
+    # is imported in the master and shared with the workers
+    app.extensions["pythfinder"].connect()
+    return app
+
+# Opens this worker's first Redis connections and makes sure the server
+# has the store's scripts, so no request pays for either. Connections
+# can't be opened before the fork, since the workers would share them.
+def warm(app, connections = 1):
+    state = app.extensions["pythfinder"]
+    store = state.connect()
+    opened = [state.pool.get_connection() for _ in range(min(connections, app.config["REDIS_MAX_CONNECTIONS"]))]
+    for connection in opened:
+        state.pool.release(connection)
+    for script in (store.write_script, store.load_script, store.derived_script):
+        state.r.script_load(script.script)
@@ -0,0 +1,23 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import metrics
+
+# The app against a fakeredis server of its own
+@pytest.fixture
+def app():
+    fakeredis = pytest.importorskip("fakeredis")
+    from redis import BlockingConnectionPool
+    pf_flask = importlib.import_module("pf-flask")
+    app = pf_flask.create_app({"CORS_ORIGIN": ""})
+    app.extensions["pythfinder"].pool = BlockingConnectionPool(
+        connection_class = metrics.counting(fakeredis.FakeRedisConnection),
+        server = fakeredis.FakeServer(),
+        max_connections = app.config["REDIS_MAX_CONNECTIONS"]
+    )
+    return app
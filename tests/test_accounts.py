@@ -0,0 +1,57 @@
+# A new character's body is checked like PUT /character's
+def test_new_character_body_is_checked(app):
+    client = app.test_client()
+    response = client.post("/api/v0/characters", json = {"name": 5, "equipment": [{"weight": 1}]})
+    assert response.status_code == 400
+    assert "invalid character data" in response.get_json()["message"]
+    assert client.post("/api/v0/characters", json = []).status_code == 400
+
+def test_new_character(app):
+    client = app.test_client()
+    assert client.post("/api/v0/characters").status_code == 201
+    response = client.post("/api/v0/characters", json = {"name": "Sam", "equipment": [{"name": "rope"}]})
+    assert response.status_code == 201
+    assert client.get("/api/v0/character/name").get_json()["data"] == {"name": "Sam"}
+
+def characters(client):
+    return client.get("/api/v0/characters").get_json()["data"]
+
+# Listing a party keeps all of it as long as the index listing it
+def test_listing_refreshes_characters(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    first = characters(client)[0]["id"]
+    client.post("/api/v0/characters", json = {"name": "Max"})
+    state = app.extensions["pythfinder"]
+    for key in state.store.keys(first):
+        state.r.expire(key, 10)
+    assert [c["name"] for c in characters(client)] == ["Sam", "Max"]
+    assert state.r.ttl("{}:version".format(first)) > 10
+
+# Characters whose keys have expired are dropped, not listed as blank;
+# new ones that haven't been saved yet still are
+def test_expired_characters_are_dropped(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    first = characters(client)[0]["id"]
+    client.post("/api/v0/characters", json = {"name": "Max"})
+    client.post("/api/v0/characters")
+    state = app.extensions["pythfinder"]
+    with client.session_transaction() as session:
+        user = session["user"]
+    state.r.delete(*state.store.keys(first))
+    state.r.zadd(state.store.index_key(user), {first: 1})
+    assert [c["name"] for c in characters(client)] == ["Max", ""]
+    assert first not in state.store.characters(user)
+    assert client.get("/api/v0/characters/" + first).status_code == 404
+
+# Reading the account doesn't give a client a session; adding to it does
+def test_reads_start_no_session(app):
+    client = app.test_client()
+    assert client.get("/api/v0/characters").get_json()["data"] == []
+    assert client.get("/api/v0/characters/active").get_json()["data"] == {"id": None}
+    assert client.get("/api/v0/characters/x").status_code == 404
+    assert app.extensions["pythfinder"].connect().r.keys("user:*") == []
+    assert client.get_cookie("session") is None
+    client.post("/api/v0/characters")
+    assert len(characters(client)) == 2
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("redis.asyncio")
+import asgi
+from redis.exceptions import ConnectionError
+
+def scope(headers):
+    return {"type": "http", "method": "POST", "path": "/api/v0/character/equipment", "query_string": b"", "headers": headers}
+
+# A chunked body has no Content-Length header; the app still sees all of it
+def test_chunked_body_is_read():
+    environ = asgi.make_environ(scope([(b"content-type", b"application/json"), (b"transfer-encoding", b"chunked")]), b'{"name":"rope"}')
+    assert asgi.flask_app.request_class(environ).get_json() == {"name": "rope"}
+
+def test_content_length_is_the_body_read():
+    environ = asgi.make_environ(scope([(b"content-type", b"application/json"), (b"content-length", b"999")]), b'{"name":"rope"}')
+    assert environ["CONTENT_LENGTH"] == "15"
+
+# First in a script, makes subscribe fail, leaving the pub/sub without a
+# connection as redis does
+FAILED_SUBSCRIBE = object()
+
+# A pub/sub connection that plays back the given results of get_message
+class ScriptedPubSub:
+    def __init__(self, script):
+        self.script = script
+        self.channels = set()
+
+    async def subscribe(self, *channels):
+        if self.script[:1] == [FAILED_SUBSCRIBE]:
+            raise ConnectionError("refused")
+        self.channels.update(channels)
+
+    async def unsubscribe(self, channel):
+        self.channels.discard(channel)
+
+    async def get_message(self, ignore_subscribe_messages, timeout):
+        await asyncio.sleep(0)
+        if self.script[:1] == [FAILED_SUBSCRIBE]:
+            raise RuntimeError("pubsub connection not set")
+        if not self.script:
+            return None
+        result = self.script.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def aclose(self):
+        pass
+
+class ScriptedRedis:
+    def __init__(self, *scripts):
+        self.connections = [ScriptedPubSub(script) for script in scripts]
+        self.made = []
+
+    def pubsub(self):
+        self.made.append(self.connections[len(self.made)])
+        return self.made[-1]
+
+# A lost connection, or one never made, is replaced and resubscribed, and
+# streams are told they may have missed writes
+@pytest.mark.parametrize("failure", [ConnectionError("gone"), FAILED_SUBSCRIBE])
+def test_change_feed_reconnects(monkeypatch, failure):
+    monkeypatch.setattr(asgi, "FEED_RECONNECT", 0)
+    r = ScriptedRedis([failure], [{"channel": b"c:changes", "data": b'5 [{"op":"remove","path":"/x"}]'}])
+    feed = asgi.ChangeFeed(r)
+
+    async def follow():
+        queue = await feed.subscribe("c:changes")
+        received = [await asyncio.wait_for(queue.get(), 1), await asyncio.wait_for(queue.get(), 1)]
+        await feed.close()
+        return received
+
+    assert asyncio.run(follow()) == [asgi.GAP, (5, '[{"op":"remove","path":"/x"}]')]
+    assert r.made[1].channels == {"c:changes"}
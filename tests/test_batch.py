@@ -0,0 +1,12 @@
+# The change log only holds saved changes, so batches can't read it
+def test_change_logs_are_not_batched(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    for path in ("/character/changes", "/character/patches?since=0"):
+        response = client.post("/api/v0/batch", json = [
+            {"method": "PUT", "path": "/character/name", "body": {"name": "Max"}},
+            {"method": "GET", "path": path}
+        ])
+        assert response.status_code == 400
+        assert "can't be batched" in response.get_json()["data"][-1]["message"]
+    assert client.get("/api/v0/character/name").get_json()["data"] == {"name": "Sam"}
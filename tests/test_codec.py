@@ -0,0 +1,12 @@
+import json
+
+import pytest
+
+import codec
+
+VALUES = [1e16, 1e-7, 0.00001, 1.5, -2e22, [1e16], {"gold": 1e-7}, {"a": [1, 2.5, 1e300]}, "1e16"]
+
+# Whichever backend is in use, output is what the standard library gives
+@pytest.mark.parametrize("value", VALUES, ids = repr)
+def test_dumps_matches_json(value):
+    assert codec.dumps(value) == json.dumps(value, separators = (",", ":"), ensure_ascii = False)
@@ -0,0 +1,37 @@
+import threading
+
+WRITERS = 60
+MAX_CONFLICT_RATE = 0.05
+
+def session_cookie(client):
+    return client.get_cookie("session").value
+
+# Parallel POSTs to one session's equipment: every one that succeeded is
+# in the stored character, and few lose all their save attempts
+def test_parallel_writes_are_not_lost(app):
+    first = app.test_client()
+    assert first.put("/api/v0/character/name", json = {"name": "Sam"}).status_code == 200
+    cookie = session_cookie(first)
+    start = threading.Barrier(WRITERS)
+    results = [None] * WRITERS
+
+    def post(n):
+        client = app.test_client()
+        client.set_cookie("session", cookie)
+        start.wait()
+        response = client.post("/api/v0/character/equipment", json = {"name": "item {}".format(n)})
+        results[n] = (response.status_code, response.get_json())
+
+    threads = [threading.Thread(target = post, args = (n,)) for n in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    statuses = [status for status, _ in results]
+    assert set(statuses) <= {201, 409}
+    saved = {body["data"]["uuid"] for status, body in results if status == 201}
+    stored = first.get("/api/v0/character/equipment").get_json()["data"]
+    assert saved <= {item["uuid"] for item in stored}
+    assert len(stored) == len(saved)
+    assert statuses.count(409) <= WRITERS * MAX_CONFLICT_RATE
@@ -0,0 +1,30 @@
+SKILLS = 4100 # stats and values past Lua's unpack limit (8000)
+
+def skills(n):
+    return [{"name": "Skill {}".format(i), "uuid": "skill-{}".format(i), "rank": 1, "mod": "dex"} for i in range(n)]
+
+# Stats worked out on a read are stored in chunks, however many there are
+def test_derived_stats_of_large_character_are_stored(app):
+    client = app.test_client()
+    assert client.put("/api/v0/character", json = {"skills": skills(SKILLS)}).status_code == 204
+    with app.app_context():
+        state = app.extensions["pythfinder"]
+        id = next(key for key in state.r.keys("*:derived")).decode().split(":")[0]
+        state.r.delete(state.store.derived_key(id))
+        version, stats = state.store.get_derived(id)
+        stored = state.r.hlen(state.store.derived_key(id))
+    assert len(stats) == SKILLS + 6 + 3
+    # plus the mark that they're complete
+    assert stored == len(stats) + 1
+
+# Items sharing a name each keep their own stats
+def test_derived_stats_of_same_named_items(app):
+    client = app.test_client()
+    attack = {"name": "Dagger", "attack_mod": "str", "damage_mod": "str"}
+    client.post("/api/v0/character/attacks", json = attack)
+    client.post("/api/v0/character/attacks", json = {**attack, "attack_mod": "dex"})
+    client.patch("/api/v0/character/abilities/dex", json = {"base": 16})
+    attacks = client.get("/api/v0/character/derived").get_json()["data"]["attacks"]
+    assert len(attacks) == 2
+    assert len({stat["uuid"] for stat in attacks}) == 2
+    assert sorted(stat["attack_bonus"] for stat in attacks) == [0, 3]
@@ -0,0 +1,49 @@
+# A matching If-None-Match is answered from the version alone
+def test_not_modified(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    tag = client.get("/api/v0/character").headers["ETag"]
+    response = client.get("/api/v0/character", headers = {"If-None-Match": tag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert int(response.headers["X-Redis-Round-Trips"]) <= 1
+
+def test_etag_changes_after_a_write(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    tag = client.get("/api/v0/character").headers["ETag"]
+    client.post("/api/v0/character/equipment", json = {"name": "rope"})
+    response = client.get("/api/v0/character", headers = {"If-None-Match": tag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != tag
+
+# A stale If-Match turns the write away and saves nothing
+def test_stale_if_match(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    tag = client.get("/api/v0/character").headers["ETag"]
+    client.put("/api/v0/character/name", json = {"name": "Max"})
+    response = client.put("/api/v0/character/name", json = {"name": "Ann"}, headers = {"If-Match": tag})
+    assert response.status_code == 412
+    response = client.put("/api/v0/character", json = {"name": "Ann"}, headers = {"If-Match": tag})
+    assert response.status_code == 412
+    response = client.patch("/api/v0/character", json = [{"op": "replace", "path": "/name", "value": "Ann"}], headers = {"If-Match": tag})
+    assert response.status_code == 412
+    assert client.get("/api/v0/character/name").get_json()["data"] == {"name": "Max"}
+
+def test_current_if_match(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    tag = client.get("/api/v0/character").headers["ETag"]
+    response = client.put("/api/v0/character/name", json = {"name": "Ann"}, headers = {"If-Match": tag})
+    assert response.status_code == 200
+    assert client.get("/api/v0/character/name").get_json()["data"] == {"name": "Ann"}
+
+# "*" only matches a character that's been saved
+def test_if_match_any_needs_a_saved_character(app):
+    client = app.test_client()
+    response = client.put("/api/v0/character/name", json = {"name": "Sam"}, headers = {"If-Match": "*"})
+    assert response.status_code == 412
+    assert client.get("/api/v0/character/name").get_json()["data"] == {"name": ""}
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    assert client.put("/api/v0/character/name", json = {"name": "Ann"}, headers = {"If-Match": "*"}).status_code == 200
@@ -0,0 +1,47 @@
+import pythfinder as pf
+import pytest
+
+import filters
+
+def character():
+    return pf.Character(data = {"spells": [
+        {"name": "light", "level": 0},
+        {"name": "shield", "level": 1},
+        {"name": "haste", "level": 3},
+        {"name": "light", "level": 2},
+        {"name": "wish", "level": 9}
+    ]})
+
+def uuids(items):
+    return [item.uuid for item in items]
+
+# The shapes tested here give what pythfinder's own filtering does
+@pytest.mark.parametrize("args", [
+    {"name": "light,haste", "name_search_type": "absolute"},
+    {"level": '{"lt": 3}'},
+    {"level": '{"gt": 0}'},
+    {"level": '{"gt": 0, "lt": 9}'},
+    {"level": '{"lt": 4}', "name": "light", "name_search_type": "absolute"},
+    {}
+])
+def test_fast_paths_match_pythfinder(args):
+    c = character()
+    query_filter = filters.compile("spells", args)
+    assert query_filter.tests or not args
+    assert uuids(query_filter.apply(c.spells, c.get_spells)) == uuids(c.get_spells(data = filters.parse("spells", args)))
+
+def test_uuid_lists():
+    c = character()
+    wanted = [c.spells[3].uuid, c.spells[1].uuid]
+    query_filter = filters.compile("spells", {"uuid": ",".join(wanted)})
+    assert uuids(query_filter.apply(c.spells, c.get_spells)) == [c.spells[1].uuid, c.spells[3].uuid]
+
+# Sorting and paging parameters don't make filters of their own
+def test_cache_ignores_listing_parameters():
+    first = filters.compile("spells", {"level": '{"lt": 3}', "cursor": "a", "limit": "2"})
+    assert filters.compile("spells", {"level": '{"lt": 3}', "cursor": "b", "sort": "name"}) is first
+    assert filters.compile("spells", {"level": '{"lt": 4}'}) is not first
+
+def test_invalid_range():
+    with pytest.raises(ValueError):
+        filters.compile("spells", {"level": "{lt"})
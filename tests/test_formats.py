@@ -0,0 +1,60 @@
+import pythfinder as pf
+import pytest
+
+import codec
+import formats
+from formats import ValueFormat
+from store import CharacterStore
+
+SPELLS = [{"name": "spell {}".format(n), "level": n % 10, "description": "a spell"} for n in range(50)]
+
+# Every format a value has been written in is read back the same
+@pytest.mark.parametrize("options, prefix", [
+    ({"binary": False}, b"["),
+    ({"level": 0}, formats.MSGPACK),
+    ({"level": 3}, formats.ZSTD)
+])
+def test_values_read_back(options, prefix):
+    if options.get("binary", True):
+        pytest.importorskip("msgpack")
+    if options.get("level"):
+        pytest.importorskip("zstandard")
+    raw = ValueFormat(**options).dumps(SPELLS)
+    assert raw[:1] == prefix
+    assert formats.loads(raw) == SPELLS
+    assert codec.loads(formats.json_bytes(raw)) == SPELLS
+
+def session_with(client, id):
+    with client.session_transaction() as session:
+        session["id"] = id
+
+# A character stored as one JSON blob, by the version before per-field
+# storage, is served as it was and converted on first load
+def test_legacy_character_is_migrated(app):
+    state = app.extensions["pythfinder"]
+    state.connect()
+    stored = pf.Character(data = {"name": "Sam", "equipment": [{"name": "rope"}]})
+    state.r.set("old", stored.get_json())
+    client = app.test_client()
+    session_with(client, "old")
+    data = client.get("/api/v0/character").get_json()["data"]
+    assert data == codec.loads(stored.get_json())
+    assert state.r.exists("old") == 0
+    assert state.r.exists("old:fields") == 1
+    assert client.post("/api/v0/character/equipment", json = {"name": "torch"}).status_code in (200, 201)
+    assert [item["name"] for item in client.get("/api/v0/character/equipment").get_json()["data"]] == ["rope", "torch"]
+    # a session from before accounts keeps it as its first character
+    assert [c["id"] for c in client.get("/api/v0/characters").get_json()["data"]] == ["old"]
+
+# Characters written in any format are read by an app writing another
+@pytest.mark.parametrize("options", [{"binary": False}, {"level": 0}, {"level": 3}])
+def test_characters_in_other_formats(app, options):
+    state = app.extensions["pythfinder"]
+    state.connect()
+    doc = codec.loads(pf.Character(data = {"name": "Sam", "spells": SPELLS}).get_json())
+    other = CharacterStore(state.r, ttl = 60, format = ValueFormat(**options))
+    other.write("other", None, other.encode(doc), None)
+    client = app.test_client()
+    session_with(client, "other")
+    assert client.get("/api/v0/character").get_json()["data"] == doc
+    assert client.get("/api/v0/character/spells?level={\"lt\": 1}").get_json()["data"] == [s for s in doc["spells"] if s["level"] < 1]
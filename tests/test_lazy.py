@@ -0,0 +1,47 @@
+import lazy
+from formats import ValueFormat
+from lazy import LazyCharacter, BLANK_DOC
+from store import encode
+from tracking import TrackedCharacter
+
+def stored(doc):
+    return encode({**BLANK_DOC, **doc}, ValueFormat(binary = False).dumps)
+
+# Skills are built from the abilities as the request left them, not as
+# they were stored
+def test_dependent_sections_see_current_values(monkeypatch):
+    built = []
+    character = lazy.pf.Character
+    def recording(data = None):
+        built.append(data)
+        return character(data = data)
+    monkeypatch.setattr(lazy.pf, "Character", recording)
+    c = TrackedCharacter(LazyCharacter(stored({})))
+    c.abilities[0].base = 18
+    c.mark_dirty()
+    c.skills
+    assert built[-1]["abilities"][0]["base"] == 18
+
+# Only the section used is saved, not the ones it's built from
+def test_touched_leaves_out_dependencies():
+    c = TrackedCharacter(LazyCharacter(stored({})))
+    c.get_skills()
+    assert c.touched == {"skills"}
+
+# Items renamed in place by their own update() are found by their new
+# name, not their old one, while the worker cache holds the character
+def test_find_follows_renamed_items(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    assert client.get("/api/v0/character/abilities/str").status_code == 200
+    assert client.patch("/api/v0/character/abilities/str", json = {"name": "strength"}).status_code == 200
+    assert client.get("/api/v0/character/abilities/strength").status_code == 200
+    assert client.get("/api/v0/character/abilities/str").status_code == 404
+
+def test_find_follows_changed_uuids():
+    c = LazyCharacter(stored({"equipment": [{"name": "rope", "uuid": "a"}]}))
+    c.hydrate({"equipment"})
+    item, = c.find("equipment", "uuid", "a")
+    item.uuid = "b"
+    assert c.find("equipment", "uuid", "b") == [item]
+    assert c.find("equipment", "uuid", "a") == []
@@ -0,0 +1,68 @@
+import pytest
+
+import pages
+
+class Item:
+    def __init__(self, name, level):
+        self.uuid = name + "-id"
+        self.name = name
+        self.level = level
+
+    def get_dict(self):
+        return {"name": self.name, "level": self.level, "double": self.level * 2}
+
+def items(*names):
+    return [Item(name, n) for n, name in enumerate(names)]
+
+def names(dicts):
+    return [d["name"] for d in dicts]
+
+def first_page(all_items):
+    data, page = pages.Listing({"limit": "2"}).apply(all_items, vars)
+    assert names(data) == ["a", "b"]
+    return page["next"]
+
+def test_pages():
+    all_items = items("a", "b", "c", "d", "e")
+    cursor = first_page(all_items)
+    data, page = pages.Listing({"limit": "2", "cursor": cursor}).apply(all_items, vars)
+    assert names(data) == ["c", "d"]
+    data, page = pages.Listing({"limit": "2", "cursor": page["next"]}).apply(all_items, vars)
+    assert names(data) == ["e"] and page["next"] is None and page["total"] == 5
+
+# The next page starts in the cursor item's old place once it's deleted,
+# so nothing after it is skipped
+def test_cursor_item_deleted():
+    all_items = items("a", "b", "c", "d", "e")
+    cursor = first_page(all_items)
+    del all_items[1]
+    data, _ = pages.Listing({"limit": "2", "cursor": cursor}).apply(all_items, vars)
+    assert names(data) == ["c", "d"]
+
+# and after the item wherever it's moved to
+def test_cursor_item_moved():
+    all_items = items("a", "b", "c", "d", "e")
+    cursor = first_page(all_items)
+    all_items.append(all_items.pop(1))
+    data, page = pages.Listing({"limit": "2", "cursor": cursor}).apply(all_items, vars)
+    assert data == [] and page["next"] is None
+    all_items.insert(0, all_items.pop())
+    data, _ = pages.Listing({"limit": "2", "cursor": cursor}).apply(all_items, vars)
+    assert names(data) == ["a", "c"]
+
+def test_invalid_cursor():
+    with pytest.raises(ValueError, match = "invalid cursor"):
+        pages.Listing({"cursor": "nonsense"})
+
+# Projected attributes are read off the item; to_dict is only used for
+# ones it works out
+def test_fields_are_read_off_items():
+    calls = []
+    def to_dict(item):
+        calls.append(item)
+        return item.get_dict()
+    data, _ = pages.Listing({"fields": "name,level"}).apply(items("a", "b"), to_dict)
+    assert data == [{"name": "a", "level": 0}, {"name": "b", "level": 1}]
+    assert calls == []
+    data, _ = pages.Listing({"fields": "name,double,missing"}).apply(items("a", "b"), to_dict)
+    assert data == [{"name": "a", "double": 0}, {"name": "b", "double": 2}]
@@ -0,0 +1,101 @@
+import pytest
+
+import patches
+from patches import PatchConflict
+
+def apply(doc, *ops):
+    return patches.apply(doc, patches.check(list(ops)))
+
+def test_add():
+    assert apply({"a": [1, 2]}, {"op": "add", "path": "/b", "value": 3}) == {"a": [1, 2], "b": 3}
+    assert apply({"a": [1, 2]}, {"op": "add", "path": "/a/1", "value": 3}) == {"a": [1, 3, 2]}
+    assert apply({"a": [1, 2]}, {"op": "add", "path": "/a/2", "value": 3}) == {"a": [1, 2, 3]}
+    assert apply({"a": [1, 2]}, {"op": "add", "path": "/a/-", "value": 3}) == {"a": [1, 2, 3]}
+    with pytest.raises(ValueError, match = "out of range"):
+        apply({"a": [1, 2]}, {"op": "add", "path": "/a/3", "value": 3})
+
+def test_remove_and_replace():
+    assert apply({"a": [1, 2], "b": 1}, {"op": "remove", "path": "/a/0"}, {"op": "remove", "path": "/b"}) == {"a": [2]}
+    assert apply({"a": [1, 2]}, {"op": "replace", "path": "/a/1", "value": 5}) == {"a": [1, 5]}
+    with pytest.raises(ValueError, match = "not found"):
+        apply({"a": 1}, {"op": "replace", "path": "/b", "value": 5})
+    with pytest.raises(ValueError, match = "not found"):
+        apply({"a": 1}, {"op": "remove", "path": "/b"})
+    # "-" is only past the end for add
+    with pytest.raises(ValueError, match = "invalid index"):
+        apply({"a": [1]}, {"op": "remove", "path": "/a/-"})
+
+def test_whole_document():
+    assert apply({"a": 1}, {"op": "replace", "path": "", "value": {"b": 2}}) == {"b": 2}
+
+def test_move_and_copy():
+    assert apply({"a": {"x": 1}, "b": {}}, {"op": "move", "from": "/a/x", "path": "/b/y"}) == {"a": {}, "b": {"y": 1}}
+    assert apply({"a": [1, 2, 3]}, {"op": "move", "from": "/a/0", "path": "/a/-"}) == {"a": [2, 3, 1]}
+    doc = apply({"a": {"x": [1]}}, {"op": "copy", "from": "/a", "path": "/b"})
+    doc["b"]["x"].append(2)
+    assert doc == {"a": {"x": [1]}, "b": {"x": [1, 2]}}
+    with pytest.raises(ValueError, match = "into itself"):
+        apply({"a": {"x": {}}}, {"op": "move", "from": "/a", "path": "/a/x/y"})
+    # a sibling whose name starts the same isn't a child
+    assert apply({"a": 1}, {"op": "move", "from": "/a", "path": "/ab"}) == {"ab": 1}
+
+def test_test():
+    assert apply({"a": [1, {"b": True}]}, {"op": "test", "path": "/a", "value": [1, {"b": True}]}) == {"a": [1, {"b": True}]}
+    with pytest.raises(PatchConflict):
+        apply({"a": 1}, {"op": "test", "path": "/a", "value": 2})
+    # JSON's true isn't 1
+    with pytest.raises(PatchConflict):
+        apply({"a": 1}, {"op": "test", "path": "/a", "value": True})
+
+def test_indexes_have_no_leading_zeros():
+    assert apply({"a": [1, 2]}, {"op": "remove", "path": "/a/0"}) == {"a": [2]}
+    with pytest.raises(ValueError, match = "invalid index"):
+        apply({"a": [1, 2]}, {"op": "remove", "path": "/a/01"})
+
+def test_escapes():
+    doc = {"a/b": 1, "m~n": 2}
+    assert apply(doc, {"op": "replace", "path": "/a~1b", "value": 3}, {"op": "remove", "path": "/m~0n"}) == {"a/b": 3}
+    assert patches.parse_pointer("/~01") == ["~1"]
+
+def test_malformed_operations_are_listed():
+    with pytest.raises(ValueError) as err:
+        patches.check([{"op": "jump"}, {"op": "add", "path": "a"}, {"op": "move", "path": "/a"}])
+    message = str(err.value)
+    assert "operation 0" in message and "operation 1" in message and "missing 'from'" in message
+    with pytest.raises(ValueError, match = "nothing to change"):
+        patches.check([])
+
+def test_sections():
+    assert patches.sections([{"op": "move", "from": "/feats/0", "path": "/traits/-"}]) == {"feats", "traits"}
+    assert patches.sections([{"op": "replace", "path": "", "value": {}}]) is None
+
+# A failed test turns the whole patch away
+def test_failed_test_saves_nothing(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    response = client.patch("/api/v0/character", json = [
+        {"op": "replace", "path": "/race", "value": "elf"},
+        {"op": "test", "path": "/name", "value": "Max"}
+    ])
+    assert response.status_code == 409
+    data = client.get("/api/v0/character").get_json()["data"]
+    assert data["name"] == "Sam" and data["race"] == ""
+
+# The logged patches take the character from one version to the next
+def test_logged_patches_rebuild_the_character(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    response = client.get("/api/v0/character")
+    since, doc = int(response.headers["ETag"].strip('"')[1:]), response.get_json()["data"]
+    uuid = client.post("/api/v0/character/equipment", json = {"name": "rope"}).get_json()["data"]["uuid"]
+    client.patch("/api/v0/character/equipment/" + uuid, json = {"count": 3})
+    client.post("/api/v0/character/spells", json = {"name": "light"})
+    client.put("/api/v0/character/race", json = {"race": "elf"})
+    client.patch("/api/v0/character", json = [{"op": "add", "path": "/languages/-", "value": "Elven"}])
+    response = client.get("/api/v0/character/patches?since={}".format(since))
+    assert response.status_code == 200
+    logged = response.get_json()["data"]["patches"]
+    assert len(logged) == 5
+    for change in logged:
+        doc = patches.apply(doc, change["patch"])
+    assert doc == client.get("/api/v0/character").get_json()["data"]
@@ -0,0 +1,44 @@
+def cache(client):
+    return client.get("/metrics").get_json()["data"]["cache"]
+
+def round_trips(response):
+    return int(response.headers["X-Redis-Round-Trips"])
+
+# Once the character is cached: reads are one round trip (checking its
+# version) and write nothing, and a save is one more
+def test_read_after_write(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    tag = client.get("/api/v0/character").headers["ETag"]
+    before = cache(client)
+    for path in ("/api/v0/character", "/api/v0/character/equipment", "/api/v0/character/skills"):
+        response = client.get(path)
+        assert round_trips(response) == 1
+        assert response.headers["ETag"] == tag
+    after = cache(client)
+    assert after["hits"] == before["hits"] + 3 and after["misses"] == before["misses"]
+    response = client.post("/api/v0/character/equipment", json = {"name": "rope"})
+    assert round_trips(response) == 2
+    assert cache(client)["hits"] == after["hits"] + 1
+    # the saved character is cached, so reading it back is a hit
+    response = client.get("/api/v0/character/equipment")
+    assert round_trips(response) == 1
+    assert [item["name"] for item in response.get_json()["data"]] == ["rope"]
+    assert cache(client)["hits"] == after["hits"] + 2
+    # a whole character is saved without being loaded
+    assert round_trips(client.put("/api/v0/character", json = {"name": "Max"})) == 1
+
+# Simple properties are read and written without loading the character
+def test_properties(app):
+    client = app.test_client()
+    client.put("/api/v0/character/name", json = {"name": "Sam"})
+    client.put("/api/v0/character/name", json = {"name": "Max"})
+    assert round_trips(client.put("/api/v0/character/race", json = {"race": "elf"})) == 1
+    assert round_trips(client.get("/api/v0/character/race")) == 1
+    assert cache(client) == {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+# A client without a session never reaches Redis
+def test_sessionless_reads(app):
+    client = app.test_client()
+    for path in ("/api/v0/character", "/api/v0/character/equipment", "/api/v0/character/name"):
+        assert round_trips(client.get(path)) == 0
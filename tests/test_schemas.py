@@ -0,0 +1,18 @@
+import pytest
+
+import schemas
+
+# Only equipment and classes need a name; the rest can be made from {}
+@pytest.mark.parametrize("section", ["feats", "traits", "special", "skills", "spells", "armor", "attacks"])
+def test_empty_items_are_accepted(section):
+    assert schemas.check(section, {}) == {}
+
+@pytest.mark.parametrize("section", ["equipment", "classes"])
+def test_name_is_required(section):
+    with pytest.raises(ValueError, match = "missing 'name'"):
+        schemas.check(section, {})
+
+def test_bad_values_are_listed():
+    with pytest.raises(ValueError) as err:
+        schemas.check("spells", {"name": 5, "level": "high"})
+    assert "'name'" in str(err.value) and "'level'" in str(err.value)
@@ -0,0 +1,22 @@
+import importlib
+
+import pytest
+
+pf_flask = importlib.import_module("pf-flask")
+
+# GET /character sent straight from the stored values is byte for byte
+# what building the character and serializing it gives
+@pytest.mark.parametrize("gold", [1e16, 1e-7, 0.00001, 12.5])
+def test_streamed_character_matches_buffered(app, monkeypatch, gold):
+    client = app.test_client()
+    assert client.put("/api/v0/character/gold", json = {"gold": gold}).status_code == 200
+    assert client.post("/api/v0/character/equipment", json = {"name": "dust", "weight": gold}).status_code == 201
+    streams = []
+    stream_character = pf_flask.stream_character
+    monkeypatch.setattr(pf_flask, "stream_character", lambda snapshot: streams.append(snapshot) or stream_character(snapshot))
+    streamed = client.get("/api/v0/character").get_data()
+    assert len(streams) == 1
+    monkeypatch.setattr(pf_flask, "STREAM_CHARACTER", False)
+    buffered = client.get("/api/v0/character").get_data()
+    assert len(streams) == 1
+    assert streamed == buffered